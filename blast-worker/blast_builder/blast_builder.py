@@ -3,16 +3,38 @@
 This file contains functions for building a blast database from ASVs in
 the postgres database. The script is executed inside a running blast-worker
 container using the build_blast_db.py wrapper.
+
+The database is partitioned on (target) gene: one BLAST database (volume) is
+built per gene, and an alias database with the full name covers them all. A
+'<name>.partitions.json' file maps genes to partitions, so that the worker
+can restrict searches to (and search in parallel over) partitions.
+
+Each build goes into a new version directory ('versions/<version>'), and is
+checked with blastdbcmd before being activated, by atomically switching the
+'current' symlink (which the worker resolves for each job) to it. The last
+few versions are kept, so that a previous one can be activated again.
+
+A manifest ('<name>.manifest.tsv') lists the ASVs (with gene and a hash of
+the taxonomy) in each version. If only new ASVs have been added since the
+active version, the next build links its files into the new version, and
+adds the new ASVs as delta volumes. A full build (compaction) is only made
+when ASVs have been removed or reannotated, or when the deltas grow too large.
 """
 
+import json
 import logging
 import os
+import re
+import shutil
 import subprocess
 import sys
+import time
 
 import psycopg2
 from psycopg2.extras import DictCursor
 
+from seqindex import SequenceIndexWriter
+
 
 def connect_db(pass_file: str = '/run/secrets/postgres_pass'):
     """
@@ -58,34 +80,323 @@ def list_datasets_in_bioatlas(cursor: DictCursor) -> list:
     return [dict(row) for row in cursor.fetchall()]
 
 
-def create_input_fasta(cursor: DictCursor, filename: str = 'blast_input'):
+def list_genes(cursor: DictCursor) -> list:
     """
-    Uses the given database 'cursor' to extract sequences to be placed in
-    'filename'.
+    Returns a list of genes, with number of sequences and letters, in
+    api.app_asvs_for_blastdb.
     """
-    logging.info("Creating input fasta file: %s.fasta", filename)
+    cursor.execute("SELECT gene, count(*) AS sequences, "
+                   "sum(length(asv_sequence)) AS letters "
+                   "FROM api.app_asvs_for_blastdb "
+                   "GROUP BY gene ORDER BY gene;")
+    return [dict(row) for row in cursor.fetchall()]
+
 
-    with open(f'{filename}.fasta', 'w') as fasta:
-        cursor.execute("SELECT * FROM api.app_asvs_for_blastdb;")
-        for asv_id, taxonomy, sequence in cursor.fetchall():
-            fasta.write('>%s-%s\n%s\n' % (asv_id, taxonomy, sequence))
+def partition_name(filename: str, gene: str) -> str:
+    """
+    Returns name of database partition for 'gene', e.g. 'asvdb_16S_rRNA'.
+    """
+    return f"{filename}_{re.sub(r'[^A-Za-z0-9]+', '_', gene).strip('_')}"
 
 
-def create_blast_db_from_fasta(fasta: str, db_name: str):
+def create_blast_db_from_view(connection, db_name: str, gene: str,
+                              timings: dict, manifest=None,
+                              asv_ids: list = None) -> bool:
+    """
+    Creates a blast database 'db_name' from the sequences for 'gene' (and
+    'asv_ids', if given) in api.app_asvs_for_blastdb. FASTA records are
+    streamed from a server-side cursor straight into makeblastdb, via a pipe,
+    so that memory use does not depend on database size. Sequences are also
+    written to a sequence index (see seqindex.py) for the volume, and
+    included ASVs to 'manifest' (file), if given. Time (s) spent on
+    extraction and makeblastdb is added to 'timings'. Returns True if
+    makeblastdb succeeded.
+    """
+    logging.info("Creating blast database %s", db_name)
+
+    CMD = ['/blast/bin/makeblastdb', '-in', '-', '-out', db_name, '-dbtype',
+           'nucl', '-title', gene]
+    process = subprocess.Popen(CMD, stdin=subprocess.PIPE)
+
+    start = time.time()
+    # Named (server-side) cursor, fetching 'itersize' rows at a time
+    with connection.cursor(name='blast_fasta') as cursor, \
+            SequenceIndexWriter(db_name) as index:
+        cursor.itersize = 10000
+        query = "SELECT asv_id, higher_taxonomy, asv_sequence, " \
+                "md5(higher_taxonomy) FROM api.app_asvs_for_blastdb " \
+                "WHERE gene = %s"
+        # Sequence index is written in (byte-wise) asv_id order
+        order = 'ORDER BY asv_id COLLATE "C"'
+        if asv_ids is None:
+            cursor.execute(f"{query} {order};", (gene,))
+        else:
+            cursor.execute(f"{query} AND asv_id = ANY(%s) {order};",
+                           (gene, asv_ids))
+        try:
+            for asv_id, taxonomy, sequence, tax_hash in cursor:
+                process.stdin.write(
+                    f'>{asv_id}-{taxonomy}\n{sequence}\n'.encode())
+                index.add(asv_id, sequence)
+                if manifest:
+                    manifest.write(f'{asv_id}\t{gene}\t{tax_hash}\n')
+            process.stdin.close()
+        except BrokenPipeError:
+            # makeblastdb has exited, see return code below
+            pass
+    extracted = time.time()
+    returncode = process.wait()
+    timings['extraction'] += extracted - start
+    timings['makeblastdb'] += time.time() - extracted
+
+    if returncode != 0:
+        logging.error("makeblastdb failed for %s, with exit status %s",
+                      db_name, returncode)
+        return False
+    return True
+
+
+def create_alias_db(db_name: str, partitions: list) -> bool:
     """
-    Creates a blast database 'db_name' from the sequences in  'fasta'.
+    Creates an alias database 'db_name', covering all 'partitions' (names of
+    databases in the same directory). Returns True if successful.
     """
-    logging.info("Creating blast database %s from %s", db_name, fasta)
+    logging.info("Creating alias database %s for %s", db_name,
+                 ', '.join(partitions))
 
-    CMD = ['/blast/bin/makeblastdb', '-in', fasta, '-out', db_name, '-dbtype',
-           'nucl']
-    subprocess.call(CMD)
+    db_dir, filename = os.path.split(db_name)
+    CMD = ['/blast/bin/blastdb_aliastool', '-dblist', ' '.join(partitions),
+           '-dbtype', 'nucl', '-out', filename, '-title', filename]
+    returncode = subprocess.call(CMD, cwd=db_dir or '.')
+    if returncode != 0:
+        logging.error("blastdb_aliastool failed, with exit status %s",
+                      returncode)
+        return False
+    return True
 
 
-def create_blast_db(filename: str, db_dir: str = '.'):
+def read_manifest(db_name: str) -> dict:
     """
-    Creates a blast database at 'db_dir'/'filename', made from all the datasets
-    that have 'in_bioatlas' set to 'true'.
+    Returns {(asv_id, gene): taxonomy hash} for ASVs in manifest of database
+    'db_name', or None if there is no manifest.
+    """
+    try:
+        with open(f'{db_name}.manifest.tsv') as file:
+            return {(asv_id, gene): tax_hash for asv_id, gene, tax_hash
+                    in (line.rstrip('\n').split('\t') for line in file)}
+    except FileNotFoundError:
+        return None
+
+
+def find_new_asvs(connection, manifest: dict) -> dict:
+    """
+    Compares api.app_asvs_for_blastdb with 'manifest', and returns new ASV
+    IDs per gene, or None if any ASV has been removed or reannotated (which
+    requires a full build).
+    """
+    new = {}
+    seen = 0
+    with connection.cursor(name='blast_manifest') as cursor:
+        cursor.itersize = 10000
+        cursor.execute("SELECT asv_id, gene, md5(higher_taxonomy) "
+                       "FROM api.app_asvs_for_blastdb;")
+        for asv_id, gene, tax_hash in cursor:
+            old_hash = manifest.get((asv_id, gene))
+            if old_hash is None:
+                new.setdefault(gene, []).append(asv_id)
+            elif old_hash != tax_hash:
+                logging.info("Annotation of %s has changed", asv_id)
+                return None
+            else:
+                seen += 1
+    if seen < len(manifest):
+        logging.info("%s ASVs have been removed", len(manifest) - seen)
+        return None
+    return new
+
+
+def link_version_files(old_dir: str, new_dir: str, filename: str):
+    """
+    Hard links database volume files from version in 'old_dir' into
+    'new_dir', so that they can be reused without copying. Files that are
+    rewritten for each version (alias, partition list and manifest) are not
+    linked, as writing these would change the old version too.
+    """
+    rewritten = [f'{filename}.{ext}'
+                 for ext in ['nal', 'partitions.json', 'manifest.tsv']]
+    for name in os.listdir(old_dir):
+        if name not in rewritten:
+            os.link(os.path.join(old_dir, name), os.path.join(new_dir, name))
+
+
+def build_full(connection, cursor: DictCursor, version_dir: str,
+               filename: str, timings: dict) -> dict:
+    """
+    Builds one database (volume) per gene in 'version_dir', and returns
+    partitions, or None if a build fails.
+    """
+    partitions = {}
+    with open(os.path.join(version_dir, f'{filename}.manifest.tsv'),
+              'w') as manifest:
+        for gene in list_genes(cursor):
+            part_name = partition_name(filename, gene['gene'])
+            part_db = os.path.join(version_dir, part_name)
+            if not create_blast_db_from_view(connection, part_db,
+                                             gene['gene'], timings, manifest):
+                return None
+            partitions[gene['gene']] = {'db': part_name,
+                                        'volumes': [part_name],
+                                        'sequences': gene['sequences'],
+                                        'letters': int(gene['letters']),
+                                        'delta_sequences': 0}
+    return partitions
+
+
+def build_delta(connection, cursor: DictCursor, old_dir: str,
+                version_dir: str, filename: str, new_asvs: dict,
+                timings: dict) -> dict:
+    """
+    Reuses volumes of version in 'old_dir', and adds a delta volume of
+    'new_asvs' (IDs per gene) to each affected gene partition, in
+    'version_dir'. Returns partitions, or None if a build fails.
+    """
+    with open(os.path.join(old_dir, f'{filename}.partitions.json')) as file:
+        partitions = json.load(file)
+    link_version_files(old_dir, version_dir, filename)
+    shutil.copyfile(os.path.join(old_dir, f'{filename}.manifest.tsv'),
+                    os.path.join(version_dir, f'{filename}.manifest.tsv'))
+
+    sizes = {g['gene']: g for g in list_genes(cursor)}
+    with open(os.path.join(version_dir, f'{filename}.manifest.tsv'),
+              'a') as manifest:
+        for gene, asv_ids in new_asvs.items():
+            part_name = partition_name(filename, gene)
+            partition = partitions.setdefault(
+                gene, {'db': part_name, 'volumes': [], 'delta_sequences': 0})
+            delta_name = f"{part_name}_d{len(partition['volumes'])}"
+            delta_db = os.path.join(version_dir, delta_name)
+            if not create_blast_db_from_view(connection, delta_db, gene,
+                                             timings, manifest, asv_ids):
+                return None
+            partition['volumes'].append(delta_name)
+            partition['delta_sequences'] += len(asv_ids)
+            partition['sequences'] = sizes[gene]['sequences']
+            partition['letters'] = int(sizes[gene]['letters'])
+    return partitions
+
+
+def check_blast_db(db_name: str, sequences: int) -> bool:
+    """
+    Checks that blastdbcmd can read database 'db_name', and that it contains
+    the expected number of sequences.
+    """
+    CMD = ['/blast/bin/blastdbcmd', '-db', db_name, '-info']
+    process = subprocess.run(CMD, capture_output=True, text=True)
+    if process.returncode != 0:
+        logging.error("blastdbcmd could not read %s: %s", db_name,
+                      process.stderr.strip())
+        return False
+    found = re.search(r'([\d,]+) sequences;', process.stdout)
+    if not found or int(found.group(1).replace(',', '')) != sequences:
+        logging.error("Database %s does not contain the expected %s "
+                      "sequences:\n%s", db_name, sequences, process.stdout)
+        return False
+    logging.info("Checked database %s:\n%s", db_name, process.stdout)
+    return True
+
+
+def has_unique_index(cursor: DictCursor, view: str) -> bool:
+    """
+    Checks whether materialized 'view' is populated, and has a unique index
+    on plain columns, as required for REFRESH MATERIALIZED VIEW CONCURRENTLY.
+    """
+    cursor.execute("""SELECT mv.ispopulated AND EXISTS (
+                          SELECT 1 FROM pg_index i
+                          WHERE i.indrelid = %(view)s::regclass
+                          AND i.indisunique
+                          AND i.indpred IS NULL
+                          AND i.indexprs IS NULL)
+                      FROM pg_matviews mv
+                      WHERE mv.schemaname || '.' || mv.matviewname = %(view)s;
+                   """, {'view': view})
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def create_version_dir(db_dir: str) -> tuple:
+    """
+    Creates directory for a new database version, named by the current time
+    (with a suffix if a version was already created in the same second), and
+    returns version and directory.
+    """
+    version = time.strftime('%Y%m%d%H%M%S')
+    for suffix in range(100):
+        name = f'{version}-{suffix}' if suffix else version
+        version_dir = os.path.join(db_dir, 'versions', name)
+        try:
+            os.makedirs(version_dir)
+            return name, version_dir
+        except FileExistsError:
+            continue
+    raise FileExistsError(f'Too many database versions named {version}')
+
+
+def list_versions(db_dir: str) -> list:
+    """
+    Returns database versions (oldest first) in 'db_dir'/versions.
+    """
+    try:
+        return sorted(os.listdir(os.path.join(db_dir, 'versions')))
+    except FileNotFoundError:
+        return []
+
+
+def current_version(db_dir: str) -> str:
+    """
+    Returns the active database version, or None if there is none.
+    """
+    link = os.path.join(db_dir, 'current')
+    if not os.path.islink(link):
+        return None
+    return os.path.basename(os.readlink(link))
+
+
+def activate_version(db_dir: str, version: str):
+    """
+    Makes 'version' the active database version, by atomically replacing the
+    'current' symlink. Workers use the new version from their next job.
+    """
+    if version not in list_versions(db_dir):
+        logging.error("No such database version: %s", version)
+        sys.exit(1)
+    link = os.path.join(db_dir, 'current')
+    tmp_link = f'{link}.{os.getpid()}'
+    os.symlink(os.path.join('versions', version), tmp_link)
+    os.replace(tmp_link, link)
+    logging.info("Activated database version %s", version)
+
+
+def remove_old_versions(db_dir: str, keep: int):
+    """
+    Removes all but the 'keep' latest versions (and the active one).
+    """
+    active = current_version(db_dir)
+    versions = list_versions(db_dir)
+    for version in versions[:max(0, len(versions) - keep)]:
+        if version != active:
+            logging.info("Removing old database version %s", version)
+            shutil.rmtree(os.path.join(db_dir, 'versions', version))
+
+
+def create_blast_db(filename: str, db_dir: str = '.', keep: int = 3,
+                    full: bool = False, max_delta: float = 0.1):
+    """
+    Creates a blast database at 'db_dir'/versions/<version>/'filename', made
+    from all the datasets that have 'in_bioatlas' set to 'true', and activates
+    it, if it passes checks. Keeps the latest 'keep' versions. Only new ASVs
+    are added (as delta volumes) to the active version, unless a 'full' build
+    is requested or needed, or deltas would exceed 'max_delta' (share of
+    all sequences).
     """
 
     logging.info("Connecting to database")
@@ -105,31 +416,98 @@ def create_blast_db(filename: str, db_dir: str = '.'):
     assert len(filename) > 0, "Filename must be at least one character long"
     assert isinstance(db_dir, str), "Directory name must be a string"
 
-    # Create filenames
-    db_name = f'{os.path.join(db_dir, filename)}'
-    fasta = f'{db_name}.fasta'
+    # Create version directory and filenames
+    version, version_dir = create_version_dir(db_dir)
+    db_name = f'{os.path.join(version_dir, filename)}'
+
+    # Time spent (s) per build stage
+    timings = {'view refresh': 0, 'compare': 0, 'extraction': 0,
+               'makeblastdb': 0, 'alias & check': 0}
 
     # Update data used in blastdb build (and BLAST search)
+    start = time.time()
     try:
+        # The refresh is only committed along with the new version, so that
+        # the view matches the active version. Refreshed concurrently, it
+        # can still be read (by exact-match searches etc.) until then
+        mode = 'CONCURRENTLY ' if has_unique_index(
+            cursor, 'api.app_asvs_for_blastdb') else ''
+        if not mode:
+            logging.warning("No unique index on api.app_asvs_for_blastdb, "
+                            "so it can not be read during the build")
         logging.info("Refreshing api.app_asvs_for_blastdb")
-        cursor.execute("REFRESH MATERIALIZED VIEW api.app_asvs_for_blastdb;")
+        cursor.execute(f"REFRESH MATERIALIZED VIEW {mode}"
+                       "api.app_asvs_for_blastdb;")
     except psycopg2.OperationalError as err:
         logging.error("Could not refresh materialized view")
         logging.error(err)
         sys.exit(1)
-
-    # Create the fasta file
-    create_input_fasta(cursor, db_name)
-
-    # Create the blast database from the fasta
-    create_blast_db_from_fasta(fasta, db_name)
-
-    # and finally, remove the fasta file, as it's no longer needed
-    os.remove(fasta)
+    timings['view refresh'] = time.time() - start
+
+    # Find ASVs added since active version, if it can be updated
+    start = time.time()
+    new_asvs = None
+    old_dir = None
+    if not full and current_version(db_dir):
+        old_dir = os.path.realpath(os.path.join(db_dir, 'current'))
+        manifest = read_manifest(os.path.join(old_dir, filename))
+        if manifest is not None:
+            new_asvs = find_new_asvs(connection, manifest)
+        if new_asvs is not None:
+            with open(os.path.join(old_dir,
+                                   f'{filename}.partitions.json')) as file:
+                old = json.load(file)
+            deltas = sum(p.get('delta_sequences', 0) for p in old.values()) \
+                + sum(len(ids) for ids in new_asvs.values())
+            if deltas > max_delta * (len(manifest) + deltas):
+                logging.info("Deltas would exceed %s of database",
+                             max_delta)
+                new_asvs = None
+    timings['compare'] = time.time() - start
+
+    # Add delta volumes of new ASVs, or create one database per gene
+    if new_asvs is not None:
+        logging.info("Adding %s new ASVs to version %s",
+                     sum(len(ids) for ids in new_asvs.values()),
+                     os.path.basename(old_dir))
+        partitions = build_delta(connection, cursor, old_dir, version_dir,
+                                 filename, new_asvs, timings)
+    else:
+        logging.info("Making full build")
+        partitions = build_full(connection, cursor, version_dir, filename,
+                                timings)
+    ok = partitions is not None
+
+    # Create alias database and partition list, and check new version
+    # before activating it
+    start = time.time()
+    if ok:
+        ok = create_alias_db(db_name, [v for p in partitions.values()
+                                       for v in p['volumes']])
+    if ok:
+        with open(f'{db_name}.partitions.json', 'w') as file:
+            json.dump(partitions, file, indent=2)
+        ok = check_blast_db(db_name, sum(p['sequences']
+                                         for p in partitions.values()))
+    timings['alias & check'] = time.time() - start
+
+    # Otherwise, keep current version (and matching api.app_asvs_for_blastdb)
+    if not ok:
+        logging.error("Discarding database version %s", version)
+        shutil.rmtree(version_dir)
+        connection.rollback()
+        sys.exit(1)
 
     logging.info("Committing update of api.app_asvs_for_blastdb")
     connection.commit()
 
+    # and finally, switch to new version, and remove old ones
+    activate_version(db_dir, version)
+    remove_old_versions(db_dir, keep)
+
+    logging.info("Build times (s): %s", ', '.join(
+        f'{stage}: {seconds:.1f}' for stage, seconds in timings.items()))
+
 
 if __name__ == '__main__':
 
@@ -141,6 +519,20 @@ if __name__ == '__main__':
                         help="Directory to store database files in.")
     PARSER.add_argument('--filename', default="asvdb",
                         help="Filename prefix for database files.")
+    PARSER.add_argument('--keep', type=int, default=3,
+                        help="Number of database versions to keep.")
+    PARSER.add_argument('--full', action="store_true",
+                        help="Make a full build, even if new ASVs could be "
+                             "added to active version.")
+    PARSER.add_argument('--max-delta', type=float, default=0.1,
+                        help="Max share of sequences in delta volumes, "
+                             "before a full build is made.")
+    PARSER.add_argument('--list', action="store_true",
+                        help="List database versions, and exit.")
+    PARSER.add_argument('--activate', metavar='VERSION',
+                        help="Activate an existing database version (e.g. "
+                             "to roll back), and exit. Note that "
+                             "api.app_asvs_for_blastdb is not rolled back.")
     PARSER.add_argument('-v', '--verbose', action="count", default=0,
                         help="Increase logging verbosity (default: warning).")
     PARSER.add_argument('-q', '--quiet', action="count", default=3,
@@ -153,5 +545,14 @@ if __name__ == '__main__':
     # E.g: -vv means log level = 10(3-2) = 10 = DEBUG
     # E.g: -qqvv means log level = 10(5-2) = 30 = WARNING
     logging.basicConfig(level=(10*(ARGS.quiet - ARGS.verbose)))
-    # Build a new blast database
-    create_blast_db(ARGS.filename, ARGS.db_dir)
+
+    if ARGS.list:
+        ACTIVE = current_version(ARGS.db_dir)
+        for VERSION in list_versions(ARGS.db_dir):
+            print(VERSION, '(active)' if VERSION == ACTIVE else '')
+    elif ARGS.activate:
+        activate_version(ARGS.db_dir, ARGS.activate)
+    else:
+        # Build a new blast database
+        create_blast_db(ARGS.filename, ARGS.db_dir, ARGS.keep, ARGS.full,
+                        ARGS.max_delta)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the BLAST builder, run without a database or BLAST binaries:
+rows are served by a stand-in (server-side) cursor, and makeblastdb is
+replaced by a process that only collects the FASTA written to it. Run from
+this directory:
+
+    python3 blast_builder_tests.py
+"""
+
+import io
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import blast_builder
+from seqindex import SequenceIndex
+
+ROWS = [
+    ('ASV:0aa', 'Bacteria;Proteobacteria', 'ACGT', 'hash0'),
+    ('ASV:1bb', 'Bacteria;Firmicutes', 'GGCCTTAA', 'hash1'),
+    ('ASV:2cc', 'Archaea', 'TTTT', 'hash2'),
+]
+
+
+class StandInCursor:
+    """
+    Serves ROWS, like a named psycopg2 cursor used as a context manager.
+    """
+
+    def __init__(self):
+        self.itersize = None
+        self.query = None
+
+    def execute(self, query, params=None):
+        self.query = query
+
+    def __iter__(self):
+        return iter(ROWS)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class StandInConnection:
+    def cursor(self, name=None):
+        return StandInCursor()
+
+
+class StandInMakeblastdb:
+    """
+    Collects FASTA written to stdin, and exits with status 0.
+    """
+
+    def __init__(self, cmd, stdin=None):
+        self.cmd = cmd
+        self.stdin = io.BytesIO()
+        # Keep content readable after the builder closes stdin
+        self.stdin.close = lambda: None
+
+    def wait(self):
+        return 0
+
+
+class CreateBlastDbTest(unittest.TestCase):
+    """
+    Tests the FASTA and sequence index build path of
+    create_blast_db_from_view.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_name = os.path.join(self.dir.name, 'asvdb_16S_rRNA')
+        self.processes = []
+
+        def popen(cmd, stdin=None):
+            process = StandInMakeblastdb(cmd, stdin)
+            self.processes.append(process)
+            return process
+
+        patcher = mock.patch.object(blast_builder.subprocess, 'Popen', popen)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.dir.cleanup)
+
+    def build(self, manifest=None) -> bool:
+        timings = {'extraction': 0, 'makeblastdb': 0}
+        return blast_builder.create_blast_db_from_view(
+            StandInConnection(), self.db_name, '16S rRNA', timings, manifest)
+
+    def test_fasta_and_index(self):
+        """
+        Checks that all rows are written as FASTA, and to the sequence index.
+        """
+        self.assertTrue(self.build())
+        fasta = self.processes[0].stdin.getvalue().decode()
+        self.assertEqual(fasta, ''.join(f'>{a}-{t}\n{s}\n'
+                                        for a, t, s, _ in ROWS))
+
+        index = SequenceIndex(self.db_name)
+        try:
+            self.assertEqual(index.size, len(ROWS))
+            for asv_id, _, sequence, _ in ROWS:
+                self.assertEqual(index.get(asv_id), sequence)
+            self.assertIsNone(index.get('ASV:missing'))
+        finally:
+            index.close()
+
+    def test_manifest(self):
+        """
+        Checks that included ASVs are written to the manifest, if given.
+        """
+        manifest = io.StringIO()
+        self.assertTrue(self.build(manifest))
+        self.assertEqual(manifest.getvalue(),
+                         ''.join(f'{a}\t16S rRNA\t{h}\n'
+                                 for a, _, _, h in ROWS))
+
+
+if __name__ == "__main__":
+    unittest.main()
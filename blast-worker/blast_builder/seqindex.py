@@ -0,0 +1,93 @@
+"""
+Compact index of ASV sequences, written next to each BLAST database volume
+by the BLAST builder, and used by the worker to add subject sequences to
+BLAST results. The index consists of two files:
+
+    <volume>.seqs    all sequences, concatenated (ASCII)
+    <volume>.seqidx  fixed-size records (asv_id, offset, length), sorted on
+                     asv_id, so that sequences can be found by binary search
+
+Both files are memory-mapped when read, so lookups need neither a database
+call nor loading the index into memory.
+"""
+
+import mmap
+import os
+import struct
+
+# asv_id (36 bytes, e.g. 'ASV:<md5>'), offset in .seqs and sequence length
+RECORD = struct.Struct('<36sQI')
+
+
+class SequenceIndexWriter:
+    """
+    Writes an index for volume 'prefix'. Sequences must be added in asv_id
+    order (byte-wise, i.e. COLLATE "C" in postgres).
+    """
+
+    def __init__(self, prefix: str):
+        self._seqs = open(f'{prefix}.seqs', 'wb')
+        self._idx = open(f'{prefix}.seqidx', 'wb')
+        self._offset = 0
+
+    def add(self, asv_id: str, sequence: str):
+        data = sequence.encode()
+        self._seqs.write(data)
+        self._idx.write(RECORD.pack(asv_id.encode(), self._offset, len(data)))
+        self._offset += len(data)
+
+    def close(self):
+        self._seqs.close()
+        self._idx.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SequenceIndex:
+    """
+    Reads the index for volume 'prefix'. Raises FileNotFoundError if the
+    volume has no index (e.g. if built before indexes were introduced).
+    """
+
+    def __init__(self, prefix: str):
+        self._maps = []
+        self._seqs = self._map(f'{prefix}.seqs')
+        self._idx = self._map(f'{prefix}.seqidx')
+        self.size = len(self._idx) // RECORD.size if self._idx else 0
+
+    def _map(self, path: str):
+        with open(path, 'rb') as file:
+            # Empty files can't be mapped
+            if os.fstat(file.fileno()).st_size == 0:
+                return b''
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    def get(self, asv_id: str) -> str:
+        """
+        Returns sequence for 'asv_id', or None if it is not in the index.
+        """
+        key = asv_id.encode().ljust(36, b'\0')
+        low, high = 0, self.size
+        while low < high:
+            mid = (low + high) // 2
+            start = mid * RECORD.size
+            found = self._idx[start:start + 36]
+            if found < key:
+                low = mid + 1
+            elif found > key:
+                high = mid
+            else:
+                _, offset, length = RECORD.unpack_from(self._idx, start)
+                return self._seqs[offset:offset + length].decode()
+        return None
+
+    def close(self):
+        for mapped in self._maps:
+            mapped.close()
+        self._maps = []
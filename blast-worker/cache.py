@@ -0,0 +1,192 @@
+"""
+Result cache used by the blast worker. BLAST results (JSON response bodies)
+are cached in memory, and optionally on disk, keyed by a hash of the
+normalized query, search parameters and a version stamp of the BLAST
+database. Least recently used entries are evicted when the cache grows past
+a size limit, and all entries are dropped when the database changes.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+
+def normalize_query(sequence: str) -> list:
+    """
+    Parses FASTA text into a list of [header, sequence] pairs, ignoring
+    whitespace, line breaks and sequence case, so that equivalent queries
+    get the same cache key.
+    """
+    records = []
+    for row in sequence.split('\n'):
+        row = row.strip()
+        if not row:
+            continue
+        if row.startswith('>') or not records:
+            records.append([row, ''])
+        else:
+            records[-1][1] += row.upper()
+    return records
+
+
+def db_version(db_path: str) -> str:
+    """
+    Returns a version stamp for the BLAST database at 'db_path', based on
+    names, sizes and modification times of the database files, including
+    files of any (gene) partitions.
+    """
+    stamp = hashlib.sha1()
+    paths = glob.glob(f'{db_path}.*') + glob.glob(f'{db_path}_*.*')
+    for path in sorted(paths):
+        stat = os.stat(path)
+        stamp.update(f'{path}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return stamp.hexdigest()
+
+
+class ResultCache:
+    """
+    LRU cache of response bodies, holding at most 'max_bytes' bytes. If
+    'path' is given, entries are also written to (and, at startup, read from)
+    that directory, so that they survive worker restarts. If given,
+    'current_version' is called to get the version of the active database,
+    which entries are kept for; otherwise, the version of the latest lookup
+    is taken to be the active one.
+    """
+
+    def __init__(self, max_bytes: int, path: str = None,
+                 current_version=None):
+        self.max_bytes = max_bytes
+        self.path = path
+        self.current_version = current_version
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(path, exist_ok=True)
+            self._load()
+
+    @staticmethod
+    def key(sequence: str, params: dict, version: str) -> str:
+        """
+        Returns cache key for a query, search parameters and db version.
+        """
+        data = [normalize_query(sequence), sorted(params.items()), version]
+        return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+    def get(self, key: str, version: str) -> bytes:
+        """
+        Returns cached body for key, or None. Lookups for other than the
+        active db version (e.g. of a request that resolved the version just
+        before the database was switched) are misses.
+        """
+        with self._lock:
+            self._check_version(self.current_version() if self.current_version
+                                else version)
+            body = self._entries.get(key) if version == self._version \
+                else None
+            if body is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return body
+
+    def put(self, key: str, version: str, body: bytes):
+        """
+        Adds body to cache, and evicts least recently used entries as needed.
+        Bodies for other than the current db version (e.g. of a job that ran
+        while the database was switched) are dropped.
+        """
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            if self.current_version:
+                self._check_version(self.current_version())
+            elif self._version is None:
+                self._check_version(version)
+            if version != self._version:
+                return
+            if key in self._entries:
+                return
+            self._entries[key] = body
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                old_key, old_body = self._entries.popitem(last=False)
+                self._size -= len(old_body)
+                self._remove_file(old_key)
+            if self.path:
+                self._write_file(key, body)
+
+    def status(self) -> dict:
+        """
+        Returns cache statistics.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries), 'bytes': self._size}
+
+    def _check_version(self, version: str):
+        """
+        Drops all entries if the active database version has changed. Must
+        be called with lock held.
+        """
+        if version == self._version:
+            return
+        if self._version is not None:
+            logging.info('BLAST database changed, clearing result cache')
+            for key in self._entries:
+                self._remove_file(key)
+            self._entries.clear()
+            self._size = 0
+        self._version = version
+        if self.path:
+            with open(os.path.join(self.path, 'VERSION'), 'w') as file:
+                file.write(version)
+
+    def _load(self):
+        """
+        Reads entries written by a previous worker process, oldest first.
+        Entries are checked against the current db version on first lookup.
+        """
+        try:
+            with open(os.path.join(self.path, 'VERSION')) as file:
+                self._version = file.read().strip()
+        except FileNotFoundError:
+            return
+        files = sorted(glob.glob(os.path.join(self.path, '*.json')),
+                       key=os.path.getmtime)
+        for path in files:
+            with open(path, 'rb') as file:
+                body = file.read()
+            key = os.path.basename(path)[:-len('.json')]
+            self._entries[key] = body
+            self._size += len(body)
+        while self._size > self.max_bytes:
+            old_key, old_body = self._entries.popitem(last=False)
+            self._size -= len(old_body)
+            self._remove_file(old_key)
+
+    def _write_file(self, key: str, body: bytes):
+        try:
+            with open(os.path.join(self.path, f'{key}.json'), 'wb') as file:
+                file.write(body)
+        except OSError as err:
+            logging.warning('Could not write cache entry: %s', err)
+
+    def _remove_file(self, key: str):
+        if not self.path:
+            return
+        try:
+            os.remove(os.path.join(self.path, f'{key}.json'))
+        except FileNotFoundError:
+            pass
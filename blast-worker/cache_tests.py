@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the BLAST worker result cache. Run from this directory:
+
+    python3 cache_tests.py
+"""
+
+import unittest
+
+from cache import ResultCache
+
+
+class ResultCacheVersionTest(unittest.TestCase):
+    """
+    Tests that entries are dropped when the database version changes, but
+    not by jobs that finish after a switch.
+    """
+
+    def setUp(self):
+        self.cache = ResultCache(max_bytes=1000)
+
+    def test_new_version_clears(self):
+        """
+        Checks that a lookup with a new version drops older entries.
+        """
+        self.cache.get('a', 'v1')
+        self.cache.put('a', 'v1', b'old')
+        self.assertEqual(self.cache.get('a', 'v1'), b'old')
+        self.assertIsNone(self.cache.get('a', 'v2'))
+        self.assertEqual(self.cache.status()['entries'], 0)
+
+    def test_late_put_after_switch(self):
+        """
+        Checks that a job started before a switch, and finished after it,
+        neither adds its result nor clears entries of the new version.
+        """
+        self.cache.get('slow', 'v1')
+        # Database switched, and another job cached under the new version
+        self.cache.get('fast', 'v2')
+        self.cache.put('fast', 'v2', b'new')
+        # Slow job finishes
+        self.cache.put('slow', 'v1', b'stale')
+        self.assertEqual(self.cache.get('fast', 'v2'), b'new')
+        self.assertIsNone(self.cache.get('slow', 'v2'))
+        self.assertEqual(self.cache.status()['entries'], 1)
+
+    def test_late_get_after_switch(self):
+        """
+        Checks that a lookup with the version resolved before a switch is a
+        miss, and neither clears entries of the new version, nor switches
+        the cache back to the old version.
+        """
+        active = ['v1']
+        self.cache = ResultCache(max_bytes=1000,
+                                 current_version=lambda: active[0])
+        self.cache.get('a', 'v1')
+        self.cache.put('a', 'v1', b'old')
+        # Database switched, and a job cached under the new version
+        active[0] = 'v2'
+        self.cache.get('b', 'v2')
+        self.cache.put('b', 'v2', b'new')
+        # Request that resolved the old version before the switch
+        self.assertIsNone(self.cache.get('a', 'v1'))
+        self.cache.put('a', 'v1', b'stale')
+        self.assertEqual(self.cache.get('b', 'v2'), b'new')
+        self.assertEqual(self.cache.status()['entries'], 1)
+
+    def test_rollback(self):
+        """
+        Checks that activating a previous version again switches the cache
+        to that version.
+        """
+        active = ['v1']
+        self.cache = ResultCache(max_bytes=1000,
+                                 current_version=lambda: active[0])
+        active[0] = 'v2'
+        self.cache.get('a', 'v2')
+        self.cache.put('a', 'v2', b'new')
+        active[0] = 'v1'
+        self.assertIsNone(self.cache.get('a', 'v1'))
+        self.cache.put('a', 'v1', b'old')
+        self.assertEqual(self.cache.get('a', 'v1'), b'old')
+        self.assertEqual(self.cache.status()['entries'], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,324 @@
+"""
+Job queue used by the blast worker. Submitted jobs (blastn commands) wait in
+a queue until one of a fixed number of runner threads is free, so that only a
+limited number of blastn jobs run at the same time. A job may be split into
+shards (e.g. parts of a multi-sequence query), which are run as concurrent
+processes, and whose outputs are joined in shard order. Output lines may be
+parsed as they are read, so that only parsed rows are kept. Output may be
+limited to a number of lines (per shard), after which a process is killed,
+and the job marked as truncated. Finished jobs are kept for a while, so that
+their results can be polled.
+"""
+
+import math
+import queue
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Job states
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+
+class QueueFull(Exception):
+    """
+    Raised when a job is submitted while the queue is full. 'retry_after' is
+    an estimate of the number of seconds until there is room again.
+    """
+    def __init__(self, retry_after: int):
+        super().__init__(f'Job queue is full, retry after {retry_after} s')
+        self.retry_after = retry_after
+
+
+class Job:
+    """
+    Commands to run, as a list of (cmd, stdin) shards, with state and (when
+    finished) joined output, or parsed output rows (if the queue parses
+    output). If 'max_lines' is given, at most that many lines of output are
+    read from each shard.
+    """
+
+    def __init__(self, shards: list, max_lines: int = None):
+        self.id = uuid.uuid4().hex
+        self.shards = shards
+        self.max_lines = max_lines
+        self.state = QUEUED
+        self.processes = []
+        self.returncode = None
+        self.stdout = None
+        self.rows = None
+        self.stderr = None
+        self.truncated = False
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._finished = threading.Event()
+
+    @property
+    def is_finished(self) -> bool:
+        return self._finished.is_set()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Waits until job is finished (or 'timeout' seconds have passed), and
+        returns True if it is.
+        """
+        return self._finished.wait(timeout)
+
+    def finish(self, state: str):
+        """
+        Sets the final state of the job, and wakes up anyone waiting for it.
+        """
+        self.state = state
+        self.finished = time.time()
+        self._finished.set()
+
+    def as_dict(self) -> dict:
+        """
+        Returns job id, state and timing, e.g. for a status response.
+        """
+        return {'job_id': self.id, 'state': self.state,
+                'shards': len(self.shards), 'submitted': self.submitted,
+                'started': self.started, 'finished': self.finished}
+
+
+class JobQueue:
+    """
+    Runs jobs in 'workers' runner threads, and accepts at most 'max_queued'
+    waiting jobs. Finished jobs are forgotten after 'keep_for' seconds. If
+    given, 'on_finish' is called with each finished job (in the runner
+    thread, or when a queued job is cancelled), and 'parse_line' with each
+    line of output, as it is read, returning a row for job.rows (or None, to
+    skip the line).
+    """
+
+    def __init__(self, workers: int, max_queued: int, keep_for: int = 600,
+                 on_finish=None, parse_line=None):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.keep_for = keep_for
+        self.on_finish = on_finish
+        self.parse_line = parse_line
+        self._queue = queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._queued = 0
+        self._running = 0
+        # Moving average of job run times, used to estimate waiting times
+        self._avg_runtime = None
+
+        for i in range(workers):
+            threading.Thread(target=self._run, name=f'blast-runner-{i}',
+                             daemon=True).start()
+
+    def submit(self, shards: list, max_lines: int = None) -> Job:
+        """
+        Adds a job, consisting of (cmd, stdin) shards, to the queue, and
+        returns it. Raises QueueFull if there is no room for more jobs.
+        """
+        with self._lock:
+            self._purge()
+            if self._queued >= self.max_queued:
+                raise QueueFull(self._retry_after())
+            job = Job(shards, max_lines)
+            self._jobs[job.id] = job
+            self._queued += 1
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id: str) -> Job:
+        """
+        Returns job with given id, or None if there is no such job.
+        """
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Job:
+        """
+        Cancels a queued or running job (by killing its processes), and
+        returns it, or None if there is no such job.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.is_finished:
+                return job
+            if job.state == QUEUED:
+                self._queued -= 1
+                job.finish(CANCELLED)
+            else:
+                # Runner thread finishes the job when the process has ended
+                job.state = CANCELLED
+                for process in job.processes:
+                    process.kill()
+                return job
+        if self.on_finish:
+            self.on_finish(job)
+        return job
+
+    def status(self) -> dict:
+        """
+        Returns number of running and queued jobs, and queue limits.
+        """
+        with self._lock:
+            return {'running': self._running, 'queued': self._queued,
+                    'workers': self.workers, 'max_queued': self.max_queued}
+
+    def _retry_after(self) -> int:
+        """
+        Estimates the number of seconds until a queued job could be started.
+        Must be called with lock held.
+        """
+        runtime = self._avg_runtime or 10
+        return max(1, math.ceil(runtime * (self._queued + 1) / self.workers))
+
+    def _purge(self):
+        """
+        Forgets jobs that finished more than 'keep_for' seconds ago.
+        Must be called with lock held.
+        """
+        limit = time.time() - self.keep_for
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.is_finished and job.finished < limit]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def _run(self):
+        """
+        Runner thread loop: takes jobs from queue and runs them, one by one.
+        """
+        while True:
+            job = self._queue.get()
+            with self._lock:
+                # Cancelled while waiting in queue
+                if job.state == CANCELLED:
+                    continue
+                self._queued -= 1
+                self._running += 1
+                job.state = RUNNING
+                job.started = time.time()
+                try:
+                    for cmd, _ in job.shards:
+                        job.processes.append(subprocess.Popen(
+                            cmd, stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+                # Make sure to catch everything so that runners keep working
+                # pylint: disable=broad-except
+                except Exception as ex:
+                    for process in job.processes:
+                        process.kill()
+                        process.wait()
+                    job.processes = []
+                    self._running -= 1
+                    job.stderr = str(ex).encode()
+                    job.finish(FAILED)
+            # Failed to start
+            if job.is_finished:
+                if self.on_finish:
+                    self.on_finish(job)
+                continue
+
+            outputs = self._communicate(job)
+
+            with self._lock:
+                self._running -= 1
+                # Report first failure, if any (but processes killed when
+                # reaching output limit are not failures)
+                job.returncode = next(
+                    (p.returncode for p, (_, _, truncated)
+                     in zip(job.processes, outputs)
+                     if p.returncode != 0 and not truncated), 0)
+                if self.parse_line:
+                    job.rows = [row for out, _, _ in outputs for row in out]
+                else:
+                    job.stdout = b''.join(out for out, _, _ in outputs)
+                job.stderr = b''.join(err for _, err, _ in outputs)
+                job.truncated = any(truncated for _, _, truncated in outputs)
+                job.processes = []
+                runtime = time.time() - job.started
+                self._avg_runtime = runtime if self._avg_runtime is None \
+                    else 0.8 * self._avg_runtime + 0.2 * runtime
+                if job.state == CANCELLED:
+                    job.finish(CANCELLED)
+                else:
+                    job.finish(DONE if job.returncode == 0 else FAILED)
+            if self.on_finish:
+                self.on_finish(job)
+
+    def _communicate(self, job: Job) -> list:
+        """
+        Sends input to, and reads output & error from, each process of a job
+        until 'eof' (or output limit), and returns (stdout, stderr, truncated)
+        per shard, with stdout as a list of rows if output is parsed. Extra
+        shards are handled in helper threads, so that all processes run
+        concurrently.
+        """
+        outputs = [None] * len(job.processes)
+
+        def communicate(i):
+            outputs[i] = JobQueue._communicate_lines(
+                job.processes[i], job.shards[i][1], job.max_lines,
+                self.parse_line)
+
+        helpers = [threading.Thread(target=communicate, args=(i,))
+                   for i in range(1, len(job.processes))]
+        for helper in helpers:
+            helper.start()
+        communicate(0)
+        for helper in helpers:
+            helper.join()
+        return outputs
+
+    @staticmethod
+    def _communicate_lines(process, stdin: bytes, max_lines: int,
+                           parse_line=None) -> tuple:
+        """
+        Like communicate(), but reads output line by line, as it is produced,
+        and (if 'max_lines' is given) stops reading after 'max_lines' lines,
+        and then kills the process. If given, 'parse_line' is applied to each
+        line as it is read, and only the (not None) rows it returns are kept.
+        Returns (stdout, or rows, stderr, truncated), where truncated is True
+        if there was more output.
+        """
+        errors = []
+
+        def write():
+            try:
+                process.stdin.write(stdin)
+                process.stdin.close()
+            except OSError:
+                # Process was killed before reading all input
+                pass
+
+        helpers = [threading.Thread(target=write),
+                   threading.Thread(target=lambda: errors.append(
+                       process.stderr.read()))]
+        for helper in helpers:
+            helper.start()
+
+        lines = []
+        n_lines = 0
+        truncated = False
+        for line in process.stdout:
+            if max_lines is not None and n_lines == max_lines:
+                truncated = True
+                process.kill()
+                break
+            n_lines += 1
+            if parse_line is None:
+                lines.append(line)
+            else:
+                row = parse_line(line)
+                if row is not None:
+                    lines.append(row)
+        process.stdout.close()
+        process.wait()
+        for helper in helpers:
+            helper.join()
+        out = b''.join(lines) if parse_line is None else lines
+        return out, b''.join(errors), truncated
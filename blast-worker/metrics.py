@@ -0,0 +1,135 @@
+"""
+Minimal metrics for the blast worker, exposed in the Prometheus text format
+(see /metrics in worker.py). Each metric keeps running totals only (counts
+per bucket or label), so recording a value is a lock and a few additions.
+"""
+
+import threading
+from bisect import bisect_left
+
+# Bucket bounds for durations (seconds), and for counts (sequences, letters,
+# rows), the latter roughly exponential
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30,
+                60, 120, 300)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+                 100000, 1000000)
+
+
+def format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join('{}="{}"'.format(
+        key, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for key, value in labels.items())
+    return '{' + pairs + '}'
+
+
+class Histogram:
+    """
+    Counts observed values per bucket (upper bounds 'buckets'), and keeps
+    their sum.
+    """
+
+    def __init__(self, name: str, help_text: str, buckets: tuple):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def expose(self) -> list:
+        with self._lock:
+            counts, total = list(self._counts), self._sum
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} histogram']
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{format_labels({"le": bound})} '
+                         f'{cumulative}')
+        lines.append(f'{self.name}_sum {format_value(total)}')
+        lines.append(f'{self.name}_count {cumulative}')
+        return lines
+
+
+class Counter:
+    """
+    Counts events, per value of label 'label'.
+    """
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value, amount: int = 1):
+        with self._lock:
+            self._counts[value] = self._counts.get(value, 0) + amount
+
+    def expose(self) -> list:
+        with self._lock:
+            counts = dict(self._counts)
+        lines = [f'# HELP {self.name} {self.help}',
+                 f'# TYPE {self.name} counter']
+        for value, count in sorted(counts.items(), key=lambda x: str(x[0])):
+            lines.append(f'{self.name}{format_labels({self.label: value})} '
+                         f'{count}')
+        return lines
+
+
+def gauge(name: str, help_text: str, value, labels: dict = None) -> list:
+    """
+    Returns lines for a gauge, whose value is read when metrics are exposed.
+    """
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} gauge',
+            f'{name}{format_labels(labels)} {format_value(value)}']
+
+
+class LatencyStats:
+    """
+    Keeps count and average run time of cold and warm jobs, where a job is
+    cold if none of its databases has been searched during the last
+    'warm_for' seconds (e.g. after idle periods, or a new database version).
+    """
+
+    def __init__(self, warm_for: float = 300):
+        self.warm_for = warm_for
+        # database -> time last searched
+        self._last_used = {}
+        self._stats = {'cold': [0, 0], 'warm': [0, 0]}
+        self._lock = threading.Lock()
+
+    def observe(self, databases: list, started: float, seconds: float):
+        with self._lock:
+            warm = any(db in self._last_used
+                       and started - self._last_used[db] < self.warm_for
+                       for db in databases)
+            stats = self._stats['warm' if warm else 'cold']
+            stats[0] += 1
+            stats[1] += seconds
+            for db in databases:
+                self._last_used[db] = started + seconds
+            # Forget databases not used for a while (e.g. old versions)
+            for db in [db for db, used in self._last_used.items()
+                       if started - used > self.warm_for]:
+                del self._last_used[db]
+
+    def status(self) -> dict:
+        with self._lock:
+            return {kind: {'jobs': count,
+                           'avg_seconds': round(total / count, 3)
+                           if count else None}
+                    for kind, (count, total) in self._stats.items()}
@@ -0,0 +1,163 @@
+"""
+Optional preloading of the active BLAST database version into RAM, e.g. a
+tmpfs such as /dev/shm, so that searches don't depend on the page cache of
+the (shared) database volume. A background thread copies the version that
+the 'current' symlink points to (at startup, and after each rebuild), and
+searches use the copy once it is complete. Jobs hold a reference to the
+copy they search, and copies of older versions are only removed when no job
+holds them anymore.
+"""
+
+import logging
+import os
+import shutil
+import threading
+import time
+
+
+def dir_size(path: str) -> int:
+    """
+    Returns total size (bytes) of files in directory.
+    """
+    return sum(entry.stat().st_size for entry in os.scandir(path)
+               if entry.is_file())
+
+
+class Preloader:
+    """
+    Keeps a copy of the active database version in 'db_dir' in 'ram_dir',
+    checking for new versions every 'interval' seconds. If given,
+    'on_remove' is called with the path of each copy that is removed.
+    """
+
+    def __init__(self, db_dir: str, ram_dir: str, interval: float = 30,
+                 on_remove=None):
+        self.db_dir = db_dir
+        self.ram_dir = os.path.normpath(ram_dir)
+        self.interval = interval
+        self.on_remove = on_remove
+        # version -> path of complete copy
+        self._loaded = {}
+        # version -> number of jobs using its copy
+        self._refs = {}
+        # Version of the active copy, which is kept while unused
+        self._active = None
+        # Versions that could not be copied (not retried)
+        self._failed = set()
+        self._loading = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts background thread that loads the active version.
+        """
+        os.makedirs(self.ram_dir, exist_ok=True)
+        # Leftovers from a previous run may be incomplete
+        for name in os.listdir(self.ram_dir):
+            shutil.rmtree(os.path.join(self.ram_dir, name),
+                          ignore_errors=True)
+        threading.Thread(target=self._run, name='blast-preloader',
+                         daemon=True).start()
+
+    def acquire(self, path: str) -> str:
+        """
+        Returns path of the copy in RAM of 'path' (a database in a version
+        directory), if loaded, and holds the copy until released, otherwise
+        'path' itself.
+        """
+        version_dir, name = os.path.split(path)
+        version = os.path.basename(version_dir)
+        with self._lock:
+            if version not in self._loaded:
+                return path
+            self._refs[version] = self._refs.get(version, 0) + 1
+            return os.path.join(self._loaded[version], name)
+
+    def release(self, path: str):
+        """
+        Releases copy held for 'path' (as returned by acquire), and removes
+        it if it is no longer used, nor active.
+        """
+        if os.path.dirname(os.path.dirname(path)) != self.ram_dir:
+            return
+        version = os.path.basename(os.path.dirname(path))
+        with self._lock:
+            if self._refs.get(version, 0) > 0:
+                self._refs[version] -= 1
+        self._remove_unused()
+
+    def status(self) -> dict:
+        with self._lock:
+            return {'dir': self.ram_dir, 'loaded': sorted(self._loaded),
+                    'loading': self._loading,
+                    'jobs': {v: n for v, n in self._refs.items() if n}}
+
+    def _run(self):
+        while True:
+            try:
+                self._check()
+            # Keep thread running, and retry later
+            # pylint: disable=broad-except
+            except Exception as ex:
+                logging.error('Preloading BLAST database failed: %s', ex)
+            time.sleep(self.interval)
+
+    def _check(self):
+        current = os.path.join(self.db_dir, 'current')
+        if not os.path.islink(current):
+            return
+        version_dir = os.path.realpath(current)
+        version = os.path.basename(version_dir)
+        with self._lock:
+            if version in self._loaded or version in self._failed:
+                return
+
+        size = dir_size(version_dir)
+        free = shutil.disk_usage(self.ram_dir).free
+        if size > free:
+            logging.warning('Not preloading BLAST database %s: needs %d MB, '
+                            'but only %d MB is free in %s', version,
+                            size // 2**20, free // 2**20, self.ram_dir)
+            self._failed.add(version)
+            return
+
+        with self._lock:
+            self._loading = version
+        start = time.time()
+        target = os.path.join(self.ram_dir, version)
+        tmp = f'{target}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        try:
+            shutil.copytree(version_dir, tmp, symlinks=True)
+            os.rename(tmp, target)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+            self._failed.add(version)
+            raise
+        finally:
+            with self._lock:
+                self._loading = None
+        logging.info('Preloaded BLAST database %s (%d MB) in %.1f s', version,
+                     size // 2**20, time.time() - start)
+
+        with self._lock:
+            self._loaded[version] = target
+            self._active = version
+        self._remove_unused()
+
+    def _remove_unused(self):
+        """
+        Removes copies of inactive versions that no job holds anymore.
+        """
+        with self._lock:
+            old = [v for v in self._loaded
+                   if v != self._active and not self._refs.get(v)]
+            for version in old:
+                del self._loaded[version]
+                self._refs.pop(version, None)
+        for version in old:
+            logging.info('Removing preloaded BLAST database %s', version)
+            path = os.path.join(self.ram_dir, version)
+            if self.on_remove:
+                self.on_remove(path)
+            shutil.rmtree(path, ignore_errors=True)
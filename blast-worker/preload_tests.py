@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Unit tests for preloading BLAST database versions into RAM (here, a
+temporary directory). Run from this directory:
+
+    python3 preload_tests.py
+"""
+
+import os
+import tempfile
+import unittest
+
+from preload import Preloader
+
+
+class PreloaderTest(unittest.TestCase):
+    """
+    Tests that copies of old versions are kept while jobs use them.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.db_dir = os.path.join(self.dir.name, 'blastdbs')
+        self.removed = []
+        self.preload = Preloader(self.db_dir,
+                                 os.path.join(self.dir.name, 'shm'),
+                                 on_remove=self.removed.append)
+        os.makedirs(self.preload.ram_dir)
+
+    def activate(self, version: str) -> str:
+        """
+        Builds and activates a (one file) database version, loads it, and
+        returns the path of the database.
+        """
+        version_dir = os.path.join(self.db_dir, 'versions', version)
+        os.makedirs(version_dir)
+        with open(os.path.join(version_dir, 'asvdb.nal'), 'w') as file:
+            file.write(version)
+        current = os.path.join(self.db_dir, 'current')
+        if os.path.islink(current):
+            os.remove(current)
+        os.symlink(os.path.join('versions', version), current)
+        self.preload._check()
+        return os.path.join(version_dir, 'asvdb')
+
+    def test_acquire(self):
+        """
+        Checks that loaded versions are searched in RAM, and others on disk.
+        """
+        path = self.activate('v1')
+        copy = self.preload.acquire(path)
+        self.assertEqual(copy, os.path.join(self.preload.ram_dir, 'v1',
+                                            'asvdb'))
+        self.assertTrue(os.path.exists(f'{copy}.nal'))
+        other = os.path.join(self.db_dir, 'versions', 'v0', 'asvdb')
+        self.assertEqual(self.preload.acquire(other), other)
+
+    def test_old_copy_kept_while_used(self):
+        """
+        Checks that the copy of an old version is removed only when the last
+        job using it has finished.
+        """
+        path = self.activate('v1')
+        v1 = self.preload.acquire(path)
+        v1_again = self.preload.acquire(path)
+        self.activate('v2')
+        self.activate('v3')
+        self.assertEqual(self.preload.status()['loaded'], ['v1', 'v3'])
+        self.preload.release(v1)
+        self.assertTrue(os.path.exists(f'{v1}.nal'))
+        self.preload.release(v1_again)
+        self.assertFalse(os.path.exists(f'{v1}.nal'))
+        self.assertEqual(self.preload.status()['loaded'], ['v3'])
+        self.assertEqual([os.path.basename(p) for p in self.removed],
+                         ['v2', 'v1'])
+
+
+if __name__ == "__main__":
+    unittest.main()
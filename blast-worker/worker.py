@@ -1,18 +1,35 @@
 #!/usr/bin/env python3
 """
-Simple web server that accepts requests to run blast jobs. The worker tries to
-keep track of the current number of jobs in case we would want to limit this in
-the future.
+Simple web server that accepts requests to run blast jobs. Jobs are queued,
+and run a limited number at a time (see jobs.py). Queries with many sequences
+are split into shards, run as concurrent blastn processes. Searches may be
+restricted to one or more genes, and database partitions (one per gene, see
+blast_builder.py) are then searched in parallel. The active version of the
+database is looked up for each request, so that new builds are used without
+restarting the worker, and may be preloaded into RAM (see preload.py).
+Subject sequences are added to results from the sequence indexes of the
+searched database volumes. Timings, sizes and errors are collected as
+metrics, exposed (for Prometheus) at /metrics.
+Jobs can either be run synchronously (POST /), or be submitted (POST /jobs),
+and then polled (GET /jobs/<job_id>) or cancelled (DELETE /jobs/<job_id>).
 """
 
 import json
 # import logging  # See FLASK_DEBUG overriding below
 import os
-import subprocess
+import threading
+import time
 from logging.config import dictConfig
 
 from flask import Flask, jsonify, request
 
+from blast_builder.seqindex import SequenceIndex
+from cache import ResultCache, db_version
+from jobs import CANCELLED, DONE, FAILED, JobQueue, QueueFull
+from metrics import (COUNT_BUCKETS, TIME_BUCKETS, Counter, Histogram,
+                     LatencyStats, gauge)
+from preload import Preloader
+
 #
 # Start server
 #
@@ -29,11 +46,104 @@ log_config["loggers"]["werkzeug"]["propagate"] = False
 dictConfig(log_config)
 
 APP = Flask(__name__)
-APP.jobs = 0
+
+# Number of blastn processes to run at once, threads used by each of these,
+# and number of jobs that may wait for a free process
+BLAST_THREADS = int(os.getenv('BLAST_THREADS') or 4)
+BLAST_WORKERS = int(os.getenv('BLAST_WORKERS')
+                    or max(1, (os.cpu_count() or 1) // BLAST_THREADS))
+BLAST_MAX_QUEUED = int(os.getenv('BLAST_MAX_QUEUED') or 20)
+# Max number of shards (concurrent blastn processes, sharing BLAST_THREADS)
+# per job, and min number of query sequences per shard
+BLAST_SHARDS = int(os.getenv('BLAST_SHARDS') or BLAST_THREADS)
+MIN_SHARD_SEQS = 10
+
+# Metrics, exposed at /metrics
+METRICS = {
+    'request': Histogram('blast_request_seconds',
+                         'Time from BLAST request (POST /) until the whole '
+                         'response has been sent', TIME_BUCKETS),
+    'queue': Histogram('blast_queue_seconds',
+                       'Time jobs wait for a free blastn process',
+                       TIME_BUCKETS),
+    'blastn': Histogram('blast_blastn_seconds',
+                        'Run time of blastn (all shards of a job)',
+                        TIME_BUCKETS),
+    'parse': Histogram('blast_parse_seconds',
+                       'Time to parse, sort and complete BLAST results',
+                       TIME_BUCKETS),
+    'serialize': Histogram('blast_serialize_seconds',
+                           'Time to encode results as JSON', TIME_BUCKETS),
+    'sequences': Histogram('blast_query_sequences',
+                           'Number of sequences per query', COUNT_BUCKETS),
+    'length': Histogram('blast_query_sequence_length',
+                        'Length of query sequences', COUNT_BUCKETS),
+    'rows': Histogram('blast_result_rows', 'Number of rows per result',
+                      COUNT_BUCKETS),
+    'errors': Counter('blast_errors_total',
+                      'Failed jobs, per blastn return code', 'returncode'),
+}
+
+
+# Run times of jobs on cold and warm databases, reported by /status
+APP.latency = LatencyStats()
+
+
+def record_job(job):
+    """
+    Releases the database copy (if any) held by a finished job, and records
+    queueing and run time, and errors, of a job that has been run.
+    """
+    if APP.preload and job.shards:
+        APP.preload.release(job_volumes(job)[0])
+    if job.started is None:
+        return
+    METRICS['queue'].observe(job.started - job.submitted)
+    METRICS['blastn'].observe(job.finished - job.started)
+    if job.state == DONE:
+        APP.latency.observe(job_volumes(job), job.started,
+                            job.finished - job.started)
+    if job.state == FAILED:
+        # No return code if blastn could not be started
+        METRICS['errors'].inc('none' if job.returncode is None
+                              else job.returncode)
+
+
+APP.jobs = JobQueue(BLAST_WORKERS, BLAST_MAX_QUEUED, on_finish=record_job,
+                    parse_line=lambda line: parse_blast_row(line))
+
+# Cache for results of synchronous BLAST requests (see main), limited to
+# BLAST_CACHE_MB megabytes, and optionally persisted in BLAST_CACHE_DIR.
+# Entries are kept for the active database version only
+APP.cache = ResultCache(int(os.getenv('BLAST_CACHE_MB') or 64) * 1024 * 1024,
+                        os.getenv('BLAST_CACHE_DIR') or None,
+                        lambda: active_version(os.getenv('BLAST_DB', 'asvdb')))
 
 # # See note on log_config vs FLASK_DEBUG setting in __init__.py
 # APP.logger.setLevel(logging.root.level)
 
+# Directory with BLAST databases (or database versions, see resolve_db)
+BLAST_DB_DIR = '/blastdbs'
+
+# Optional directory in RAM (e.g. a tmpfs), to keep a copy of the active
+# database version in
+APP.preload = None
+if os.getenv('BLAST_PRELOAD_DIR'):
+    APP.preload = Preloader(BLAST_DB_DIR, os.getenv('BLAST_PRELOAD_DIR'),
+                            on_remove=lambda path: forget_indexes(path))
+    APP.preload.start()
+
+# Sequence indexes (memory-mapped) of database volumes, per volume path
+INDEXES = {}
+INDEXES_LOCK = threading.Lock()
+
+# Fields in (tabular) BLAST output, and their types
+FIELD_NAMES = ['qacc', 'stitle', 'pident', 'qcovhsp', 'evalue']
+FIELD_TYPES = [str, str, float, float, float]
+
+# Number of result rows per chunk of streamed JSON responses
+JSON_CHUNK_ROWS = 1000
+
 
 def unlist(value):
     """
@@ -46,110 +156,458 @@ def unlist(value):
 @APP.route('/status')
 def status():
     """
-    Returns the current status of the worker
+    Returns the current status of the worker, where 'jobs' is the total number
+    of running and queued jobs, and 'latency' compares run times of jobs on
+    cold and warm databases.
     """
-    return jsonify(jobs=APP.jobs)
+    current = APP.jobs.status()
+    return jsonify(jobs=current['running'] + current['queued'],
+                   cache=APP.cache.status(),
+                   latency=APP.latency.status(),
+                   preload=APP.preload.status() if APP.preload else None,
+                   db_version=resolve_db(os.getenv('BLAST_DB', 'asvdb'))[1],
+                   **current)
 
 
-@APP.route('/', methods=['POST'])
-def main():
+@APP.route('/metrics')
+def metrics():
     """
-    Composes a BLAST command from a (DataTable) AJAX request, forwarded from
-    molmod endpoint /blast_run, and executes the command using subprocess.
+    Returns metrics in the Prometheus text format.
+    """
+    current = APP.jobs.status()
+    lines = []
+    for metric in METRICS.values():
+        lines += metric.expose()
+    lines += gauge('blast_jobs_running', 'Number of running jobs',
+                   current['running'])
+    lines += gauge('blast_jobs_queued', 'Number of queued jobs',
+                   current['queued'])
+    lines += gauge('blast_db_info', 'Version of the active BLAST database', 1,
+                   {'version': resolve_db(os.getenv('BLAST_DB', 'asvdb'))[1]})
+    return APP.response_class('\n'.join(lines) + '\n',
+                              mimetype='text/plain; version=0.0.4')
+
+
+def resolve_db(db: str) -> tuple:
+    """
+    Returns path and version of database 'db'. Versioned builds are used via
+    the 'current' symlink, which is resolved once per request, so that a job
+    keeps using the same version even if another one is activated meanwhile.
+    Unversioned databases get a version stamp based on their files. Jobs
+    search the copy in RAM instead, if the version has been preloaded (see
+    submit_job).
+    """
+    current = os.path.join(BLAST_DB_DIR, 'current')
+    if os.path.islink(current):
+        version_dir = os.path.realpath(current)
+        return os.path.join(version_dir, db), os.path.basename(version_dir)
+    path = os.path.join(BLAST_DB_DIR, db)
+    return path, db_version(path)
+
+
+def active_version(db: str) -> str:
+    """
+    Returns version of the active database 'db' (as in resolve_db).
+    """
+    current = os.path.join(BLAST_DB_DIR, 'current')
+    if os.path.islink(current):
+        return os.path.basename(os.path.realpath(current))
+    return db_version(os.path.join(BLAST_DB_DIR, db))
+
+
+def split_query(sequence: str, shards: int) -> list:
+    """
+    Splits FASTA text into (at most) 'shards' parts, with consecutive records
+    and about the same number of records in each. Records without a header
+    (accession) are named Query_<n>, by position in the whole query, as
+    blastn would (but per shard) name them.
+    """
+    records = []
+    for row in sequence.split('\n'):
+        if row.startswith('>') or not records:
+            records.append([])
+        records[-1].append(row)
+    # Leave out empty lines before first header
+    records = [r for r in records if r[0].startswith('>')
+               or ''.join(r).strip()]
+    for i, record in enumerate(records):
+        if not record[0].startswith('>'):
+            record.insert(0, f'>Query_{i + 1}')
+        elif not record[0][1:].strip():
+            record[0] = f'>Query_{i + 1}'
+    shards = max(1, min(shards, len(records)))
+    size, rest = divmod(len(records), shards)
+    parts, start = [], 0
+    for i in range(shards):
+        end = start + size + (1 if i < rest else 0)
+        parts.append('\n'.join('\n'.join(r) for r in records[start:end]))
+        start = end
+    return parts
+
+
+def load_partitions(db_path: str) -> dict:
+    """
+    Returns gene partitions of database, as listed by BLAST builder, or an
+    empty dict if database is not partitioned.
+    """
+    try:
+        with open(f'{db_path}.partitions.json') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def select_partitions(form: dict, db_path: str) -> list:
+    """
+    Returns partitions (dicts with database path and size) of database at
+    'db_path' to search, for genes given in form, or all partitions if no gene
+    is given. Raises ValueError for genes that are not in the database.
+    """
+    partitions = load_partitions(db_path)
+    genes = [g for g in form.get('gene', []) if g]
+    unknown = [g for g in genes if g not in partitions]
+    if unknown:
+        raise ValueError(f'No BLAST database for gene(s): {unknown}')
+    # A partition may consist of several volumes (base and delta volumes),
+    # passed on to blastn as a space-separated list
+    db_dir = os.path.dirname(db_path)
+    return [dict(part, path=' '.join(os.path.join(db_dir, volume) for volume
+                                     in part.get('volumes', [part['db']])))
+            for gene, part in partitions.items() if not genes or gene in genes]
+
+
+def query_order(job) -> dict:
+    """
+    Returns the position of each query (accession) in the input of a job.
     """
+    order = {}
+    for _, stdin in job.shards:
+        for row in stdin.decode().split('\n'):
+            if row.startswith('>'):
+                # All queries have an accession (see split_query)
+                order.setdefault(row[1:].split()[0], len(order))
+    return order
 
-    #
-    # Format the BLAST command - return an error if the input form is missing
-    # required values.
-    #
 
+def choose_shards(n_seqs: int) -> int:
+    """
+    Returns number of shards to split a query of 'n_seqs' sequences into,
+    limited by BLAST_SHARDS, MIN_SHARD_SEQS and the number of idle CPUs.
+    """
     try:
-        form = request.json
+        idle = (os.cpu_count() or 1) - os.getloadavg()[0]
+    except OSError:
+        idle = BLAST_SHARDS
+    return max(1, min(BLAST_SHARDS, n_seqs // MIN_SHARD_SEQS, int(idle)))
+
+
+def blast_command(form: dict, threads: int = BLAST_THREADS,
+                  db_path: str = None, dbsize: int = None) -> list:
+    """
+    Composes a BLAST command from a (DataTable) AJAX request, forwarded from
+    molmod endpoint /blast_run. If 'db_path' is given, that database (e.g.
+    a partition) is searched instead of the one in the form, and E-values are
+    calculated for an effective database size of 'dbsize' letters, if given.
+    Raises KeyError if the form is missing required values.
+    """
+    # Collect BLAST cmd items into list
+    cmd = ['blastn']
+    cmd += ['-perc_identity', unlist(form['min_identity'])]
+    # Query cover per High-Scoring Pair
+    cmd += ['-qcov_hsp_perc', unlist(form['min_qry_cover'])]
+    cmd += ['-db', db_path or resolve_db(form['db'])[0]]
+    if dbsize:
+        cmd += ['-dbsize', str(dbsize)]
+    cmd += ['-outfmt', f'6 {" ".join(FIELD_NAMES)}']
+    # Only report best High Scorting Pair per query/subject pair
+    cmd += ['-max_hsps', '1']
+    # No query can have more hits than the max number of result rows
+    if form.get('max_rows'):
+        cmd += ['-max_target_seqs', str(int(unlist(form['max_rows'])))]
+    cmd += ['-num_threads', str(threads)]
+    return cmd
+
 
-        field_names = ['qacc', 'stitle', 'pident', 'qcovhsp', 'evalue']
+def parse_blast_row(line: bytes) -> dict:
+    """
+    Formats a line of (tabular) BLAST output as a dict, to make it easier to
+    parse, with fields converted to their types. Used by the job queue, to
+    parse output as blastn produces it. Returns None for empty or incomplete
+    rows.
+    """
+    values = line.decode().rstrip('\n').split('\t')
+    if len(values) != len(FIELD_NAMES):
+        if line.strip():
+            # pylint: disable=no-member
+            APP.logger.error(f"Could not assign fields of {FIELD_NAMES}"
+                             f" for row: {line.decode().strip()}.")
+        return None
+    return dict(zip(FIELD_NAMES, (ftype(value) for ftype, value
+                                  in zip(FIELD_TYPES, values))))
+
+
+def json_chunks(results: list, truncated: bool):
+    """
+    Yields the JSON response body for results in chunks of JSON_CHUNK_ROWS
+    rows, so that the response can be streamed while it is being encoded.
+    """
+    yield '{"data": ['
+    for start in range(0, len(results), JSON_CHUNK_ROWS):
+        chunk = json.dumps(results[start:start + JSON_CHUNK_ROWS])[1:-1]
+        yield f', {chunk}' if start else chunk
+    yield f'], "truncated": {json.dumps(truncated)}}}'
 
-        # Collect BLAST cmd items into list
-        cmd = ['blastn']
-        cmd += ['-perc_identity', unlist(form['min_identity'])]
-        # Query cover per High-Scoring Pair
-        cmd += ['-qcov_hsp_perc', unlist(form['min_qry_cover'])]
-        cmd += ['-db', os.path.join('/blastdbs', form['db'])]
-        cmd += ['-outfmt', f'6 {" ".join(field_names)}']
-        # Only report best High Scorting Pair per query/subject pair
-        cmd += ['-max_hsps', '1']
-        cmd += ['-num_threads', '4']
 
+def submit_job(form: dict, db_path: str = None):
+    """
+    Formats BLAST commands from form, for query shards (per partition to
+    search, if database is partitioned), and submits them to the job queue.
+    The database at 'db_path' is used, or the active version of the one in
+    the form, or its copy in RAM, if preloaded. Returns the job, or an error
+    response if the form is missing required values, or the queue is full.
+    """
+    try:
+        query = "\n".join(form['sequence'])
+        db_path = db_path or resolve_db(form['db'])[0]
+        if APP.preload:
+            # Copy is held until the job has finished (see record_job)
+            db_path = APP.preload.acquire(db_path)
+        partitions = select_partitions(form, db_path) or [{'path': db_path}]
+        # Calculate E-values for the size of the whole database (all
+        # partitions), so that they do not depend on the genes searched
+        dbsize = sum(p['letters']
+                     for p in load_partitions(db_path).values()) or None
+        n_shards = max(1, choose_shards(query.count('>')) // len(partitions))
+        threads = max(1, BLAST_THREADS // (n_shards * len(partitions)))
+        shards = []
+        for partition in partitions:
+            cmd = blast_command(form, threads, partition['path'], dbsize)
+            shards += [(cmd, part.encode())
+                       for part in split_query(query, n_shards)]
     except KeyError as err:
+        release_db(db_path)
         # pylint: disable=no-member
         APP.logger.error(f'Command formatting resulted in: {err}')
-        return str(err), 500
+        return None, (str(err), 500)
+    except ValueError as err:
+        release_db(db_path)
+        # pylint: disable=no-member
+        APP.logger.warning(str(err))
+        return None, (str(err), 400)
+
+    try:
+        max_rows = form.get('max_rows')
+        job = APP.jobs.submit(shards,
+                              int(unlist(max_rows)) if max_rows else None)
+    except QueueFull as err:
+        release_db(db_path)
+        # pylint: disable=no-member
+        APP.logger.warning(str(err))
+        return None, (str(err), 429, {'Retry-After': str(err.retry_after)})
+
+    METRICS['sequences'].observe(query.count('>'))
+    for record in query.split('>')[1:]:
+        METRICS['length'].observe(len(''.join(
+            record.partition('\n')[2].split())))
+
+    # pylint: disable=no-member
+    APP.logger.debug(f'Submitted job {job.id} ({len(shards)} shards), '
+                     f'status is {APP.jobs.status()}')
+    return job, None
+
+
+def volume_index(path: str):
+    """
+    Returns sequence index of database volume at 'path', or None if the
+    volume has no index.
+    """
+    with INDEXES_LOCK:
+        if path not in INDEXES:
+            # Forget indexes of old database versions (closed when unused)
+            if len(INDEXES) > 100:
+                INDEXES.clear()
+            try:
+                INDEXES[path] = SequenceIndex(path)
+            except FileNotFoundError:
+                INDEXES[path] = None
+        return INDEXES[path]
+
+
+def forget_indexes(path: str):
+    """
+    Forgets (and so closes, when unused) sequence indexes of volumes in
+    directory 'path', e.g. of a database copy that is removed.
+    """
+    with INDEXES_LOCK:
+        for volume in [v for v in INDEXES if v.startswith(f'{path}/')]:
+            del INDEXES[volume]
+
+
+def release_db(db_path: str):
+    """
+    Releases database copy held for a job that was not submitted.
+    """
+    if APP.preload and db_path:
+        APP.preload.release(db_path)
+
+
+def job_volumes(job) -> list:
+    """
+    Returns paths of the database volumes that a job searches.
+    """
+    volumes = []
+    for cmd, _ in job.shards:
+        for volume in cmd[cmd.index('-db') + 1].split(' '):
+            if volume not in volumes:
+                volumes.append(volume)
+    return volumes
+
+
+def add_subject_sequences(job, results: list):
+    """
+    Adds subject sequences ('asv_sequence') to results, from the sequence
+    indexes of the database volumes that the job searched. Results are left
+    unchanged if volumes have no index (i.e. unpartitioned databases).
+    """
+    indexes = [i for i in map(volume_index, job_volumes(job))
+               if i is not None]
+    if not indexes:
+        return
+    for result in results:
+        # stitle = asv_id + '-' + taxonomy
+        asv_id = str(result.get('stitle', '')).split('-')[0]
+        for index in indexes:
+            sequence = index.get(asv_id)
+            if sequence is not None:
+                result['asv_sequence'] = sequence
+                break
 
-    #
-    # Execute BLAST search using subprocess.
-    #
 
-    APP.jobs += 1
-    APP.logger.debug(f'Job count is {APP.jobs}')
+def job_result(job, on_body=None):
+    """
+    Returns response for a finished job: results as (streamed) JSON if BLAST
+    succeeded, otherwise the error. Results are limited to the max number of
+    rows (if given), and 'truncated' tells if there were more. If given,
+    'on_body' is called with the complete response body, once streamed.
+    """
+    if job.state == DONE:
+        # pylint: disable=no-member
+        APP.logger.debug('BLAST success')
+        start = time.perf_counter()
+        results = job.rows
+        # Merge results of partitions, by query and E-value, as BLAST would
+        order = query_order(job)
+        results.sort(key=lambda r: (order.get(r.get('qacc'), len(order)),
+                                    r.get('evalue', 0)))
+        truncated = job.truncated
+        if job.max_lines is not None and len(results) > job.max_lines:
+            results = results[:job.max_lines]
+            truncated = True
+        add_subject_sequences(job, results)
+        METRICS['parse'].observe(time.perf_counter() - start)
+        METRICS['rows'].observe(len(results))
+
+        def stream():
+            # Time spent encoding, excluding time spent sending chunks
+            chunks, seconds = [], 0
+            start = time.perf_counter()
+            for chunk in json_chunks(results, truncated):
+                chunk = chunk.encode()
+                seconds += time.perf_counter() - start
+                if on_body:
+                    chunks.append(chunk)
+                yield chunk
+                start = time.perf_counter()
+            METRICS['serialize'].observe(seconds)
+            if on_body:
+                on_body(b''.join(chunks))
+
+        return APP.response_class(stream(), mimetype='application/json')
+
+    if job.state == CANCELLED:
+        return 'Job was cancelled', 409
+
+    # If BLAST returns error (even if subprocess worked),
+    # e.g. 2: Error in BLAST database
+    err = job.stderr.decode()
+    # pylint: disable=no-member
+    APP.logger.error("%s", err.strip())
+    return err, 500
+
 
+@APP.route('/', methods=['POST'])
+def main():
+    """
+    Runs a BLAST job for a (DataTable) AJAX request, forwarded from molmod
+    endpoint /blast_run, and waits for the results. Results are cached, per
+    query, search parameters and database version.
+    """
+    start = time.perf_counter()
+    form = request.json
     try:
-        with subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE) as process:
-            # Send seq from sform to stdin, read output & error until 'eof'
-            stdout, stderr = process.communicate(
-                input="\n".join(form['sequence']).encode()
-            )
-
-    # Make sure to catch everything so that workers can keep working
-    # pylint: disable=broad-except
-    except Exception as ex:
+        db_path, version = resolve_db(form['db'])
+        key = APP.cache.key(
+            "\n".join(form['sequence']),
+            {'min_identity': unlist(form['min_identity']),
+             'min_qry_cover': unlist(form['min_qry_cover']),
+             'db': form['db'],
+             'gene': sorted(g for g in form.get('gene', []) if g),
+             'max_rows': unlist(form.get('max_rows'))},
+            version)
+    except KeyError as err:
         # pylint: disable=no-member
-        APP.logger.error("Subprocess error: %s", ex)
-        return str(ex), 500
+        APP.logger.error(f'Command formatting resulted in: {err}')
+        return str(err), 500
 
-    else:
-        # If BLAST returns success response
-        if process.returncode == 0:
-            # pylint: disable=no-member
-            APP.logger.debug('BLAST success')
-
-            #
-            # Format results as JSON, to make it easier to parse.
-            #
-
-            raw = stdout.decode()
-            results = []
-            for row in raw.split('\n'):
-                row = row.strip()
-                if not row:
-                    continue
-                # Format as dictionary using list of field names,
-                # transforming numerical strings into numbers
-                result = {}
-                for i, field in enumerate(row.split("\t")):
-                    try:
-                        value = float(field)
-                    except ValueError:
-                        value = field
-                    try:
-                        result[field_names[i]] = value
-                    except Exception:
-                        APP.logger.error(
-                            f"Could not assign field {i} of {field_names}"
-                            f" for row: {row}."
-                        )
-                results += [result]
-
-            return jsonify(data=results)
-
-        # If BLAST returns error (even if subprocess worked),
-        # e.g. 2: Error in BLAST database
-        err = stderr.decode()
+    body = APP.cache.get(key, version)
+    if body is not None:
         # pylint: disable=no-member
-        APP.logger.error("%s", err.strip())
-        return err, 500
+        APP.logger.debug('Returning cached BLAST results')
+        METRICS['request'].observe(time.perf_counter() - start)
+        return APP.response_class(body, mimetype='application/json')
+
+    job, error = submit_job(form, db_path)
+    if error:
+        return error
+    job.wait()
+
+    def on_body(body):
+        APP.cache.put(key, version, body)
+        METRICS['request'].observe(time.perf_counter() - start)
+
+    return job_result(job, on_body)
+
+
+@APP.route('/jobs', methods=['POST'])
+def submit():
+    """
+    Submits a BLAST job, and returns its id, to be used for polling.
+    """
+    job, error = submit_job(request.json)
+    if error:
+        return error
+    return jsonify(job.as_dict()), 202
 
-    # Decrease job count, irrespective of success or failure
-    finally:
-        APP.jobs -= 1
-        APP.logger.debug(f'Final job count is {APP.jobs}')
+
+@APP.route('/jobs/<job_id>', methods=['GET'])
+def poll(job_id):
+    """
+    Returns the state of a job, including results if it has finished.
+    """
+    job = APP.jobs.get(job_id)
+    if job is None:
+        return 'No such job', 404
+    if not job.is_finished:
+        return jsonify(job.as_dict())
+    return job_result(job)
+
+
+@APP.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel(job_id):
+    """
+    Cancels a queued or running job.
+    """
+    job = APP.jobs.cancel(job_id)
+    if job is None:
+        return 'No such job', 404
+    return jsonify(job.as_dict())
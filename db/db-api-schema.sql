@@ -144,14 +144,16 @@ WHERE ta.status::text = 'valid'
 
 --
 -- Objects used in FILTER page
--- Views are materialized to increase search performance, and need to updated after
--- data import / db restore (see 'make status' / 'make stats' in Makefile)
+-- Views are materialized (or, for search results, kept in a table) to increase
+-- search performance, and need to updated after data import / db restore
+-- (see 'make status' / 'make stats' in Makefile)
 --
 
--- View for data displayed in the FILTER search result table,
--- also used by view for FILTER dropdown options (below)
-CREATE MATERIALIZED VIEW api.app_search_mixs_tax AS
-SELECT DISTINCT asv.asv_id,
+-- Per-dataset rows for the FILTER search result table (below), including
+-- datasets that are not (yet) in the Bioatlas
+CREATE OR REPLACE VIEW :data_schema.search_mixs_tax_rows AS
+SELECT DISTINCT se.dataset_pid,
+    asv.asv_id,
     concat_ws('|'::text, concat_ws(''::text, asv.asv_id, '-', ta.kingdom), ta.phylum, ta.class, ta.oorder, ta.family, ta.genus, ta.specific_epithet, ta.infraspecific_epithet, ta.otu) AS asv_tax,
     asv.asv_sequence,
     mixs.target_gene AS gene,
@@ -174,12 +176,198 @@ FROM :data_schema.mixs
     JOIN :data_schema.asv ON asv.pid = oc.asv_pid
     JOIN :data_schema.taxon_annotation ta ON asv.pid = ta.asv_pid
     JOIN :data_schema.sampling_event se ON oc.event_pid = se.pid
-    JOIN :data_schema.dataset ds ON se.dataset_pid = ds.pid
-WHERE ds.in_bioatlas
-    AND ta.status::text = 'valid'::text
+WHERE ta.status::text = 'valid'::text
     AND ta.target_prediction = TRUE
-    AND ta.annotation_target = mixs.target_gene
-ORDER BY asv.asv_id, asv.asv_sequence, mixs.target_gene, mixs.target_subfragment, (((mixs.pcr_primer_name_forward)::text || ': '::text) || (mixs.pcr_primer_forward)::text), (((mixs.pcr_primer_name_reverse)::text || ': '::text) || (mixs.pcr_primer_reverse)::text);
+    AND ta.annotation_target = mixs.target_gene;
+
+-- Table for data displayed in the FILTER search result table,
+-- also used by view for FILTER dropdown options (below).
+-- Unlike the other FILTER objects, this is a regular table that is updated
+-- per dataset (see functions below), so that adding or removing a single
+-- dataset from the Bioatlas does not require a full rebuild.
+-- In databases created before this was a table, drop the materialized view
+-- (and the FILTER dropdown views built from it, which are recreated below).
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_matviews
+               WHERE schemaname = 'api' AND matviewname = 'app_search_mixs_tax') THEN
+        DROP MATERIALIZED VIEW api.app_search_mixs_tax CASCADE;
+    END IF;
+END;
+$$;
+CREATE TABLE IF NOT EXISTS api.app_search_mixs_tax (
+    asv_id character(36) NOT NULL,
+    asv_tax text,
+    asv_sequence character varying,
+    gene character varying NOT NULL,
+    sub character varying NOT NULL,
+    fw_name text NOT NULL,
+    fw_sequence text NOT NULL,
+    rv_name text NOT NULL,
+    rv_sequence text NOT NULL,
+    fw_prim text,
+    rv_prim text,
+    kingdom character varying,
+    phylum character varying,
+    classs character varying,
+    oorder character varying,
+    family character varying,
+    genus character varying,
+    species character varying,
+    -- Number of included datasets that contain the row
+    n_datasets integer NOT NULL DEFAULT 1,
+    -- Surrogate key, making result order stable (see app_search_page)
+    row_id bigint GENERATED ALWAYS AS IDENTITY,
+    PRIMARY KEY (asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence)
+);
+CREATE UNIQUE INDEX IF NOT EXISTS search_row_id ON api.app_search_mixs_tax(row_id);
+-- Indexes for each order that FILTER results can be paged through in
+CREATE INDEX IF NOT EXISTS search_order_asv_tax ON api.app_search_mixs_tax((COALESCE(asv_tax, '')), row_id);
+CREATE INDEX IF NOT EXISTS search_order_gene ON api.app_search_mixs_tax((COALESCE(gene, '')), row_id);
+CREATE INDEX IF NOT EXISTS search_order_sub ON api.app_search_mixs_tax((COALESCE(sub, '')), row_id);
+CREATE INDEX IF NOT EXISTS search_order_fw_name ON api.app_search_mixs_tax((COALESCE(fw_name, '')), row_id);
+CREATE INDEX IF NOT EXISTS search_order_rv_name ON api.app_search_mixs_tax((COALESCE(rv_name, '')), row_id);
+-- Indexes for FILTER dropdown selections (column = ANY(...), as used by
+-- app_search_page and PostgREST 'in' filters), which the planner can
+-- combine (BitmapAnd) when selections are made in several dropdowns
+CREATE INDEX IF NOT EXISTS search_gene ON api.app_search_mixs_tax(gene);
+CREATE INDEX IF NOT EXISTS search_sub ON api.app_search_mixs_tax(sub);
+CREATE INDEX IF NOT EXISTS search_fw_prim ON api.app_search_mixs_tax(fw_prim);
+CREATE INDEX IF NOT EXISTS search_rv_prim ON api.app_search_mixs_tax(rv_prim);
+CREATE INDEX IF NOT EXISTS search_kingdom ON api.app_search_mixs_tax(kingdom);
+CREATE INDEX IF NOT EXISTS search_phylum ON api.app_search_mixs_tax(phylum);
+CREATE INDEX IF NOT EXISTS search_classs ON api.app_search_mixs_tax(classs);
+CREATE INDEX IF NOT EXISTS search_oorder ON api.app_search_mixs_tax(oorder);
+CREATE INDEX IF NOT EXISTS search_family ON api.app_search_mixs_tax(family);
+CREATE INDEX IF NOT EXISTS search_genus ON api.app_search_mixs_tax(genus);
+CREATE INDEX IF NOT EXISTS search_species ON api.app_search_mixs_tax(species);
+-- Extended statistics on correlated columns (e.g. a genus implies its family,
+-- and a primer its gene), so that the planner does not multiply selectivities
+-- of selections in several dropdowns, and underestimate the number of rows
+CREATE STATISTICS IF NOT EXISTS api.search_taxonomy_stats (ndistinct, dependencies, mcv)
+    ON kingdom, phylum, classs, oorder, family, genus, species
+    FROM api.app_search_mixs_tax;
+CREATE STATISTICS IF NOT EXISTS api.search_sequencing_stats (ndistinct, dependencies, mcv)
+    ON gene, sub, fw_prim, rv_prim
+    FROM api.app_search_mixs_tax;
+
+-- Datasets currently included in api.app_search_mixs_tax. Kept out of the
+-- api schema, as all its tables are readable through PostgREST.
+CREATE TABLE IF NOT EXISTS :data_schema.search_datasets (
+    dataset_pid integer PRIMARY KEY
+);
+
+-- Functions used by status_updater.py to add/remove rows for a single dataset
+-- (as it is added to/removed from the Bioatlas), or to rebuild the whole
+-- table (e.g. after db restore or reannotation). These are kept out of the
+-- api schema, as they should not be exposed through PostgREST.
+CREATE OR REPLACE FUNCTION :data_schema.search_add_dataset(ds_pid integer)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    nrows integer;
+BEGIN
+    -- Do nothing if dataset is already included
+    INSERT INTO search_datasets VALUES (ds_pid) ON CONFLICT DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN 0;
+    END IF;
+    -- Add new rows, or increase count of rows shared with other datasets.
+    -- An ASV may have several valid annotations for the same gene, so use one
+    -- row per key, as a row can only be inserted/updated once per statement
+    INSERT INTO api.app_search_mixs_tax AS s
+    SELECT DISTINCT ON (asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence)
+        asv_id, asv_tax, asv_sequence, gene, sub, fw_name, fw_sequence,
+        rv_name, rv_sequence, fw_prim, rv_prim, kingdom, phylum, classs,
+        oorder, family, genus, species, 1
+    FROM search_mixs_tax_rows
+    WHERE dataset_pid = ds_pid
+    ORDER BY asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence, asv_tax
+    ON CONFLICT (asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence)
+    DO UPDATE SET n_datasets = s.n_datasets + 1,
+        -- Keep taxonomy in line with current annotation
+        asv_tax = EXCLUDED.asv_tax, kingdom = EXCLUDED.kingdom,
+        phylum = EXCLUDED.phylum, classs = EXCLUDED.classs,
+        oorder = EXCLUDED.oorder, family = EXCLUDED.family,
+        genus = EXCLUDED.genus, species = EXCLUDED.species;
+    GET DIAGNOSTICS nrows = ROW_COUNT;
+    RETURN nrows;
+END;
+$$;
+COMMENT ON FUNCTION :data_schema.search_add_dataset(integer)
+    IS 'Example call: SELECT search_add_dataset(3);';
+
+CREATE OR REPLACE FUNCTION :data_schema.search_remove_dataset(ds_pid integer)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    nrows integer;
+BEGIN
+    -- Do nothing if dataset is not included
+    DELETE FROM search_datasets WHERE dataset_pid = ds_pid;
+    IF NOT FOUND THEN
+        RETURN 0;
+    END IF;
+    -- Remove rows that only this dataset contains...
+    DELETE FROM api.app_search_mixs_tax s
+    USING search_mixs_tax_rows r
+    WHERE r.dataset_pid = ds_pid AND s.n_datasets <= 1
+        AND (s.asv_id, s.gene, s.sub, s.fw_name, s.fw_sequence, s.rv_name, s.rv_sequence)
+          = (r.asv_id, r.gene, r.sub, r.fw_name, r.fw_sequence, r.rv_name, r.rv_sequence);
+    GET DIAGNOSTICS nrows = ROW_COUNT;
+    -- ... and decrease count of rows shared with other datasets
+    UPDATE api.app_search_mixs_tax s
+    SET n_datasets = s.n_datasets - 1
+    FROM search_mixs_tax_rows r
+    WHERE r.dataset_pid = ds_pid
+        AND (s.asv_id, s.gene, s.sub, s.fw_name, s.fw_sequence, s.rv_name, s.rv_sequence)
+          = (r.asv_id, r.gene, r.sub, r.fw_name, r.fw_sequence, r.rv_name, r.rv_sequence);
+    RETURN nrows;
+END;
+$$;
+COMMENT ON FUNCTION :data_schema.search_remove_dataset(integer)
+    IS 'Call BEFORE deleting dataset data. Example call: SELECT search_remove_dataset(3);';
+
+CREATE OR REPLACE FUNCTION :data_schema.search_rebuild()
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    nrows integer;
+BEGIN
+    -- Use DELETE rather than TRUNCATE, so that the table
+    -- can still be read (by the FILTER page) during rebuild
+    DELETE FROM api.app_search_mixs_tax;
+    DELETE FROM search_datasets;
+    INSERT INTO search_datasets
+    SELECT pid FROM dataset WHERE in_bioatlas;
+    -- One row per key, and dataset, as in search_add_dataset
+    INSERT INTO api.app_search_mixs_tax
+    SELECT DISTINCT ON (asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence)
+        asv_id, asv_tax, asv_sequence, gene, sub, fw_name, fw_sequence,
+        rv_name, rv_sequence, fw_prim, rv_prim, kingdom, phylum, classs,
+        oorder, family, genus, species,
+        count(*) OVER (PARTITION BY asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence)
+    FROM (
+        SELECT DISTINCT ON (dataset_pid, asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence) *
+        FROM search_mixs_tax_rows
+            JOIN search_datasets USING (dataset_pid)
+        ORDER BY dataset_pid, asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence, asv_tax
+    ) r
+    ORDER BY asv_id, gene, sub, fw_name, fw_sequence, rv_name, rv_sequence, asv_tax;
+    GET DIAGNOSTICS nrows = ROW_COUNT;
+    -- Update (extended) statistics right away, rather than when autovacuum
+    -- gets to it, as all rows have been replaced
+    ANALYZE api.app_search_mixs_tax;
+    RETURN nrows;
+END;
+$$;
+COMMENT ON FUNCTION :data_schema.search_rebuild()
+    IS 'Example call: SELECT search_rebuild();';
+
+SELECT :data_schema.search_rebuild();
 
 -- View for FILTER dropdown options (dynamically filtered in function, below)
 CREATE MATERIALIZED VIEW api.app_filter_mixs_tax AS
@@ -194,12 +382,51 @@ SELECT DISTINCT gene, sub,
     genus,
     species
 FROM api.app_search_mixs_tax;
+-- Unique indexes (here and below) let status_updater.py use
+-- REFRESH MATERIALIZED VIEW CONCURRENTLY, i.e. without blocking page reads
+CREATE UNIQUE INDEX IF NOT EXISTS filter_mixs_tax_uniq ON api.app_filter_mixs_tax(gene, sub, fw_prim, rv_prim, kingdom, phylum, classs, oorder, family, genus, species);
+
+-- Indexes for finding FILTER view rows by value of any dropdown field (gene
+-- is covered by the unique index), used to check that dropdown options
+-- co-occur with selections made in other dropdowns (see app_drop_options)
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_sub ON api.app_filter_mixs_tax(sub);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_fw_prim ON api.app_filter_mixs_tax(fw_prim);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_rv_prim ON api.app_filter_mixs_tax(rv_prim);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_kingdom ON api.app_filter_mixs_tax(kingdom);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_phylum ON api.app_filter_mixs_tax(phylum);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_classs ON api.app_filter_mixs_tax(classs);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_oorder ON api.app_filter_mixs_tax(oorder);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_family ON api.app_filter_mixs_tax(family);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_genus ON api.app_filter_mixs_tax(genus);
+CREATE INDEX IF NOT EXISTS filter_mixs_tax_species ON api.app_filter_mixs_tax(species);
+
+-- View of distinct (non-empty) values per FILTER dropdown field, i.e. all
+-- dropdown options, in which options are searched by (case-insensitive)
+-- prefix, and paged through in order of value (see app_drop_options)
+CREATE MATERIALIZED VIEW api.app_filter_options AS
+SELECT DISTINCT v.field, v.value
+FROM api.app_filter_mixs_tax f,
+    LATERAL (VALUES ('gene', f.gene), ('sub', f.sub),
+                    ('fw_prim', f.fw_prim), ('rv_prim', f.rv_prim),
+                    ('kingdom', f.kingdom), ('phylum', f.phylum),
+                    ('classs', f.classs), ('oorder', f.oorder),
+                    ('family', f.family), ('genus', f.genus),
+                    ('species', f.species)) AS v(field, value)
+WHERE v.value <> '';
+CREATE UNIQUE INDEX IF NOT EXISTS filter_options_uniq ON api.app_filter_options(field, value);
+CREATE INDEX IF NOT EXISTS filter_options_prefix ON api.app_filter_options(field, lower(value) text_pattern_ops);
 
--- Function executed as the user clicks a FILTER dropdown, getting data from
--- a materialized view (above), and dynamically modifying the query based on
+-- Function executed as the user clicks (types in, or scrolls) a FILTER
+-- dropdown, getting options from a materialized view (above), and
+-- dynamically modifying the query based on
 -- 1) which dropdown sent the request,
--- 2) what the user typed in the dropdown, if anything, and
+-- 2) what the user typed in the dropdown, if anything (matched as a
+--    case-insensitive prefix of options),
 -- 3) which selections have previously been made in other dropdowns, if any
+--    (options must then co-occur with selections in app_filter_mixs_tax), and
+-- 4) where the page starts, i.e. after option 'after_value' (keyset pagination),
+--    if known, and otherwise after 'noffset' options.
+-- Options are not counted, but 'more' tells if there is another page.
 CREATE OR REPLACE FUNCTION api.app_drop_options(
     field text,
     noffset bigint,
@@ -215,58 +442,194 @@ CREATE OR REPLACE FUNCTION api.app_drop_options(
     gene text[] DEFAULT '{}',
     sub text[] DEFAULT '{}',
     fw_prim text[] DEFAULT '{}',
-    rv_prim text[] DEFAULT '{}')
+    rv_prim text[] DEFAULT '{}',
+    after_value text DEFAULT NULL)
 RETURNS TABLE(data json)
-LANGUAGE plpgsql
+LANGUAGE plpgsql STABLE
 AS $$
+DECLARE
+    filters text := '';
+    conditions text := '';
 BEGIN
-    -- Execute dynamically, i.e. modify the query based on 1) which dropdown sent
-    -- the request, 2) what the user typed, if anything, and 3) which
-    -- selections have previously been made in other dropdowns, if any
+    IF field NOT IN ('gene', 'sub', 'fw_prim', 'rv_prim', 'kingdom', 'phylum',
+                     'classs', 'oorder', 'family', 'genus', 'species') THEN
+        RAISE EXCEPTION 'No FILTER dropdown named %', field;
+    END IF;
+
+    IF kingdom <> '{}' THEN filters := filters || format(' AND f.kingdom = ANY(%L)', kingdom); END IF;
+    IF phylum <> '{}' THEN filters := filters || format(' AND f.phylum = ANY(%L)', phylum); END IF;
+    IF classs <> '{}' THEN filters := filters || format(' AND f.classs = ANY(%L)', classs); END IF;
+    IF oorder <> '{}' THEN filters := filters || format(' AND f.oorder = ANY(%L)', oorder); END IF;
+    IF family <> '{}' THEN filters := filters || format(' AND f.family = ANY(%L)', family); END IF;
+    IF genus <> '{}' THEN filters := filters || format(' AND f.genus = ANY(%L)', genus); END IF;
+    IF species <> '{}' THEN filters := filters || format(' AND f.species = ANY(%L)', species); END IF;
+    IF gene <> '{}' THEN filters := filters || format(' AND f.gene = ANY(%L)', gene); END IF;
+    IF sub <> '{}' THEN filters := filters || format(' AND f.sub = ANY(%L)', sub); END IF;
+    IF fw_prim <> '{}' THEN filters := filters || format(' AND f.fw_prim = ANY(%L)', fw_prim); END IF;
+    IF rv_prim <> '{}' THEN filters := filters || format(' AND f.rv_prim = ANY(%L)', rv_prim); END IF;
+
+    IF filters <> '' THEN
+        -- Semi-join via filter_mixs_tax_<field> index
+        conditions := conditions || format(
+            ' AND EXISTS (SELECT 1 FROM api.app_filter_mixs_tax f WHERE f.%I = o.value%s)',
+            field, filters);
+    END IF;
+    IF term <> '' THEN
+        -- Escape LIKE wildcards, so that term is only matched as a prefix
+        conditions := conditions || format(
+            ' AND lower(o.value) LIKE %L',
+            replace(replace(replace(lower(term), '\', '\\'), '%', '\%'), '_', '\_') || '%');
+    END IF;
+    IF after_value IS NOT NULL THEN
+        conditions := conditions || format(' AND o.value > %L', after_value);
+        noffset := 0;
+    END IF;
+
     RETURN QUERY EXECUTE format(
-        '-- Put filtered options in temp table
-		WITH filtered AS (
-		 	SELECT DISTINCT %I AS id
-         	FROM api.app_filter_mixs_tax
-         	WHERE %I <> '''' AND %I IS NOT NULL
-         	AND ($1 = ''{}'' OR kingdom = ANY($1))
-         	AND ($2 = ''{}'' OR phylum = ANY($2))
-         	AND ($3 = ''{}'' OR classs = ANY($3))
-         	AND ($4 = ''{}'' OR oorder = ANY($4))
-         	AND ($5 = ''{}'' OR family = ANY($5))
-         	AND ($6 = ''{}'' OR genus = ANY($6))
-         	AND ($7 = ''{}'' OR species = ANY($7))
-            -- Make case-insensitive comparison with user-provided term
-         	AND %I ~* $8
-         	AND ($9 = ''{}'' OR gene = ANY($9))
-         	AND ($10 = ''{}'' OR sub = ANY($10))
-         	AND ($11 = ''{}'' OR fw_prim = ANY($11))
-         	AND ($12 = ''{}'' OR rv_prim = ANY($12))
-         	ORDER BY %I
-         	OFFSET $13
+        'WITH page AS (
+            SELECT o.value AS id
+            FROM api.app_filter_options o
+            WHERE o.field = %L%s
+            ORDER BY o.value
+            OFFSET %s
             -- Fetch one extra record to check if more results exist for pagination
-         	LIMIT $14 + 1)
-		-- Format & paginate according to select2 requirements
-		SELECT json_build_object(
-            ''count'', (SELECT COUNT(*) FROM filtered),
-            ''results'', COALESCE(json_agg(json_build_object(''id'', f.id, ''text'', f.id)),''[]'')
-		-- Format dynamic field NAME
-		) FROM filtered f', field, field, field, field, field, field)
-	-- Set dynamic field VALUES
-    USING kingdom, phylum, classs, oorder, family, genus, species, '^'||term||'.*$',
-	gene, sub, fw_prim, rv_prim, noffset, nlimit;
+            LIMIT %s)
+        -- Format according to select2 requirements
+        SELECT json_build_object(
+            ''more'', (SELECT count(*) FROM page) > %s,
+            ''results'', COALESCE((
+                SELECT json_agg(json_build_object(''id'', p.id, ''text'', p.id))
+                FROM (SELECT id FROM page ORDER BY id LIMIT %s) p), ''[]''))',
+        field, conditions, noffset, nlimit + 1, nlimit, nlimit);
 END;
 $$;
-COMMENT ON FUNCTION api.app_drop_options(text, bigint, integer, text, text[], text[], text[], text[], text[], text[], text[], text[], text[], text[], text[])
+COMMENT ON FUNCTION api.app_drop_options(text, bigint, integer, text, text[], text[], text[], text[], text[], text[], text[], text[], text[], text[], text[], text)
     IS 'Example call 1 (view in Properties | General to get quotes right):
 SELECT api.app_drop_options(''classs'', 0, 25, ''T'', ''{}'', ''{Actinobacteriota, Bacteroidota}'');
 
 Example call 2 (view in Properties | General to get quotes right):
 -- Payload sent to /rpc/app_drop_options: {"kingdom": ["Bacteria"], "phylum": ["Planctomycetes"], "field": "classs", "term": "", "nlimit": 25, "noffset": 0}
 SELECT api.app_drop_options(''classs'', 0, 25, '''', ''{Bacteria}'',''{Planctomycetes}'');
+
+Example call 3, for the page after option ''Gammaproteobacteria'':
+SELECT api.app_drop_options(''classs'', 0, 25, '''', ''{Bacteria}'', after_value => ''Gammaproteobacteria'');
 ';
 
 
+-- Function returning a page of FILTER search results (see filter_routes.py),
+-- for selections made in dropdowns and an optional search term (matching
+-- taxonomy or ASV ID), ordered by 'order_col' and row_id. Pages that follow
+-- an already seen page start after the last row of that page (after_value,
+-- after_id), i.e. use keyset pagination, and other pages use an offset. If
+-- 'with_count', the number of rows matching selections and search term
+-- (count), and selections only (total), are included, counted up to
+-- 'max_count', above which the query planner's estimate is used instead, as
+-- exact counts of large result sets take too long.
+CREATE OR REPLACE FUNCTION api.app_search_page(
+    order_col text DEFAULT 'asv_tax',
+    descending boolean DEFAULT FALSE,
+    after_value text DEFAULT NULL,
+    after_id bigint DEFAULT NULL,
+    noffset bigint DEFAULT 0,
+    nlimit integer DEFAULT 25,
+    term text DEFAULT '',
+    with_count boolean DEFAULT FALSE,
+    max_count integer DEFAULT 100000,
+    kingdom text[] DEFAULT '{}',
+    phylum text[] DEFAULT '{}',
+    classs text[] DEFAULT '{}',
+    oorder text[] DEFAULT '{}',
+    family text[] DEFAULT '{}',
+    genus text[] DEFAULT '{}',
+    species text[] DEFAULT '{}',
+    gene text[] DEFAULT '{}',
+    sub text[] DEFAULT '{}',
+    fw_prim text[] DEFAULT '{}',
+    rv_prim text[] DEFAULT '{}')
+RETURNS TABLE(data json)
+LANGUAGE plpgsql STABLE
+AS $$
+DECLARE
+    filters text := 'TRUE';
+    sort_key text;
+    dir text := CASE WHEN descending THEN 'DESC' ELSE 'ASC' END;
+    -- Conditions to count rows for (selections, and selections and term)
+    conditions text[];
+    condition text;
+    counts bigint[] := '{}';
+    n bigint;
+    plan json;
+    results json;
+BEGIN
+    IF order_col NOT IN ('asv_tax', 'gene', 'sub', 'fw_name', 'rv_name') THEN
+        RAISE EXCEPTION 'FILTER results can not be ordered by %', order_col;
+    END IF;
+    -- Same expression as in search_order_* indexes
+    sort_key := format('COALESCE(%I, '''')', order_col);
+
+    IF kingdom <> '{}' THEN filters := filters || format(' AND kingdom = ANY(%L)', kingdom); END IF;
+    IF phylum <> '{}' THEN filters := filters || format(' AND phylum = ANY(%L)', phylum); END IF;
+    IF classs <> '{}' THEN filters := filters || format(' AND classs = ANY(%L)', classs); END IF;
+    IF oorder <> '{}' THEN filters := filters || format(' AND oorder = ANY(%L)', oorder); END IF;
+    IF family <> '{}' THEN filters := filters || format(' AND family = ANY(%L)', family); END IF;
+    IF genus <> '{}' THEN filters := filters || format(' AND genus = ANY(%L)', genus); END IF;
+    IF species <> '{}' THEN filters := filters || format(' AND species = ANY(%L)', species); END IF;
+    IF gene <> '{}' THEN filters := filters || format(' AND gene = ANY(%L)', gene); END IF;
+    IF sub <> '{}' THEN filters := filters || format(' AND sub = ANY(%L)', sub); END IF;
+    IF fw_prim <> '{}' THEN filters := filters || format(' AND fw_prim = ANY(%L)', fw_prim); END IF;
+    IF rv_prim <> '{}' THEN filters := filters || format(' AND rv_prim = ANY(%L)', rv_prim); END IF;
+
+    conditions := ARRAY[filters];
+
+    IF term <> '' THEN
+        filters := filters || format(' AND (asv_tax ILIKE %L OR asv_id ILIKE %L)',
+                                     '%' || term || '%', '%' || term || '%');
+        conditions := conditions || filters;
+    END IF;
+
+    IF with_count THEN
+        FOREACH condition IN ARRAY conditions LOOP
+            EXECUTE format('SELECT count(*) FROM (
+                                SELECT 1 FROM api.app_search_mixs_tax WHERE %s LIMIT %s) s',
+                           condition, max_count + 1)
+            INTO n;
+            IF n > max_count THEN
+                EXECUTE format('EXPLAIN (FORMAT JSON) SELECT 1 FROM api.app_search_mixs_tax WHERE %s',
+                               condition)
+                INTO plan;
+                n := GREATEST(n, (plan->0->'Plan'->>'Plan Rows')::numeric::bigint);
+            END IF;
+            counts := counts || n;
+        END LOOP;
+    END IF;
+
+    -- Start after last row of previous page, if given
+    IF after_id IS NOT NULL THEN
+        filters := filters || format(' AND (%s, row_id) %s (%L, %s)', sort_key,
+                                     CASE WHEN descending THEN '<' ELSE '>' END,
+                                     COALESCE(after_value, ''), after_id);
+    END IF;
+
+    EXECUTE format(
+        'SELECT COALESCE(json_agg(r), ''[]'') FROM (
+            SELECT * FROM api.app_search_mixs_tax
+            WHERE %s
+            ORDER BY %s %s, row_id %s
+            OFFSET %s LIMIT %s) r',
+        filters, sort_key, dir, dir, noffset, nlimit)
+    INTO results;
+
+    RETURN QUERY SELECT json_build_object(
+        'count', counts[array_length(counts, 1)], 'total', counts[1],
+        'estimated', COALESCE(counts[1] > max_count, FALSE),
+        'results', results);
+END;
+$$;
+COMMENT ON FUNCTION api.app_search_page(text, boolean, text, bigint, bigint, integer, text, boolean, integer, text[], text[], text[], text[], text[], text[], text[], text[], text[], text[], text[])
+    IS 'Example call (view in Properties | General to get quotes right):
+SELECT api.app_search_page(''asv_tax'', FALSE, NULL, NULL, 0, 25, '''', TRUE, 100000, ''{Bacteria}'');
+';
+
 --
 -- Objects used in BLAST page
 --
@@ -278,11 +641,13 @@ SELECT api.app_drop_options(''classs'', 0, 25, '''', ''{Bacteria}'',''{Planctomy
 -- 1) we may need to send more ASV IDs than we can fit into an URL to filter a GET request, and
 -- 2) PostgREST does not allow POST requests for SELECT operations on views
 -- Materialized (see above), and updated with 'make blastdb'
+-- The BLAST database is partitioned on (target) gene, i.e. one volume per gene
 CREATE MATERIALIZED VIEW IF NOT EXISTS api.app_asvs_for_blastdb AS
-SELECT DISTINCT asv_id, higher_taxonomy, asv_sequence
+SELECT DISTINCT asv_id, higher_taxonomy, asv_sequence, gene
     FROM (SELECT asv.asv_id,
             concat_ws(';'::text, ta.kingdom, ta.phylum, ta.class, ta.oorder, ta.family, ta.genus, ta.specific_epithet, ta.infraspecific_epithet, ta.otu) AS higher_taxonomy,
-            asv.asv_sequence
+            asv.asv_sequence,
+            mixs.target_gene AS gene
         FROM :data_schema.asv
             JOIN :data_schema.taxon_annotation ta ON asv.pid = ta.asv_pid
             JOIN :data_schema.occurrence oc ON oc.asv_pid = asv.pid
@@ -293,53 +658,207 @@ SELECT DISTINCT asv_id, higher_taxonomy, asv_sequence
             AND ta.annotation_target::text = mixs.target_gene::text
             AND ta.status::text = 'valid'::text AND ta.target_prediction = TRUE) rd;
 CREATE INDEX IF NOT EXISTS blast_asv ON api.app_asvs_for_blastdb(asv_id);
+-- Unique index (the sequence is given by asv_id), so that the BLAST builder
+-- can refresh the view concurrently, without blocking BLAST searches
+CREATE UNIQUE INDEX IF NOT EXISTS blast_uniq ON api.app_asvs_for_blastdb(asv_id, gene, higher_taxonomy);
+CREATE INDEX IF NOT EXISTS blast_gene ON api.app_asvs_for_blastdb(gene);
+
+-- Genes (BLAST database partitions), used for search form options, and for
+-- E-values of exact matches (with partition sizes, as in the BLAST builder)
+CREATE VIEW api.app_blastdb_genes AS
+SELECT gene, count(*) AS sequences, sum(length(asv_sequence)) AS letters
+    FROM api.app_asvs_for_blastdb
+    GROUP BY gene
+    ORDER BY gene;
 
 CREATE FUNCTION api.app_seq_from_id(ids character varying[])
     RETURNS TABLE(asv_id CHARACTER(36), ASV_SEQUENCE CHARACTER VARYING)
     LANGUAGE sql IMMUTABLE
     AS $$
-    SELECT asv_id, asv_sequence FROM api.app_asvs_for_blastdb
+    SELECT DISTINCT asv_id, asv_sequence FROM api.app_asvs_for_blastdb
     WHERE asv_id = ANY(ids)
 $$;
 COMMENT ON FUNCTION api.app_seq_from_id(character varying[])
     IS 'Example call (view in Properties | General to get quotes right):
 SELECT api.app_seq_from_id(''{ASV:40b37890b1b1fcdf0ece91f1da34c1ca}'')';
 
+-- Functions used for exact-match BLAST searches (100% identity and coverage),
+-- where ASVs are looked up via ID (ASV: + md5 of query sequence) instead.
+-- If genes are given, only ASVs in those partitions are included. ASVs are
+-- returned once per partition (gene), as BLAST reports a hit per partition
+CREATE FUNCTION api.app_asvs_from_id(ids character varying[], genes character varying[] DEFAULT NULL)
+    RETURNS TABLE(asv_id CHARACTER(36), higher_taxonomy TEXT, asv_sequence CHARACTER VARYING, gene CHARACTER VARYING)
+    LANGUAGE sql STABLE
+    AS $$
+    SELECT DISTINCT asv_id, higher_taxonomy, asv_sequence, gene FROM api.app_asvs_for_blastdb
+    WHERE asv_id = ANY(ids)
+        AND (genes IS NULL OR gene = ANY(genes))
+$$;
+COMMENT ON FUNCTION api.app_asvs_from_id(character varying[], character varying[])
+    IS 'Example call (view in Properties | General to get quotes right):
+SELECT api.app_asvs_from_id(''{ASV:40b37890b1b1fcdf0ece91f1da34c1ca}'')';
+
+-- Stats for the About page are kept as per-dataset partials (sets of distinct
+-- ASVs, taxa etc. per gene), merged into value sets with dataset counts, from
+-- which the number of distinct values per gene is maintained. Adding or removing
+-- a dataset thus only requires work proportional to the size of that dataset.
+-- Updated with 'make status' (per dataset) / 'make stats' (rebuild all)
+
+-- Distinct values per dataset, gene and kind of value
+-- (kind = 'dataset', 'asv', 'kingdom', 'phylum', ... , 'species')
+CREATE TABLE IF NOT EXISTS :data_schema.about_stats_partial (
+    dataset_pid integer NOT NULL,
+    gene character varying NOT NULL,
+    kind character varying NOT NULL,
+    vals text[] NOT NULL,
+    PRIMARY KEY (dataset_pid, gene, kind)
+);
+
+-- Merged partials, with number of (included) datasets containing each value
+CREATE TABLE IF NOT EXISTS :data_schema.about_stats_value (
+    gene character varying NOT NULL,
+    kind character varying NOT NULL,
+    value text NOT NULL,
+    n_datasets integer NOT NULL DEFAULT 1,
+    PRIMARY KEY (gene, kind, value)
+);
+-- Lets about_remove_dataset find values no longer used, without a full scan
+CREATE INDEX IF NOT EXISTS about_stats_unused
+    ON :data_schema.about_stats_value(n_datasets) WHERE n_datasets < 1;
+
+-- Number of distinct values per gene and kind
+CREATE TABLE IF NOT EXISTS :data_schema.about_stats_count (
+    gene character varying NOT NULL,
+    kind character varying NOT NULL,
+    n integer NOT NULL,
+    PRIMARY KEY (gene, kind)
+);
+
+CREATE OR REPLACE FUNCTION :data_schema.about_add_dataset(ds_pid integer)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    nrows integer;
+BEGIN
+    -- Do nothing if dataset is already included
+    IF EXISTS (SELECT 1 FROM about_stats_partial WHERE dataset_pid = ds_pid) THEN
+        RETURN 0;
+    END IF;
+    -- Store sets of distinct values for dataset
+    -- Note that 'species' includes genus, and that kingdoms may be blank
+    INSERT INTO about_stats_partial (dataset_pid, gene, kind, vals)
+    SELECT ds_pid, r.gene, v.kind, array_agg(DISTINCT v.value)
+    FROM search_mixs_tax_rows r,
+        LATERAL (VALUES ('dataset', ds_pid::text), ('asv', r.asv_id::text),
+            ('kingdom', r.kingdom), ('phylum', r.phylum), ('class', r.classs),
+            ('order', r.oorder), ('family', r.family), ('genus', r.genus),
+            ('species', r.genus || r.species)) AS v(kind, value)
+    WHERE r.dataset_pid = ds_pid
+        AND (v.kind = 'kingdom' OR v.value <> '')
+    GROUP BY r.gene, v.kind;
+    GET DIAGNOSTICS nrows = ROW_COUNT;
+    -- Merge into value sets, and count values that are new to a gene
+    WITH merged AS (
+        INSERT INTO about_stats_value AS v (gene, kind, value)
+        SELECT gene, kind, unnest(vals)
+        FROM about_stats_partial
+        WHERE dataset_pid = ds_pid
+        ON CONFLICT (gene, kind, value)
+        DO UPDATE SET n_datasets = v.n_datasets + 1
+        RETURNING v.gene, v.kind, v.n_datasets)
+    INSERT INTO about_stats_count AS c (gene, kind, n)
+    SELECT gene, kind, count(*)
+    FROM merged
+    WHERE n_datasets = 1
+    GROUP BY gene, kind
+    ON CONFLICT (gene, kind) DO UPDATE SET n = c.n + EXCLUDED.n;
+    RETURN nrows;
+END;
+$$;
+COMMENT ON FUNCTION :data_schema.about_add_dataset(integer)
+    IS 'Example call: SELECT about_add_dataset(3);';
+
+CREATE OR REPLACE FUNCTION :data_schema.about_remove_dataset(ds_pid integer)
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    nrows integer;
+BEGIN
+    SELECT count(*) INTO nrows FROM about_stats_partial WHERE dataset_pid = ds_pid;
+    -- Do nothing if dataset is not included
+    IF nrows = 0 THEN
+        RETURN 0;
+    END IF;
+    -- Remove stored sets for dataset from value sets,
+    -- and count values that are no longer used for a gene
+    WITH removed AS (
+        DELETE FROM about_stats_partial
+        WHERE dataset_pid = ds_pid
+        RETURNING gene, kind, vals),
+    updated AS (
+        UPDATE about_stats_value v
+        SET n_datasets = v.n_datasets - 1
+        FROM (SELECT gene, kind, unnest(vals) AS value FROM removed) r
+        WHERE (v.gene, v.kind, v.value) = (r.gene, r.kind, r.value)
+        RETURNING v.gene, v.kind, v.n_datasets)
+    UPDATE about_stats_count c
+    SET n = c.n - u.n
+    FROM (SELECT gene, kind, count(*) AS n
+          FROM updated
+          WHERE n_datasets < 1
+          GROUP BY gene, kind) u
+    WHERE (c.gene, c.kind) = (u.gene, u.kind);
+    DELETE FROM about_stats_value WHERE n_datasets < 1;
+    DELETE FROM about_stats_count WHERE n < 1;
+    RETURN nrows;
+END;
+$$;
+COMMENT ON FUNCTION :data_schema.about_remove_dataset(integer)
+    IS 'Example call: SELECT about_remove_dataset(3);';
+
+CREATE OR REPLACE FUNCTION :data_schema.about_rebuild()
+RETURNS integer
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    nrows integer := 0;
+    ds_pid integer;
+BEGIN
+    DELETE FROM about_stats_partial;
+    DELETE FROM about_stats_value;
+    DELETE FROM about_stats_count;
+    FOR ds_pid IN SELECT pid FROM dataset WHERE in_bioatlas LOOP
+        nrows := nrows + about_add_dataset(ds_pid);
+    END LOOP;
+    RETURN nrows;
+END;
+$$;
+COMMENT ON FUNCTION :data_schema.about_rebuild()
+    IS 'Example call: SELECT about_rebuild();';
+
 -- View used for populating stats table in About page
--- Materialized (see above), and updated with 'make status' / 'make stats'
-CREATE MATERIALIZED VIEW api.app_about_stats AS
-SELECT sub.gene,
-   string_agg(DISTINCT sub.kingdom::text, ', '::text) AS kingdoms,
-   count(DISTINCT sub.dataset) AS datasets,
-   count(DISTINCT CASE WHEN sub.phylum <> '' then sub.phylum end) AS phyla,
-   count(DISTINCT CASE WHEN sub.classs <> '' then sub.classs end) AS classes,
-   count(DISTINCT CASE WHEN sub.oorder <> '' then sub.oorder end)AS orders,
-   count(DISTINCT CASE WHEN sub.family <> '' then sub.family end) AS families,
-   count(DISTINCT CASE WHEN sub.genus <> '' then sub.genus end) AS genera,
-   count(DISTINCT CASE WHEN sub.species <> '' then sub.species end) AS species,
-   count(DISTINCT sub.asv_id) AS asvs
-  FROM ( SELECT ds.pid as dataset,
-           asv.asv_id,
-           mixs.target_gene AS gene,
-           ta.kingdom,
-           ta.phylum,
-           ta.class AS classs,
-           ta.oorder,
-           ta.family,
-           ta.genus,
-           ta.genus::text || ta.specific_epithet::text AS species
-          FROM mixs
-            JOIN :data_schema.occurrence oc ON oc.event_pid = mixs.pid
-            JOIN :data_schema.asv ON asv.pid = oc.asv_pid
-            JOIN :data_schema.taxon_annotation ta ON asv.pid = ta.asv_pid
-            JOIN :data_schema.sampling_event se ON oc.event_pid = se.pid
-            JOIN :data_schema.dataset ds ON se.dataset_pid = ds.pid
-            WHERE ds.in_bioatlas and ta.status::text = 'valid'::text
-               AND ta.target_prediction = TRUE
-               AND ta.annotation_target = mixs.target_gene) sub
- GROUP BY sub.gene
- ORDER BY sub.gene
-WITH DATA;
+CREATE OR REPLACE VIEW api.app_about_stats AS
+SELECT c.gene,
+   k.kingdoms,
+   max(c.n) FILTER (WHERE c.kind = 'dataset') AS datasets,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'phylum'), 0) AS phyla,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'class'), 0) AS classes,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'order'), 0) AS orders,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'family'), 0) AS families,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'genus'), 0) AS genera,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'species'), 0) AS species,
+   coalesce(max(c.n) FILTER (WHERE c.kind = 'asv'), 0) AS asvs
+  FROM :data_schema.about_stats_count c
+    LEFT JOIN (SELECT gene, string_agg(value, ', ' ORDER BY value) AS kingdoms
+               FROM :data_schema.about_stats_value
+               WHERE kind = 'kingdom'
+               GROUP BY gene) k ON k.gene = c.gene
+ GROUP BY c.gene, k.kingdoms
+ ORDER BY c.gene;
+
+SELECT :data_schema.about_rebuild();
 
 -- View used for populating dataset table in Download data page
 -- Materialized (see above), and updated with 'make status' / 'make stats'
@@ -360,6 +879,7 @@ AS
   WHERE ds.in_bioatlas = true AND ds.pid = se.dataset_pid AND se.pid = mixs.pid
   ORDER BY mixs.target_gene, ds.dataset_name
 WITH DATA;
+CREATE UNIQUE INDEX IF NOT EXISTS dataset_list_uniq ON api.app_dataset_list(dataset_id, dataset_name, ipt_resource_id, target_gene, target_subfragment, pcr_primer_name_forward, pcr_primer_name_reverse, institution_code);
 
 
 --
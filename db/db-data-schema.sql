@@ -126,3 +126,4 @@ CREATE INDEX IF NOT EXISTS taxon_asv ON public.taxon_annotation(asv_pid);
 CREATE INDEX IF NOT EXISTS mixs_id ON public.mixs(pid);
 CREATE INDEX IF NOT EXISTS occurrence_event ON public.occurrence(event_pid);
 CREATE INDEX IF NOT EXISTS occurrence_asv ON public.occurrence(asv_pid);
+CREATE INDEX IF NOT EXISTS event_dataset ON public.sampling_event(dataset_pid);
@@ -4,8 +4,6 @@ import json
 import os
 from functools import wraps
 
-import logging
-import requests
 from logging.config import dictConfig
 from flask import Flask, render_template, request
 from flask_cas import CAS, login_required
@@ -13,21 +11,32 @@ from flask_mail import Mail
 from flask_wtf.csrf import CSRFProtect
 
 from config import get_config
+from health import HealthCheck
+from response_cache import ResponseCache
+from upstream import Upstream
 import errors
 
 CONFIG = get_config()
 
+# Clients (with connection pools, see upstream.py) for PostgREST (API), and
+# BLAST workers (any replica, see blast_pool.py). Jobs are not retried by
+# the client, as the worker pool retries them on other replicas.
+POSTGREST = Upstream(CONFIG.POSTGREST, CONFIG.POSTGREST_POOL_SIZE,
+                     (CONFIG.CONNECT_TIMEOUT, CONFIG.POSTGREST_READ_TIMEOUT))
+BLAST_WORKERS = Upstream('', CONFIG.BLAST_POOL_SIZE,
+                         (CONFIG.CONNECT_TIMEOUT, CONFIG.BLAST_READ_TIMEOUT),
+                         retries=0)
+
+# Cache for API responses that only change with data (see response_cache.py)
+RESPONSE_CACHE = ResponseCache(shared_dir=CONFIG.RESPONSE_CACHE_DIR)
+
+# CAS server status, probed in the background (see health.py)
+# Simulate Service Unavailable with url "https://httpbin.org/status/503"
+CAS_HEALTH = HealthCheck('CAS', CONFIG.CAS_SERVER)
+
 
 def cas_server_available():
-    url = CONFIG.CAS_SERVER
-    # Simulate Service Unavailable
-    # url = "https://httpbin.org/status/503"
-    response = requests.get(url)
-    if response.status_code == 200:
-        return True
-    else:
-        logging.error(f"CAS server not working: {response.status_code}")
-        return False
+    return CAS_HEALTH.available()
 
 
 def custom_login_required(route_function):
@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Client for a pool of blast-worker replicas. Replicas are discovered by
+resolving the configured worker hosts (with Docker Compose, a scaled service
+name resolves to the addresses of all its containers), and their '/status' is
+polled in a background thread. Each job is sent to the least loaded healthy
+replica, and if a replica fails (can't be connected to, or responds with a
+gateway error), it is taken out of rotation for a while, and the job is
+retried on the next replica.
+"""
+
+import logging
+import os
+import random
+import socket
+import threading
+import time
+
+import requests
+
+from upstream import Upstream
+
+
+class WorkerPool:
+    """
+    Keeps track of blast-worker replicas for 'hosts', given as 'host:port'.
+    Status is polled every 'interval' seconds, and failing replicas are left
+    out for 'backoff' seconds. Requests are sent with 'client' (see
+    upstream.py), which should not retry them itself.
+    """
+
+    # Responses that make us try another replica. Not 500, which the worker
+    # also returns for errors caused by the request (e.g. an invalid query),
+    # that would fail on any replica
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, hosts: list, interval: float = 5, backoff: float = 30,
+                 timeout: float = 2, client: Upstream = None):
+        self.hosts = hosts
+        self.client = client or Upstream(retries=0)
+        self.interval = interval
+        self.backoff = backoff
+        self.timeout = timeout
+        # url -> {'jobs': reported jobs, 'active': jobs sent from this
+        # process and not yet returned, 'down_until': time}
+        self._workers = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        """
+        Starts background polling, unless already started in this process.
+        Called on first use, so that each uWSGI process (forked after app
+        creation) gets its own poller.
+        """
+        with self._lock:
+            if self._thread and self._thread.is_alive() \
+                    and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._poll_loop,
+                                            daemon=True)
+            self._thread.start()
+        self.refresh()
+
+    def discover(self) -> list:
+        """
+        Returns worker URLs for all addresses that configured hosts resolve
+        to. Hosts that can't be resolved are used as they are.
+        """
+        urls = []
+        for host in self.hosts:
+            name, _, port = host.rpartition(':')
+            if not name:
+                name, port = port, '5000'
+            try:
+                infos = socket.getaddrinfo(name, int(port),
+                                           type=socket.SOCK_STREAM)
+                addresses = sorted({info[4][0] for info in infos})
+            except (socket.gaierror, ValueError) as ex:
+                logging.warning('Could not resolve BLAST worker %s: %s',
+                                host, ex)
+                addresses = [name]
+            for address in addresses:
+                if ':' in address:
+                    address = f'[{address}]'  # IPv6
+                urls.append(f'http://{address}:{port}')
+        return urls
+
+    def refresh(self):
+        """
+        Rediscovers replicas, and updates their status.
+        """
+        urls = self.discover()
+        with self._lock:
+            for url in urls:
+                self._workers.setdefault(url, {'jobs': 0, 'active': 0,
+                                               'down_until': 0})
+            for url in set(self._workers) - set(urls):
+                del self._workers[url]
+
+        for url in urls:
+            try:
+                response = self.client.get(f'{url}/status',
+                                           timeout=self.timeout)
+                response.raise_for_status()
+                jobs = response.json()['jobs']
+            except Exception as ex:
+                self.mark_down(url, f'status request failed: {ex}')
+                continue
+            with self._lock:
+                if url in self._workers:
+                    # Failing workers come back when their time is up
+                    self._workers[url]['jobs'] = jobs
+
+    def _poll_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.refresh()
+            except Exception as ex:
+                logging.error('BLAST worker poll failed: %s', ex)
+
+    def mark_down(self, url: str, reason: str):
+        """
+        Takes worker out of rotation for a while.
+        """
+        with self._lock:
+            if url not in self._workers:
+                return
+            if self._workers[url]['down_until'] <= time.time():
+                logging.warning('BLAST worker %s out of rotation (%s)', url,
+                                reason)
+            self._workers[url]['down_until'] = time.time() + self.backoff
+
+    def candidates(self) -> list:
+        """
+        Returns worker URLs in the order they should be tried: healthy
+        replicas, least loaded first (ties in random order, so that processes
+        don't all pick the same one), followed by replicas out of rotation,
+        as a last resort.
+        """
+        now = time.time()
+        with self._lock:
+            workers = list(self._workers.items())
+        random.shuffle(workers)
+        healthy = [(w['jobs'] + w['active'], url) for url, w in workers
+                   if w['down_until'] <= now]
+        down = [(w['down_until'], url) for url, w in workers
+                if w['down_until'] > now]
+        return [url for _, url in sorted(healthy, key=lambda x: x[0])] + \
+               [url for _, url in sorted(down, key=lambda x: x[0])]
+
+    def post(self, path: str = '/', **kwargs) -> requests.Response:
+        """
+        Posts request to least loaded worker, and retries on the others if
+        that fails. Returns the last response (e.g. 429, if all workers are
+        busy), or raises the last error, if no worker could be reached. Other
+        error responses (e.g. 500) are returned as they are, and other errors
+        (e.g. a read timeout, for a job that the worker is still running) are
+        raised without trying other workers.
+        """
+        self.start()
+        response, error = None, None
+        for url in self.candidates():
+            with self._lock:
+                if url in self._workers:
+                    self._workers[url]['active'] += 1
+            try:
+                response = self.client.post(
+                    f'{url}{path}',
+                    timeout=(self.timeout, self.client.timeout[1]), **kwargs)
+            except requests.ConnectionError as ex:
+                # Including ConnectTimeout
+                error = ex
+                self.mark_down(url, str(ex))
+                continue
+            finally:
+                with self._lock:
+                    if url in self._workers:
+                        self._workers[url]['active'] -= 1
+
+            if response.status_code in self.RETRY_STATUS:
+                self.mark_down(url, f'status {response.status_code}')
+            elif response.status_code == 429:
+                # Busy, but healthy
+                with self._lock:
+                    if url in self._workers:
+                        self._workers[url]['jobs'] += 1
+            else:
+                return response
+
+        if response is not None:
+            return response
+        raise error or requests.ConnectionError('No BLAST workers found')
+
+    def status(self) -> dict:
+        """
+        Returns known workers, with load and health.
+        """
+        now = time.time()
+        with self._lock:
+            return {url: {'jobs': w['jobs'], 'active': w['active'],
+                          'healthy': w['down_until'] <= now}
+                    for url, w in self._workers.items()}
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Unit tests for the BLAST worker pool client. Runs a few local stand-in
+workers, which answer '/status' and job requests like blast-worker does, so
+no docker environment is needed.
+"""
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+#pylint: disable=import-error
+from blast_pool import WorkerPool
+from upstream import Upstream
+
+
+class StandInWorker(ThreadingHTTPServer):
+    """
+    Local HTTP server with a configurable number of jobs, and job response
+    status and delay (s). Counts job requests in 'posts'.
+    """
+
+    def __init__(self, jobs: int = 0, status: int = 200):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.jobs = jobs
+        self.status = status
+        self.delay = 0
+        self.posts = 0
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def host(self) -> str:
+        return f'127.0.0.1:{self.server_address[1]}'
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.respond(200, {'jobs': self.server.jobs})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.posts += 1
+        time.sleep(self.server.delay)
+        self.respond(self.server.status, {'data': [], 'truncated': False})
+
+    def respond(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class WorkerPoolTest(unittest.TestCase):
+    """
+    Tests that jobs are routed to the least loaded healthy worker.
+    """
+
+    def setUp(self):
+        self.workers = [StandInWorker(jobs) for jobs in (3, 0, 5)]
+        self.pool = WorkerPool([w.host for w in self.workers], interval=60,
+                               backoff=60, timeout=1)
+
+    def tearDown(self):
+        for worker in self.workers:
+            if worker.socket.fileno() != -1:
+                worker.stop()
+
+    def test_least_loaded(self):
+        """
+        Checks that jobs go to the worker reporting the fewest jobs.
+        """
+        response = self.pool.post('/', json={'sequence': ['>q\nACGT']})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([w.posts for w in self.workers], [0, 1, 0])
+
+        # Load changes are picked up on refresh
+        self.workers[1].jobs = 10
+        self.pool.refresh()
+        self.pool.post('/', json={})
+        self.assertEqual([w.posts for w in self.workers], [1, 1, 0])
+
+    def test_retry_on_error(self):
+        """
+        Checks that a failing worker is skipped, and taken out of rotation.
+        """
+        self.workers[1].status = 503
+        self.pool.start()
+        response = self.pool.post('/', json={})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([w.posts for w in self.workers], [1, 1, 0])
+
+        # Worker 1 is no longer tried, although it reports the fewest jobs
+        self.pool.post('/', json={})
+        self.assertEqual([w.posts for w in self.workers], [2, 1, 0])
+        self.assertFalse(self.pool.status()[f'http://{self.workers[1].host}']
+                         ['healthy'])
+
+    def test_request_error(self):
+        """
+        Checks that a 500 response (e.g. for an invalid query) is returned
+        without trying other workers, or taking the worker out of rotation.
+        """
+        for worker in self.workers:
+            worker.status = 500
+        self.pool.start()
+        response = self.pool.post('/', json={})
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual([w.posts for w in self.workers], [0, 1, 0])
+        self.assertTrue(all(w['healthy'] for w in self.pool.status().values()))
+
+    def test_read_timeout(self):
+        """
+        Checks that a read timeout (of a job that the worker is still
+        running) is raised without trying other workers, or taking the
+        worker out of rotation.
+        """
+        pool = WorkerPool([w.host for w in self.workers], interval=60,
+                          backoff=60, timeout=1,
+                          client=Upstream(retries=0, timeout=(1, 0.2)))
+        self.workers[1].delay = 1
+        pool.start()
+        with self.assertRaises(requests.ReadTimeout):
+            pool.post('/', json={})
+        self.assertEqual([w.posts for w in self.workers], [0, 1, 0])
+        self.assertTrue(all(w['healthy'] for w in pool.status().values()))
+
+    def test_unreachable_worker(self):
+        """
+        Checks that jobs are retried when a worker can't be reached.
+        """
+        self.pool.start()
+        self.workers[1].stop()
+        response = self.pool.post('/', json={})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.workers[0].posts, 1)
+
+    def test_all_busy(self):
+        """
+        Checks that a 429 response is returned if all workers are busy.
+        """
+        for worker in self.workers:
+            worker.status = 429
+        response = self.pool.post('/', json={})
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual([w.posts for w in self.workers], [1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
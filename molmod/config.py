@@ -71,6 +71,22 @@ class Config:
     MAINTENANCE_ROUTES = get_env_variable('MAINTENANCE_ROUTES')
     POSTGREST = get_env_variable('POSTGREST_HOST')
     BLAST_DB = get_env_variable('BLAST_DB')
+    # Optional, as older .env files don't have it
+    BLAST_WORKER_HOSTS = (os.getenv('BLAST_WORKER_HOSTS')
+                          or 'blast-worker:5000').split()
+    # Connections kept alive per process, and timeouts (s, 0 = no limit),
+    # for requests to PostgREST and BLAST workers (see upstream.py)
+    POSTGREST_POOL_SIZE = int(os.getenv('POSTGREST_POOL_SIZE') or 10)
+    BLAST_POOL_SIZE = int(os.getenv('BLAST_POOL_SIZE') or 4)
+    CONNECT_TIMEOUT = float(os.getenv('CONNECT_TIMEOUT') or 3) or None
+    POSTGREST_READ_TIMEOUT = float(os.getenv('POSTGREST_READ_TIMEOUT')
+                                   or 120) or None
+    BLAST_READ_TIMEOUT = float(os.getenv('BLAST_READ_TIMEOUT') or 900) or None
+    # Optional directory for API response cache, shared by all processes
+    # (see response_cache.py)
+    RESPONSE_CACHE_DIR = os.getenv('RESPONSE_CACHE_DIR') or None
+    # Numbers of FILTER results above which counts are estimated
+    FILTER_MAX_COUNT = int(os.getenv('FILTER_MAX_COUNT') or 100000)
 
     SBDI_START_PAGE = get_env_variable('SBDI_START_PAGE')
     SBDI_CONTACT_PAGE = get_env_variable('SBDI_CONTACT_PAGE')
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Index of exported dataset archives (<dataset_id>.zip), kept as a manifest
+(manifest.json) in the export directory, and updated by the exporter when it
+finishes an archive. The app reads the manifest instead of checking each
+archive file, and only reloads it when it has been modified.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime as dt
+
+EXPORT_DIR = '/app/data-volumes/exports'
+MANIFEST_NAME = 'manifest.json'
+
+
+def archive_entry(path: str) -> dict:
+    """
+    Returns manifest entry (size, mtime, checksum and export time) for
+    archive at 'path'.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(block)
+    stat = os.stat(path)
+    return {'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'sha256': sha256.hexdigest(),
+            'exported': dt.now().isoformat(timespec='seconds')}
+
+
+def read_manifest(export_dir: str = EXPORT_DIR) -> dict:
+    """
+    Returns manifest, as a dict of entries per dataset_id, or an empty dict
+    if there is no manifest.
+    """
+    try:
+        with open(os.path.join(export_dir, MANIFEST_NAME)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+
+def write_manifest(manifest: dict, export_dir: str = EXPORT_DIR):
+    """
+    Replaces manifest (atomically, so that the app never reads a partial
+    manifest).
+    """
+    path = os.path.join(export_dir, MANIFEST_NAME)
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+@contextmanager
+def manifest_lock(export_dir: str = EXPORT_DIR):
+    """
+    Holds an exclusive lock on the manifest (shared by all processes), so
+    that concurrent exports do not drop each other's entries.
+    """
+    with open(os.path.join(export_dir, f'{MANIFEST_NAME}.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def add_archive(dataset_id: str, export_dir: str = EXPORT_DIR) -> dict:
+    """
+    Adds (or updates) the entry of an exported archive in the manifest, and
+    returns the entry. If there is no manifest yet, it is built from all
+    archives in the export directory, so that it also lists archives
+    exported earlier.
+    """
+    with manifest_lock(export_dir):
+        if not os.path.exists(os.path.join(export_dir, MANIFEST_NAME)):
+            return _rebuild_manifest(export_dir)[dataset_id]
+        entry = archive_entry(os.path.join(export_dir, f'{dataset_id}.zip'))
+        manifest = read_manifest(export_dir)
+        manifest[dataset_id] = entry
+        write_manifest(manifest, export_dir)
+        return entry
+
+
+def rebuild_manifest(export_dir: str = EXPORT_DIR) -> dict:
+    """
+    Rebuilds manifest from the archives in the export directory (e.g. for
+    archives exported before the manifest existed, or removed since), keeping
+    export times of unchanged archives. Returns the new manifest.
+    """
+    with manifest_lock(export_dir):
+        return _rebuild_manifest(export_dir)
+
+
+def _rebuild_manifest(export_dir: str) -> dict:
+    old = read_manifest(export_dir)
+    manifest = {}
+    for name in sorted(os.listdir(export_dir)):
+        if not name.endswith('.zip'):
+            continue
+        dataset_id = name[:-len('.zip')]
+        entry = archive_entry(os.path.join(export_dir, name))
+        previous = old.get(dataset_id)
+        if previous and previous.get('sha256') == entry['sha256']:
+            entry['exported'] = previous['exported']
+        manifest[dataset_id] = entry
+    write_manifest(manifest, export_dir)
+    return manifest
+
+
+class ExportManifest:
+    """
+    Manifest of 'export_dir', as read by the app: re-read only if the file
+    has changed, so that each use costs a single stat call.
+    """
+
+    def __init__(self, export_dir: str = EXPORT_DIR):
+        self.path = os.path.join(export_dir, MANIFEST_NAME)
+        self._manifest, self._mtime = {}, None
+        self._lock = threading.Lock()
+
+    def get(self) -> dict:
+        """
+        Returns manifest, or None if there is no manifest yet.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.path) as file:
+                        self._manifest = json.load(file)
+                    self._mtime = mtime
+                except (OSError, ValueError):
+                    pass
+            return self._manifest
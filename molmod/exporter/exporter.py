@@ -4,7 +4,8 @@ This script is executed inside a running asv-main container, using the
 export_data.py wrapper. Depending on arguments added to the wrapper,
 the exporter either reads data from event-core-like DwC views and produces
 condensed dataset archives, or exports fasta files to be used in taxonomic
-reannotation.
+reannotation. Exported archives are listed in a manifest (see
+export_manifest.py), used by the Download page.
 """
 
 from datetime import datetime as dt
@@ -18,6 +19,7 @@ import psycopg2
 from psycopg2.extras import DictCursor
 import requests
 from bs4 import BeautifulSoup
+from export_manifest import add_archive, rebuild_manifest
 
 
 def connect_db(pass_file: str = '/run/secrets/postgres_pass'):
@@ -221,6 +223,9 @@ def export_datasets(pids: str):
                     cursor.copy_expert(cp, tsv)
             shutil.make_archive(dir, 'zip', dir)
             shutil.rmtree(dir)
+            entry = add_archive(dataset_id)
+            logging.info("Added %s to manifest (%d bytes)", dataset_id,
+                         entry['size'])
 
             elapsed_time = time.time() - start_time
             logging.info("Time required: %.2f seconds", elapsed_time)
@@ -274,6 +279,9 @@ if __name__ == '__main__':
                         help="Target gene for filtering of ASVs in"
                              "fasta export. Use to return all ASVs derived "
                              "from a specific target gene.")
+    PARSER.add_argument('--manifest', action='store_true',
+                        help="Rebuild manifest of exported archives from "
+                             "the archives in the export directory.")
     PARSER.add_argument('-v', '--verbose', action="count", default=0,
                         help="Increase logging verbosity (default: warning).")
     PARSER.add_argument('-q', '--quiet', action="count", default=3,
@@ -286,8 +294,11 @@ if __name__ == '__main__':
     # E.g: -vv means log level = 10(3-2) = 10 = DEBUG
     # E.g: -qqvv means log level = 10(5-2) = 30 = WARNING
     logging.basicConfig(level=(10*(ARGS.quiet - ARGS.verbose)))
+    if ARGS.manifest:
+        logging.info("Rebuilt manifest of %d archives",
+                     len(rebuild_manifest()))
     # If a reference database is given, just export a fasta file
-    if ARGS.ref or ARGS.target:
+    elif ARGS.ref or ARGS.target:
         create_output_fasta(ARGS.ref, ARGS.target)
     else:
         export_datasets(ARGS.ds)
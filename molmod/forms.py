@@ -123,6 +123,8 @@ class BlastSearchForm(FlaskForm):
                              default=DEFAULT_BLAST_GENE)
     min_identity = IntegerField(u'min_identity', [identity_check], default=100)
     min_qry_cover = IntegerField(u'min_qry_cover', [cover_check], default=100)
+    # Optional restriction to (BLAST database partitions of) selected genes
+    gene = SelectMultipleField(u'gene', choices=[])
     blast_for_seq = SubmitField(u'BLAST')
 
 
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+"""
+Health checks of upstream services (e.g. the CAS server), run in the
+background, so that requests only need to read a cached flag. The state of
+each check is kept in a small file, shared by all (uWSGI) processes of the
+app, and only one process at a time runs the probe (see 'probe_due').
+
+Each check works as a circuit breaker: after 'threshold' failed probes in a
+row, the circuit opens, and the service is reported as unavailable. While
+open, the service is probed less often ('reset_after' seconds apart), and the
+circuit closes again at the first successful probe. If no recent state
+exists (e.g. right after startup, or if probing has stopped), the service is
+assumed to be available.
+"""
+
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import requests
+
+# Circuit states
+CLOSED = 'closed'
+OPEN = 'open'
+
+
+class HealthCheck:
+    """
+    Probes 'url' every 'interval' seconds, with a 'timeout' (s) for each
+    request. States older than 'ttl' seconds are ignored.
+    """
+
+    def __init__(self, name: str, url: str, interval: float = 30,
+                 timeout: float = 3, ttl: float = 120, threshold: int = 2,
+                 reset_after: float = 60, state_dir: str = None):
+        self.name = name
+        self.url = url
+        self.interval = interval
+        self.timeout = timeout
+        self.ttl = ttl
+        self.threshold = threshold
+        self.reset_after = reset_after
+        state_dir = state_dir or tempfile.gettempdir()
+        self.state_file = os.path.join(state_dir, f'molmod_health_{name}.json')
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        # Last state read, and modification time of file when read
+        self._state, self._mtime = None, None
+
+    def start(self):
+        """
+        Starts background probing, unless already started in this process
+        (each uWSGI process is forked after app creation, and needs its own
+        thread).
+        """
+        with self._lock:
+            if self._thread and self._thread.is_alive() \
+                    and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name=f'health-{self.name}')
+            self._thread.start()
+
+    def available(self) -> bool:
+        """
+        Returns False if the circuit is open, i.e. the service has failed
+        recently, otherwise True.
+        """
+        self.start()
+        state = self.read_state()
+        if state is None or time.time() - state['checked'] > self.ttl:
+            return True
+        return state['circuit'] != OPEN
+
+    def read_state(self) -> dict:
+        """
+        Returns the shared state (re-read only if file has changed), or None
+        if there is none.
+        """
+        try:
+            mtime = os.stat(self.state_file).st_mtime_ns
+            if mtime != self._mtime:
+                with open(self.state_file) as file:
+                    self._state, self._mtime = json.load(file), mtime
+        except (OSError, ValueError):
+            return None
+        return self._state
+
+    def write_state(self, state: dict):
+        tmp = f'{self.state_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as file:
+            json.dump(state, file)
+        os.replace(tmp, self.state_file)
+
+    def probe_due(self, state: dict) -> bool:
+        if state is None:
+            return True
+        wait = self.reset_after if state['circuit'] == OPEN else self.interval
+        return time.time() - state['checked'] >= wait
+
+    def probe(self):
+        """
+        Probes the service (unless another process just did), and updates
+        the shared state.
+        """
+        with open(f'{self.state_file}.lock', 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is probing
+                return
+            state = self.read_state()
+            if not self.probe_due(state):
+                return
+
+            try:
+                response = requests.get(self.url, timeout=self.timeout)
+                error = None if response.status_code == 200 \
+                    else f'status {response.status_code}'
+            except requests.RequestException as ex:
+                error = str(ex)
+
+            failures = 0 if state is None else state['failures']
+            circuit = CLOSED if state is None else state['circuit']
+            if error is None:
+                if circuit == OPEN:
+                    logging.info('%s server is working again', self.name)
+                failures, circuit = 0, CLOSED
+            else:
+                failures += 1
+                if failures >= self.threshold:
+                    if circuit != OPEN:
+                        logging.error('%s server not working: %s', self.name,
+                                      error)
+                    circuit = OPEN
+            self.write_state({'circuit': circuit, 'failures': failures,
+                              'error': error, 'checked': time.time()})
+
+    def _run(self):
+        while True:
+            try:
+                self.probe()
+            # Keep probing, even if e.g. state file can't be written
+            # pylint: disable=broad-except
+            except Exception as ex:
+                logging.error('Health check of %s failed: %s', self.name, ex)
+            time.sleep(min(self.interval, self.reset_after) / 2)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Query plan tests for FILTER searches, checking that typical combinations of
+dropdown selections are looked up via indexes on api.app_search_mixs_tax,
+rather than by a sequential scan of the whole table. Note that these tests
+are intended to run inside the docker environment, against the live database
+(which is not modified), and are skipped if the search table is empty.
+"""
+
+import json
+import unittest
+
+#pylint: disable=import-error
+from importer import connect_db
+
+# Typical FILTER selections, as combinations of dropdown fields
+SELECTIONS = [
+    ['kingdom'],
+    ['phylum'],
+    ['kingdom', 'phylum'],
+    ['classs'],
+    ['oorder'],
+    ['family'],
+    ['genus'],
+    ['genus', 'species'],
+    ['gene'],
+    ['gene', 'sub'],
+    ['fw_prim', 'rv_prim'],
+    ['gene', 'kingdom', 'phylum'],
+]
+
+# Tables smaller than this are always scanned sequentially, as that is then
+# cheaper, so sequential scans are disabled to check that indexes are usable
+SMALL_TABLE = 100000
+
+
+def plan_nodes(plan: dict) -> list:
+    """
+    Returns all nodes in (JSON) query plan.
+    """
+    nodes = [plan]
+    for child in plan.get('Plans', []):
+        nodes += plan_nodes(child)
+    return nodes
+
+
+class SearchPlanTest(unittest.TestCase):
+    """
+    Tests that FILTER selections use indexes.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.connection, cls.cursor = connect_db()
+        cls.cursor.execute("SELECT count(*) FROM api.app_search_mixs_tax;")
+        cls.rows = cls.cursor.fetchone()[0]
+        if cls.rows < SMALL_TABLE:
+            cls.cursor.execute("SET enable_seqscan = off;")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.connection.rollback()
+        cls.connection.close()
+
+    def selection(self, fields: list) -> dict:
+        """
+        Returns a selection of one (existing, and rather uncommon) value per
+        field, such as a user would make in the dropdowns.
+        """
+        columns = ', '.join(fields)
+        self.cursor.execute(
+            f"SELECT {columns} FROM api.app_search_mixs_tax "
+            f"WHERE {' AND '.join(f'{f} IS NOT NULL' for f in fields)} "
+            f"GROUP BY {columns} ORDER BY count(*), {columns} LIMIT 1;")
+        row = self.cursor.fetchone()
+        return None if row is None else dict(zip(fields, row))
+
+    def plan(self, selection: dict) -> dict:
+        """
+        Returns query plan of FILTER search for selection, with conditions
+        written as in app_search_page (and PostgREST 'in' filters).
+        """
+        conditions = ' AND '.join(f'{f} = ANY(%({f})s)' for f in selection)
+        self.cursor.execute(
+            "EXPLAIN (FORMAT JSON) SELECT * FROM api.app_search_mixs_tax "
+            f"WHERE {conditions};",
+            {f: [v] for f, v in selection.items()})
+        plan = self.cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return plan[0]['Plan']
+
+    def test_selections_use_index(self):
+        """
+        Checks that typical selections are looked up via an index on (one
+        of) the selected columns, without sequential scans.
+        """
+        if not self.rows:
+            self.skipTest("FILTER search table is empty")
+        for fields in SELECTIONS:
+            with self.subTest(fields=fields):
+                selection = self.selection(fields)
+                if selection is None:
+                    self.skipTest(f"No rows with values for {fields}")
+                nodes = plan_nodes(self.plan(selection))
+                self.assertNotIn('Seq Scan', [n['Node Type'] for n in nodes])
+                # Index on (at least) one of the selected columns
+                indexes = {n.get('Index Name') for n in nodes}
+                self.assertTrue(indexes.intersection(
+                    f'search_{f}' for f in fields),
+                    f"No index on {fields} used: {indexes - {None}}")
+
+
+if __name__ == "__main__":
+    unittest.main()
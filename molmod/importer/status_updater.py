@@ -1,15 +1,153 @@
 #!/usr/bin/env python3
 """
-This script updates dataset metadata and/or the materialized view used for
-summary stats in the About page. It is executed inside a running asv-main
+This script updates dataset metadata and/or the data (tables and materialized
+views) used for summary stats in the About page, filter search and dataset
+list in the Download page. It is executed inside a running asv-main
 container using the update_bas_status.py wrapper.
 """
 
 import logging
 import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 import psycopg2
 from importer import connect_db
+from response_cache import bump_data_version
+
+# Materialized views updated by this script, mapped to the views they are
+# built from, i.e. that need to be refreshed before them. Excludes
+# api.app_asvs_for_blastdb, but this is always updated before BLAST build.
+# The FILTER dropdown views are built from table api.app_search_mixs_tax,
+# which is updated (see update_dataset_data) before views are refreshed
+VIEW_DEPENDENCIES = {
+    'api.app_filter_mixs_tax': [],
+    'api.app_filter_options': ['api.app_filter_mixs_tax'],
+    'api.app_dataset_list': [],
+}
+
+# Data that are updated per dataset, rather than refreshed as views, mapped to
+# db functions that add/remove data for a single dataset, or rebuild data for
+# all datasets (see db/db-api-schema.sql)
+DATASET_FUNCTIONS = {
+    'filter search data': ('search_add_dataset', 'search_remove_dataset',
+                           'search_rebuild'),
+    'stats for About page': ('about_add_dataset', 'about_remove_dataset',
+                             'about_rebuild'),
+}
+
+
+def can_refresh_concurrently(cursor, view: str) -> bool:
+    """Checks whether a materialized view is populated, and has a unique
+       index on plain columns (and without WHERE clause), which is required
+       for REFRESH MATERIALIZED VIEW CONCURRENTLY.
+    """
+    sql = """SELECT mv.ispopulated AND EXISTS (
+                 SELECT 1 FROM pg_index i
+                 WHERE i.indrelid = %(view)s::regclass
+                 AND i.indisunique
+                 AND i.indpred IS NULL
+                 AND i.indexprs IS NULL)
+             FROM pg_matviews mv
+             WHERE mv.schemaname || '.' || mv.matviewname = %(view)s;"""
+    cursor.execute(sql, {'view': view})
+    row = cursor.fetchone()
+    return bool(row and row[0])
+
+
+def update_dataset_data(cursor, pid: int = 0, status: int = None):
+    """Updates data that are maintained per dataset (see DATASET_FUNCTIONS),
+       by adding or removing data for the referenced dataset, depending on
+       its new Bioatlas status, or rebuilds data if no dataset is referenced.
+    """
+    # Bioatlas status unchanged
+    if pid > 0 and status is None:
+        return
+
+    for name, (add, remove, rebuild) in DATASET_FUNCTIONS.items():
+        start = time.time()
+        if pid > 0:
+            logging.info("Updating %s for dataset %s", name, pid)
+            func = add if status else remove
+            cursor.execute(f"SELECT {func}(%s);", (pid,))
+        else:
+            logging.info("Rebuilding %s", name)
+            cursor.execute(f"SELECT {rebuild}();")
+        logging.info("Updated %s (%s rows) in %.2f seconds", name,
+                     cursor.fetchone()[0], time.time() - start)
+
+
+def refresh_view(view: str, dry_run: bool = False) -> float:
+    """Refreshes a materialized view in a separate database connection, and
+       returns the time (in seconds) the refresh took. Views with a unique
+       index are refreshed concurrently, so that they can still be read
+       (e.g. by the About, Filter and Download pages) during the refresh.
+    """
+    connection, cursor = connect_db()
+    try:
+        concurrently = can_refresh_concurrently(cursor, view)
+        mode = 'CONCURRENTLY ' if concurrently else ''
+        start = time.time()
+        cursor.execute(f"REFRESH MATERIALIZED VIEW {mode}{view};")
+        if dry_run:
+            connection.rollback()
+        else:
+            connection.commit()
+        elapsed = time.time() - start
+        logging.info("Refreshed %s%s in %.2f seconds", view,
+                     ' (concurrently)' if concurrently else '', elapsed)
+        return elapsed
+    finally:
+        connection.close()
+
+
+def refresh_views(views: dict, max_workers: int = None,
+                  dry_run: bool = False) -> bool:
+    """Refreshes materialized views, given as a dict mapping each view to the
+       views it depends on. Views are refreshed in parallel as soon as their
+       dependencies have been refreshed, and views depending on a failed
+       refresh are skipped. Returns True if all views were refreshed.
+    """
+    # Ignore dependencies on views that are not to be refreshed
+    pending = {view: [d for d in deps if d in views]
+               for view, deps in views.items()}
+    running = {}
+    done = set()
+    failed = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(views)) as pool:
+        while pending or running:
+            for view, deps in list(pending.items()):
+                # Skip views built from views that could not be refreshed
+                if failed.intersection(deps):
+                    logging.error("Skipping %s, as %s could not be refreshed",
+                                  view, ', '.join(failed.intersection(deps)))
+                    failed.add(view)
+                    del pending[view]
+                # Start views that have all dependencies refreshed
+                elif done.issuperset(deps):
+                    logging.info("Refreshing %s", view)
+                    running[pool.submit(refresh_view, view, dry_run)] = view
+                    del pending[view]
+
+            if not running:
+                logging.error("Could not resolve view dependencies for: %s",
+                              ', '.join(pending))
+                return False
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                view = running.pop(future)
+                try:
+                    future.result()
+                # connect_db exits on connection errors
+                except (psycopg2.Error, SystemExit) as err:
+                    logging.error("Could not refresh %s: %s", view, err)
+                    failed.add(view)
+                else:
+                    done.add(view)
+
+    return not failed
 
 
 def run_update(pid: int = 0, status: int = None, ruid: str = None,
@@ -48,35 +186,13 @@ def run_update(pid: int = 0, status: int = None, ruid: str = None,
                 connection.rollback()
                 sys.exit(1)
 
-    # Update materialized views, excluding api.app_asvs_for_blastdb,
-    # but this is always updated before BLAST build
-    # About stats
-    try:
-        logging.info("Updating stats for About page")
-        cursor.execute("REFRESH MATERIALIZED VIEW api.app_about_stats;")
-    except psycopg2.OperationalError as err:
-        logging.error(err)
-        sys.exit(1)
-    # Filter results
-    try:
-        logging.info("Updating data for filter search results")
-        cursor.execute("REFRESH MATERIALIZED VIEW api.app_search_mixs_tax;")
-    except psycopg2.OperationalError as err:
-        logging.error(err)
-        sys.exit(1)
-    # Filter dropdowns
-    try:
-        logging.info("Updating data for filter dropdown options")
-        cursor.execute("REFRESH MATERIALIZED VIEW api.app_filter_mixs_tax;")
-    except psycopg2.OperationalError as err:
-        logging.error(err)
-        sys.exit(1)
-    # Dataset table
+    # Update filter search data and stats, in the same transaction as the
+    # metadata
     try:
-        logging.info("Updating dataset table in Download data")
-        cursor.execute("REFRESH MATERIALIZED VIEW api.app_dataset_list;")
-    except psycopg2.OperationalError as err:
-        logging.error(err)
+        update_dataset_data(cursor, pid, status)
+    except psycopg2.Error as err:
+        logging.error(f"Database error: {err}")
+        connection.rollback()
         sys.exit(1)
 
     #
@@ -89,6 +205,19 @@ def run_update(pid: int = 0, status: int = None, ruid: str = None,
     else:
         logging.info("Committing changes")
         connection.commit()
+    connection.close()
+
+    # Update materialized views, after committing any metadata changes, as
+    # views are refreshed in separate connections (see refresh_views)
+    refreshed = refresh_views(VIEW_DEPENDENCIES, dry_run=dry_run)
+
+    # Invalidate cached API responses in the app (see response_cache.py), as
+    # data have changed, even if some view could not be refreshed
+    if not dry_run:
+        logging.info("Setting new data version %s", bump_data_version())
+
+    if not refreshed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+"""
+Cache for API (PostgREST) responses that only change when data are updated,
+e.g. About page stats, the dataset list and filter dropdown options. Entries
+are keyed by endpoint and (normalized) parameters, and kept in memory (per
+process, least recently used entries are dropped first), and optionally in
+a directory shared by all processes.
+
+Entries belong to a data version, a stamp in DATA_VERSION_FILE, which is
+bumped by status_updater.py after data and views have been updated, so that
+all cached entries are then invalidated at once. Entries also expire after
+'ttl' seconds, in case data change in other ways.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Stamp bumped when API data change (shared by app and status updater, which
+# run in the same container)
+DATA_VERSION_FILE = os.getenv('DATA_VERSION_FILE') \
+    or '/tmp/molmod_data_version'
+
+
+def bump_data_version(path: str = DATA_VERSION_FILE) -> str:
+    """
+    Sets a new data version, and returns it.
+    """
+    version = f'{time.time_ns():x}'
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as file:
+        file.write(version)
+    os.replace(tmp, path)
+    return version
+
+
+class ResponseCache:
+    """
+    Caches up to 'max_items' entries in memory, and optionally all entries
+    in 'shared_dir'.
+    """
+
+    def __init__(self, max_items: int = 1000, ttl: float = 3600,
+                 shared_dir: str = None,
+                 version_file: str = DATA_VERSION_FILE):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.shared_dir = shared_dir
+        self.version_file = version_file
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._version, self._mtime = None, None
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def data_version(self) -> str:
+        """
+        Returns current data version (the stamp file is only re-read if it
+        has changed). A version is set if there is none yet.
+        """
+        try:
+            mtime = os.stat(self.version_file).st_mtime_ns
+        except FileNotFoundError:
+            bump_data_version(self.version_file)
+            mtime = os.stat(self.version_file).st_mtime_ns
+        if mtime != self._mtime:
+            with open(self.version_file) as file:
+                version = file.read().strip()
+            with self._lock:
+                # Entries of older versions can't be used anymore
+                if version != self._version:
+                    self._entries.clear()
+                    self._prune_shared(version)
+                self._version, self._mtime = version, mtime
+        return self._version
+
+    @staticmethod
+    def key(endpoint: str, params: dict = None) -> str:
+        """
+        Returns key for endpoint and parameters (in any order).
+        """
+        data = json.dumps([endpoint, params or {}], sort_keys=True,
+                          separators=(',', ':'))
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def get(self, endpoint: str, params: dict = None):
+        """
+        Returns cached value, or None if there is none (for the current data
+        version).
+        """
+        version = self.data_version()
+        key = self.key(endpoint, params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored, value = entry
+                if time.time() - stored < self.ttl:
+                    self._entries.move_to_end(key)
+                    return value
+                del self._entries[key]
+        if not self.shared_dir:
+            return None
+
+        path = self._shared_path(version, key)
+        try:
+            stored = os.stat(path).st_mtime
+            if time.time() - stored >= self.ttl:
+                return None
+            with open(path) as file:
+                value = json.load(file)
+        except (OSError, ValueError):
+            return None
+        self._remember(key, stored, value)
+        return value
+
+    def put(self, endpoint: str, params: dict, value):
+        """
+        Caches (JSON-serializable) value.
+        """
+        version = self.data_version()
+        key = self.key(endpoint, params)
+        self._remember(key, time.time(), value)
+        if self.shared_dir:
+            path = self._shared_path(version, key)
+            tmp = f'{path}.{os.getpid()}.tmp'
+            try:
+                with open(tmp, 'w') as file:
+                    json.dump(value, file)
+                os.replace(tmp, path)
+            except OSError:
+                pass
+
+    def cached(self, endpoint: str, params: dict, fetch):
+        """
+        Returns cached value, or the value returned by 'fetch()', which is
+        then cached, unless it is None (e.g. if the request failed).
+        """
+        value = self.get(endpoint, params)
+        if value is None:
+            value = fetch()
+            if value is not None:
+                self.put(endpoint, params, value)
+        return value
+
+    def _remember(self, key: str, stored: float, value):
+        with self._lock:
+            self._entries[key] = (stored, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_items:
+                self._entries.popitem(last=False)
+
+    def _shared_path(self, version: str, key: str) -> str:
+        return os.path.join(self.shared_dir, f'{version}_{key}.json')
+
+    def _prune_shared(self, version: str):
+        """
+        Removes shared entries of other data versions.
+        """
+        if not self.shared_dir:
+            return
+        for name in os.listdir(self.shared_dir):
+            if not name.startswith(f'{version}_'):
+                try:
+                    os.remove(os.path.join(self.shared_dir, name))
+                except OSError:
+                    pass
@@ -3,7 +3,10 @@ This module contains routes involved in blast processing and
 result display. The blast-worker containers are called from the
 /blast_run endpoint in this module.
 """
+import hashlib
 import json
+import math
+import time
 
 import requests
 from flask import Blueprint
@@ -11,11 +14,18 @@ from flask import current_app as APP
 from flask import jsonify, render_template, request
 from forms import BlastResultForm, BlastSearchForm
 
+from blast_pool import WorkerPool
 from config import get_config
-from molmod import custom_login_required
+from molmod import BLAST_WORKERS, POSTGREST, custom_login_required
 
 CONFIG = get_config()
 
+# Replicas of blast-worker, that jobs are distributed over
+WORKERS = WorkerPool(CONFIG.BLAST_WORKER_HOSTS, client=BLAST_WORKERS)
+
+# Max number of result rows sent to browser (also applied by blast worker)
+MAX_ROWS = 1000
+
 blast_bp = Blueprint('blast_bp', __name__,
                      template_folder='templates')
 
@@ -31,6 +41,7 @@ def blast():
     # Create forms from classes in forms.py
     sform = BlastSearchForm()
     rform = BlastResultForm()
+    sform.gene.choices = [(g, g) for g in get_blast_genes()]
 
     # Only include result form if BLAST button was clicked
     if request.form.get('blast_for_seq') and sform.validate_on_submit():
@@ -42,31 +53,64 @@ def blast():
 @custom_login_required
 def blast_run():
     """
-    Sends blast run request to one of the available blast workers, and then
+    Sends blast run request to the least loaded blast worker, and then
     adds subject sequences to the output, via a separate function, and returns
-    a JSON Response (or an empty string if error occurs).
+    a JSON Response (or an empty string if error occurs). Searches for 100%
+    identity and coverage are first run as exact (ID) lookups, and only
+    queries without exact matches are sent to the worker.
     """
 
     form = dict(request.form.lists())
     form['db'] = CONFIG.BLAST_DB
-    response = requests.post('http://blast-worker:5000/', json=form)
-    if not response.ok:
-        APP.logger.error('Error response returned from worker')
-        # If error: Return '' instead of None, to avoid logging Werkzeug stack
-        # (visible on next request for some reason).
-        # jQuery will display custom error msg
-        return ''
+    form['max_rows'] = MAX_ROWS
+
+    results, records, truncated = [], None, False
+    if is_exact_search(form):
+        records = parse_fasta('\n'.join(form['sequence']))
+        exact = get_exact_matches(records, form.get('gene'))
+        # If lookup failed, let BLAST handle all queries instead
+        if exact is not None:
+            results, unmatched = exact
+            form['sequence'] = [f'>{header}\n{seq}'
+                                for header, seq in unmatched]
+
+    if form['sequence']:
+        try:
+            response = WORKERS.post('/', json=form)
+        except requests.RequestException as ex:
+            APP.logger.error('BLAST worker request failed: %s', ex)
+            return ''
+        if response.status_code == 429:
+            APP.logger.warning('BLAST worker is busy, retry after %s seconds',
+                               response.headers.get('Retry-After'))
+            return ''
+        if not response.ok:
+            APP.logger.error('Error response returned from worker')
+            # If error: Return '' instead of None, to avoid logging Werkzeug
+            # stack (visible on next request for some reason).
+            # jQuery will display custom error msg
+            return ''
+
+        blast_results = response.json()
+        results += blast_results['data'] if 'data' in blast_results \
+            else blast_results
+        truncated = blast_results.get('truncated', False) \
+            if isinstance(blast_results, dict) else False
+
+        # Keep exact and BLAST results in query order, as in BLAST output
+        if records:
+            order = {qacc(header): i
+                     for i, (header, _) in reversed(list(enumerate(records)))}
+            results.sort(key=lambda r: order.get(r['qacc'], len(order)))
 
     #
     # If there are results, format them and add subject sequence before
     # returning.
     #
 
-    results = response.json()
-    results = results['data'] if 'data' in results else results
-
-    # Limit results sent to browser to max 1000 rows
-    results = results[0:1000]
+    # Limit results sent to browser to max rows
+    truncated = truncated or len(results) > MAX_ROWS
+    results = results[0:MAX_ROWS]
 
     # Format result fields
     for result in results:
@@ -81,8 +125,12 @@ def blast_run():
         # Extract asvid from stitle = id + taxonomy
         result['asv_id'] = result['stitle'].split('-')[0]
 
-    # Get Subject sequence via ID, and add to the results
-    asv_ids = [f['asv_id'] for f in results]
+    # Get Subject sequence via ID (unless already added by worker, from the
+    # sequence index of the searched database, or known from exact lookup),
+    # and add to the results
+    asv_ids = [f['asv_id'] for f in results if 'asv_sequence' not in f]
+    if not asv_ids:
+        return jsonify(data=results, truncated=truncated)
     sdict = get_sseq_from_api(asv_ids)
 
     # If no, or incomplete set of, sequences were retrieved,
@@ -92,13 +140,185 @@ def blast_run():
         return ''
     else:
         for result in results:
+            if 'asv_sequence' in result:
+                continue
             if result['asv_id'] in sdict:
                 result['asv_sequence'] = sdict[result['asv_id']]
             else:
                 APP.logger.error(f"No seq found for {result['asv_id']}")
                 return ''
 
-    return jsonify(data=results)
+    return jsonify(data=results, truncated=truncated)
+
+
+def is_exact_search(form: dict) -> bool:
+    """Checks whether BLAST form asks for 100% identity and coverage."""
+    try:
+        return (float(form['min_identity'][0]) == 100
+                and float(form['min_qry_cover'][0]) == 100)
+    except (KeyError, IndexError, ValueError):
+        return False
+
+
+def parse_fasta(text: str) -> list:
+    """Parses (validated, see forms.py) FASTA text into a list of
+       (header, sequence) tuples, with headers excluding '>', and sequences
+       in upper case, without whitespace."""
+    records = []
+    for row in text.split('\n'):
+        row = row.strip()
+        if not row:
+            continue
+        if row.startswith('>'):
+            records.append([row[1:], ''])
+        elif records:
+            records[-1][1] += row.upper()
+    return [tuple(r) for r in records]
+
+
+def qacc(header: str) -> str:
+    """Returns query accession (first word of header), as reported by BLAST."""
+    return header.split()[0] if header.strip() else ''
+
+
+def asv_id_from_seq(seq: str) -> str:
+    """Returns ASV ID for a sequence, i.e. 'ASV:' + md5 of sequence."""
+    return f'ASV:{hashlib.md5(seq.encode()).hexdigest()}'
+
+
+def get_exact_matches(records: list, genes: list = None) -> tuple:
+    """Looks up query sequences as ASV IDs (ASV: + md5 of sequence) via API,
+       optionally restricted to 'genes', and returns exact (100% identity and
+       coverage) matches, formatted as BLAST results, and the records without
+       a match. Note that, unlike BLAST, this will not find longer ASVs that
+       contain a query. Returns None if the lookup fails.
+    """
+    genes = sorted(g for g in genes or [] if g) or None
+    ids = {asv_id_from_seq(seq) for _, seq in records}
+    payload = json.dumps({'ids': sorted(ids), 'genes': genes})
+    headers = {'Content-Type': 'application/json'}
+    try:
+        response = POSTGREST.post('/rpc/app_asvs_from_id', headers=headers,
+                                  data=payload, idempotent=True)
+        response.raise_for_status()
+        partitions = get_blastdb_partitions()
+    except Exception as ex:
+        APP.logger.error('API request for exact matches returned: %s', ex)
+        return None
+
+    asvs = {}
+    for item in response.json():
+        asvs.setdefault(item['asv_id'], []).append(item)
+
+    # E-values as calculated by the worker: for the size of the whole
+    # database, and the number of sequences in the partition searched
+    letters = sum(p['letters'] for p in partitions.values())
+    results, unmatched = [], []
+    for header, seq in records:
+        asv_id = asv_id_from_seq(seq)
+        if asv_id not in asvs:
+            unmatched.append((header, seq))
+            continue
+        for asv in asvs[asv_id]:
+            sequences = partitions[asv['gene']]['sequences'] \
+                if asv['gene'] in partitions \
+                else sum(p['sequences'] for p in partitions.values())
+            results.append({
+                'qacc': qacc(header),
+                'stitle': f"{asv['asv_id']}-{asv['higher_taxonomy']}",
+                'pident': 100.0,
+                'qcovhsp': 100.0,
+                'evalue': exact_evalue(len(seq), letters, sequences),
+                'asv_sequence': asv['asv_sequence']
+            })
+    return results, unmatched
+
+
+# BLAST database partitions (sizes per gene), cached for a while, as they
+# only change when the database is rebuilt
+_BLASTDB_PARTITIONS = {'partitions': None, 'fetched': 0}
+
+
+def get_blastdb_partitions() -> dict:
+    """Returns number of sequences and letters (as a dict) per partition
+       (gene) of BLAST database."""
+    if time.time() - _BLASTDB_PARTITIONS['fetched'] > 600:
+        response = POSTGREST.get('/app_blastdb_genes')
+        response.raise_for_status()
+        _BLASTDB_PARTITIONS.update(
+            partitions={row['gene']: {'sequences': row['sequences'] or 0,
+                                      'letters': row['letters'] or 0}
+                        for row in response.json()},
+            fetched=time.time())
+    return _BLASTDB_PARTITIONS['partitions']
+
+
+def get_blast_genes() -> list:
+    """Returns genes that BLAST searches can be restricted to, i.e.
+       partitions of BLAST database."""
+    try:
+        response = POSTGREST.get('/app_blastdb_genes?select=gene')
+        response.raise_for_status()
+    except Exception as ex:
+        APP.logger.error('API request for BLAST genes returned: %s', ex)
+        return []
+    return [row['gene'] for row in response.json()]
+
+
+# Karlin-Altschul parameters (lambda, K, alpha, beta) that blastn uses for
+# its default (megablast) scoring, i.e. reward 1, penalty -2 and linear gap
+# costs, as tabulated in blast_stat.c of BLAST+
+KA_LAMBDA, KA_K, KA_ALPHA, KA_BETA = 1.28, 0.46, 1.5, -2
+
+
+def length_adjustment(length: int, db_letters: int, db_seqs: int) -> int:
+    """Returns the length adjustment that BLAST subtracts from query and
+       subject lengths (for edge effects), computed as in
+       BLAST_ComputeLengthAdjustment of BLAST+."""
+    m, n, N = length, db_letters, db_seqs
+    alpha_d_lambda, log_k = KA_ALPHA / KA_LAMBDA, math.log(KA_K)
+    # Largest adjustment for which K * (m - ell) * (n - N * ell) > max(m, n)
+    c = n * m - max(m, n) / KA_K
+    if c < 0:
+        return 0
+    mb = m * N + n
+    ell_min, ell_max = 0, 2 * c / (mb + math.sqrt(mb * mb - 4 * N * c))
+    ell_next, converged = 0, False
+    for i in range(1, 21):
+        ell = ell_next
+        space = (m - ell) * (n - N * ell)
+        ell_bar = alpha_d_lambda * (log_k + math.log(space)) + KA_BETA
+        if ell_bar >= ell:
+            ell_min = ell
+            if ell_bar - ell_min <= 1:
+                converged = True
+                break
+            if ell_min == ell_max:
+                break
+        else:
+            ell_max = ell
+        if ell_min <= ell_bar <= ell_max:
+            ell_next = ell_bar
+        else:
+            ell_next = ell_max if i == 1 else (ell_min + ell_max) / 2
+    if converged:
+        ell = math.ceil(ell_min)
+        if ell <= ell_max and alpha_d_lambda * (
+                log_k + math.log((m - ell) * (n - N * ell))) + KA_BETA >= ell:
+            return ell
+    return int(ell_min)
+
+
+def exact_evalue(length: int, db_letters: int, db_seqs: int) -> float:
+    """Calculates BLAST E-value for an exact match of given length (i.e. a
+       raw score of 'length'), using effective query and database lengths,
+       for a database of 'db_letters' (as in -dbsize) and 'db_seqs'
+       sequences (in the partition searched), as blastn does. E-values may
+       still differ from those of blastn for up to 10 minutes after a
+       database rebuild, as partition sizes are cached."""
+    adjust = length_adjustment(length, db_letters, db_seqs)
+    space = max(1, length - adjust) * max(1, db_letters - db_seqs * adjust)
+    return KA_K * space * math.exp(-KA_LAMBDA * length)
 
 
 def get_sseq_from_api(asv_ids: list) -> dict:
@@ -106,11 +326,11 @@ def get_sseq_from_api(asv_ids: list) -> dict:
         as these are not available in regular BLAST response"""
 
     # Send API request
-    url = f"{CONFIG.POSTGREST}/rpc/app_seq_from_id"
     payload = json.dumps({'ids': asv_ids})
     headers = {'Content-Type': 'application/json'}
     try:
-        response = requests.request("POST", url, headers=headers, data=payload)
+        response = POSTGREST.post('/rpc/app_seq_from_id', headers=headers,
+                                  data=payload, idempotent=True)
         response.raise_for_status()
     except Exception as ex:
         APP.logger.error('API request for subject sequences returned: %s', ex)
@@ -1,22 +1,41 @@
 """
 This module contains routes involved in filter search and result display.
 """
+import codecs
+import csv
 import json
+import zlib
+from datetime import datetime as dt
 
 import requests
-from flask import Blueprint
+from flask import Blueprint, Response, abort
 from flask import current_app as APP
-from flask import render_template, request
+from flask import render_template, request, stream_with_context
 from forms import FilterResultForm, FilterSearchForm
 
 from config import get_config
-from molmod import custom_login_required
+from molmod import POSTGREST, RESPONSE_CACHE, custom_login_required
 
 CONFIG = get_config()
 
 filter_bp = Blueprint('filter_bp', __name__,
                       template_folder='templates')
 
+# Dropdowns that FILTER results can be filtered by (see FilterSearchForm)
+FILTER_FIELDS = ['gene', 'sub', 'fw_prim', 'rv_prim', 'kingdom', 'phylum',
+                 'classs', 'oorder', 'family', 'genus', 'species']
+# Columns that FILTER results can be ordered by (default first)
+ORDER_COLUMNS = ['asv_tax', 'gene', 'sub', 'fw_name', 'rv_name']
+# Largest number of FILTER results returned per page
+MAX_PAGE_LENGTH = 100
+# Columns included in FILTER result downloads (TSV)
+DOWNLOAD_COLUMNS = ['asv_id', 'asv_tax', 'asv_sequence', 'gene', 'sub',
+                    'fw_name', 'fw_sequence', 'rv_name', 'rv_sequence',
+                    'kingdom', 'phylum', 'classs', 'oorder', 'family',
+                    'genus', 'species']
+# Size (characters) of text compressed and sent at a time, in downloads
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
 
 @filter_bp.route('/filter', methods=['GET', 'POST'])
 @custom_login_required
@@ -66,81 +85,225 @@ def request_drop_options(field) -> dict:
 
     # Add name of field to be filtered, and (user-typed search) term
     payload.update({'field': field, 'term': term})
+    search = dict(payload)
     # Add pagination data.
     limit = 25
-    offset = (int(request.form['page']) - 1) * limit
+    page = int(request.form['page'])
+    offset = (page - 1) * limit
     # Examples (assuming more=TRUE, see below):
     # 1) User opens dropdown -> select2 sends page=1 -> offset = 0 -> get
     # records 1-25 from db
-    # 2) User scrolls past limit -> page = 2 -> offset = 25 -> get 26-50
-    payload.update({'nlimit': limit, 'noffset': offset})
+    # 2) User scrolls past limit -> page = 2 -> get records after last
+    # record of page 1 (cached, see below), or if unknown, offset = 25
+    # -> get 26-50
+    after = RESPONSE_CACHE.get('app_drop_options_after',
+                               dict(search, page=page)) if page > 1 else None
+    payload.update({'nlimit': limit, 'noffset': offset,
+                    'after_value': after})
 
     #
     # Send API request
     #
 
     # Data are sent to a stored db procedure (app_drop_options) which,
-    # in turn, dynamically filters data from a db view (app_filter_mixs_tax),
-    # based on target field, typed input and selections made in
-    # other dropdowns (see db/db-api-schema.sql)
-    url = f"{CONFIG.POSTGREST}/rpc/app_drop_options"
-    payload = json.dumps(payload)
-    APP.logger.debug(f'Payload sent to /rpc/app_drop_options: {payload}')
-    headers = {'Content-Type': 'application/json'}
-    try:
-        response = requests.request("POST", url, headers=headers, data=payload)
-        response.raise_for_status()
-    except Exception as e:
-        APP.logger.error(f'API request for select options resulted in: {e}')
-    else:
+    # in turn, dynamically filters data from a db view (app_filter_options),
+    # based on target field, typed input (prefix) and selections made in
+    # other dropdowns (see db/db-api-schema.sql). Responses are cached for
+    # the current data version.
+    def request_options():
+        data = json.dumps(payload)
+        APP.logger.debug(f'Payload sent to /rpc/app_drop_options: {data}')
+        headers = {'Content-Type': 'application/json'}
+        try:
+            response = POSTGREST.post('/rpc/app_drop_options',
+                                      headers=headers, data=data,
+                                      idempotent=True)
+            response.raise_for_status()
+        except Exception as e:
+            APP.logger.error(
+                f'API request for select options resulted in: {e}')
+        else:
+            return json.loads(response.text)[0]['data']
+
+    data = RESPONSE_CACHE.cached('app_drop_options', payload,
+                                 request_options)
+    if data is not None:
         # Repackage data into custom format for Select2 boxes
-        results = json.loads(response.text)[0]['data']['results']
-        count = json.loads(response.text)[0]['data']['count']
-        if count > limit:
-            # Remove extra record used for pagination check
-            results = results[:-1]
-        # APP.logger.debug(f"Offset: {offset}, Limit: {limit}, Count: {count}")
-        # APP.logger.debug(f"More results: {count > limit}")
+        results = data['results']
+        if data['more']:
+            # Remember where next page starts
+            RESPONSE_CACHE.put('app_drop_options_after',
+                               dict(search, page=page + 1),
+                               results[-1]['id'])
+        # APP.logger.debug(f"Offset: {offset}, Limit: {limit}")
+        # APP.logger.debug(f"More results: {data['more']}")
         return {'results': results,
                 # Enable scrolling if there are at least one additional record
-                'pagination': {'more': count > limit}}
+                'pagination': {'more': data['more']}}
 
 
 @filter_bp.route('/filter_run', methods=['POST'])
 @custom_login_required
 def filter_run() -> dict:
-    """Composes API request for filtered ASV occurrences, based on data
-       received in (DataTable) AJAX request, and returns dict
+    """Composes API request for a page of filtered ASV occurrences, based on
+       dropdown selections and (DataTables server-side) paging, ordering
+       and search parameters received in AJAX request, and returns dict
        with DataTables-specific format"""
 
-    # Set base URL for API search
-    url = f"{CONFIG.POSTGREST}/app_search_mixs_tax"
-
-    #
-    # Append row filters based on POST:ed dropdown selections
-    #
-
-    filters = [f for f in request.form if f != 'csrf_token']
-    selections = {f: ','.join(
-        map(str,request.form.getlist(f))) for f in filters}
-    query_parts = []
-    for filter, value in selections.items():
-        query_parts.append(f'{filter}=in.({value})')
-    query_parts.append('limit=1000')
+    form = request.form
 
-    url += '?' + '&'.join(query_parts)
-    # APP.logger.debug(f'URL for API request: {url}')
+    # Dropdown selections, e.g. {'kingdom': ['Bacteria']}
+    selections = {f: form.getlist(f) for f in FILTER_FIELDS
+                  if form.getlist(f)}
+    # Clean search term from characters used as wildcards in (I)LIKE
+    term = ''.join(e for e in form.get('search[value]', '').strip()
+                   if e not in '%_\\')
+    # Results are ordered by one column (and row_id, for a stable order)
+    column = form.get('order[0][column]', '')
+    order_col = form.get(f'columns[{column}][data]')
+    if order_col not in ORDER_COLUMNS:
+        order_col = ORDER_COLUMNS[0]
+    descending = form.get('order[0][dir]') == 'desc'
+    try:
+        draw = int(form.get('draw', 0))
+        start = max(int(form.get('start', 0)), 0)
+        length = int(form.get('length', 25))
+    except ValueError:
+        return {'error': 'Invalid paging parameters'}, 400
+    if not 0 < length <= MAX_PAGE_LENGTH:
+        length = MAX_PAGE_LENGTH
 
     #
     # Send API request
     #
 
+    # Data are sent to a stored db procedure (app_search_page), which
+    # filters, orders and paginates the search table (see
+    # db/db-api-schema.sql). Counts, and the last row of each page seen, are
+    # cached for the current data version, so that counts are only made once
+    # per search, and following pages can start right after the previous one
+    # (keyset pagination), instead of skipping all rows before it (offset).
+    search = dict(selections, term=term)
+    counts = RESPONSE_CACHE.get('app_search_count', search)
+    page = dict(search, order_col=order_col, descending=descending)
+    after = RESPONSE_CACHE.get('app_search_page', dict(page, start=start)) \
+        if start else None
+    payload = dict(page, nlimit=length, with_count=counts is None,
+                   max_count=CONFIG.FILTER_MAX_COUNT)
+    if after:
+        payload.update({'after_value': after[0], 'after_id': after[1]})
+    else:
+        payload['noffset'] = start
+    # APP.logger.debug(f'Payload sent to /rpc/app_search_page: {payload}')
+
     try:
-        response = requests.get(url)
+        response = POSTGREST.post('/rpc/app_search_page', json=payload,
+                                  idempotent=True)
         response.raise_for_status()
-    except (requests.ConnectionError, requests.exceptions.HTTPError) as e:
+    except requests.RequestException as e:
         APP.logger.error(f'API request for filtered occurences returned: {e}')
-    else:
-        results = json.loads(response.text)
-        # APP.logger.debug(results)
-        return {"data": results}
+        return {'error': 'Search failed'}, 502
+
+    data = response.json()[0]['data']
+    if counts is None:
+        counts = {k: data[k] for k in ('count', 'total', 'estimated')}
+        RESPONSE_CACHE.put('app_search_count', search, counts)
+    results = data['results']
+    if results:
+        last = results[-1]
+        RESPONSE_CACHE.put('app_search_page',
+                           dict(page, start=start + len(results)),
+                           [last[order_col], last['row_id']])
+    return {'draw': draw,
+            'recordsTotal': counts['total'],
+            'recordsFiltered': counts['count'],
+            'estimated': counts['estimated'],
+            'data': results}
+
+
+@filter_bp.route('/filter_download/<fmt>', methods=['POST'])
+@custom_login_required
+def filter_download(fmt):
+    """Streams all FILTER results for POST:ed dropdown selections, as
+       gzipped TSV (one row per ASV and primer pair) or FASTA (one record
+       per ASV) file. Rows are read from API (as CSV) and compressed a block
+       at a time, so that memory use does not depend on number of results"""
+
+    if fmt not in ('tsv', 'fasta'):
+        abort(404)
+
+    # Quote selected values, as they may contain commas
+    # e.g. 'kingdom=in.("Bacteria","Archaea")'
+    params = []
+    for field in FILTER_FIELDS:
+        values = [v.replace('\\', '\\\\').replace('"', '\\"')
+                  for v in request.form.getlist(field)]
+        if values:
+            params.append((field, 'in.({})'.format(
+                ','.join(f'"{v}"' for v in values))))
+    # Order FASTA by ASV, so that rows of the same ASV are adjacent
+    params.append(('select', ','.join(DOWNLOAD_COLUMNS)))
+    params.append(('order', 'asv_id' if fmt == 'fasta' else 'row_id'))
+
+    try:
+        response = POSTGREST.get('/app_search_mixs_tax', params=params,
+                                 headers={'Accept': 'text/csv'},
+                                 stream=True)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        APP.logger.error(f'API request for FILTER download returned: {e}')
+        abort(502)
+
+    name = f'asv-filter-results-{dt.now():%Y%m%d}.{fmt}.gz'
+    return Response(stream_with_context(stream_results(response, fmt)),
+                    mimetype='application/gzip',
+                    headers={'Content-Disposition':
+                             f'attachment; filename={name}'})
+
+
+def stream_results(response, fmt: str):
+    """Yields gzipped TSV or FASTA, converted from CSV in (streamed) API
+       response, in chunks of (uncompressed) DOWNLOAD_CHUNK_SIZE"""
+    # wbits=31 gives gzip (rather than zlib) format
+    compressor = zlib.compressobj(wbits=31)
+    try:
+        rows = csv.reader(iter_lines(response))
+        header = next(rows, [])
+        lines, size, last_asv = [], 0, None
+        if fmt == 'tsv':
+            lines.append('\t'.join(header) + '\n')
+        for row in rows:
+            if fmt == 'tsv':
+                line = '\t'.join(v.replace('\t', ' ') for v in row) + '\n'
+            else:
+                record = dict(zip(header, row))
+                if record['asv_id'] == last_asv:
+                    continue
+                last_asv = record['asv_id']
+                line = (f'>{record["asv_id"]} {record["asv_tax"]}\n'
+                        f'{record["asv_sequence"]}\n')
+            lines.append(line)
+            size += len(line)
+            if size >= DOWNLOAD_CHUNK_SIZE:
+                chunk = compressor.compress(''.join(lines).encode())
+                lines, size = [], 0
+                if chunk:
+                    yield chunk
+        yield compressor.compress(''.join(lines).encode()) \
+            + compressor.flush()
+    finally:
+        response.close()
+
+
+def iter_lines(response):
+    """Yields lines (incl. line endings, as expected by csv.reader) of text
+       in (streamed) API response"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    rest = ''
+    for block in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        *lines, rest = (rest + decoder.decode(block)).split('\n')
+        for line in lines:
+            yield line + '\n'
+    rest += decoder.decode(b'', final=True)
+    if rest:
+        yield rest
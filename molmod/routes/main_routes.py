@@ -11,10 +11,14 @@ from forms import DownloadForm, UploadForm
 from werkzeug.utils import secure_filename
 
 from config import get_config
-from molmod import custom_login_required
+from export_manifest import EXPORT_DIR, ExportManifest
+from molmod import POSTGREST, RESPONSE_CACHE, custom_login_required
 
 CONFIG = get_config()
 
+# Index of exported dataset archives (see exporter.py)
+EXPORTS = ExportManifest()
+
 main_bp = Blueprint('main_bp', __name__,
                     template_folder='templates')
 
@@ -33,14 +37,16 @@ def about():
 
 
 def get_stats() -> dict:
-    """Makes API request for db stats, and returns dict."""
+    """Makes API request for db stats (unless cached for current data
+       version), and returns dict."""
+    return RESPONSE_CACHE.cached('app_about_stats', {}, request_stats)
 
-    url = f"{CONFIG.POSTGREST}/app_about_stats"
 
+def request_stats() -> dict:
     try:
-        response = requests.get(url)
+        response = POSTGREST.get('/app_about_stats')
         response.raise_for_status()
-    except (requests.ConnectionError, requests.exceptions.HTTPError) as e:
+    except requests.RequestException as e:
         APP.logger.error(f'API request for db stats returned: {e}')
     else:
         results = json.loads(response.text)
@@ -183,17 +189,24 @@ def download():
 def list_datasets() -> dict:
     """Composes API request for available datasets, based on data
        received in (DataTable) AJAX request, and returns dict
-       with DataTable-specific format"""
-
-    url = f"{CONFIG.POSTGREST}/app_dataset_list"
+       with DataTable-specific format. The API response is cached for
+       the current data version."""
 
-    try:
-        response = requests.get(url)
-        response.raise_for_status()
-    except (requests.ConnectionError, requests.exceptions.HTTPError) as e:
-        APP.logger.error(f'API request for dataset list returned: {e}')
-    else:
-        results = json.loads(response.text)  # -> list of dicts
+    def request_datasets():
+        try:
+            response = POSTGREST.get('/app_dataset_list')
+            response.raise_for_status()
+        except requests.RequestException as e:
+            APP.logger.error(f'API request for dataset list returned: {e}')
+        else:
+            return json.loads(response.text)  # -> list of dicts
+
+    results = RESPONSE_CACHE.cached('app_dataset_list', {}, request_datasets)
+    if results is not None:
+        # Copy, as links are added below
+        results = [dict(ds) for ds in results]
+        archives = EXPORTS.get()
+        missing = []
         for ds in results:
             # Only add IPT link if ID was provided
             if ds['ipt_resource_id']:
@@ -202,16 +215,34 @@ def list_datasets() -> dict:
             else:
                 msg = f'Dataset {ds["dataset_id"]} has no IPT resource ID'
                 APP.logger.warning(msg)
-            # Only add Download link if zip exists
-            zip_path = os.path.join('/app/data-volumes/exports',
-                                    f'{ds["dataset_id"]}.zip')
-
-            if os.path.isfile(zip_path):
+            # Only add Download link if zip has been exported
+            if archives is not None:
+                archive = archives.get(ds['dataset_id'])
+            else:
+                # No manifest yet (see exporter.py --manifest)
+                zip_path = os.path.join(EXPORT_DIR, f'{ds["dataset_id"]}.zip')
+                archive = {'size': os.path.getsize(zip_path)} \
+                    if os.path.isfile(zip_path) else None
+            if archive:
                 ds['zip_link'] = url_for('main_bp.datasets',
                                          filename=f"{ds['dataset_id']}.zip",
                                          _external=True)
+                ds['zip_bytes'] = archive['size']
+                ds['zip_size'] = format_size(archive['size'])
             else:
-                APP.logger.warning(f'Zip file does not exist: {zip_path}')
+                missing.append(ds['dataset_id'])
+        if missing:
+            APP.logger.debug(f'No exported zip file for: {missing}')
 
         # APP.logger.debug(results)
         return results
+
+
+def format_size(size: int) -> str:
+    """Formats file size (bytes) for display, e.g. '2.5 MB'."""
+    for unit in ['bytes', 'kB', 'MB']:
+        if size < 1000:
+            return f'{size:.0f} {unit}' if unit == 'bytes' \
+                else f'{size:.1f} {unit}'
+        size /= 1000
+    return f'{size:.1f} GB'
@@ -16,6 +16,7 @@ $(document).ready(function() {
                 $('#sequence_textarea').val('');
                 $('#min_identity_input').val('');
                 $('#min_qry_cover_input').val('');
+                $('#gene_select').val([]);
             });
             // Define columns for BLAST search result table
             var columns = [
@@ -69,8 +70,8 @@ $(document).ready(function() {
                 { data: 'fw_sequence', visible: false },
                 { data: 'rv_sequence', visible: false }
             ];
-            // Make FILTER search result table
-            var dTbl = makeResultTbl('/filter_run', columns);
+            // Make FILTER search result table, paginated by server
+            var dTbl = makeResultTbl('/filter_run', columns, true);
             break;
 
         case '/download':
@@ -382,10 +383,12 @@ function makeSel2drop(drop){
     });
 }
 
-function makeResultTbl(url, columns) {
+function makeResultTbl(url, columns, serverSide) {
     // Makes DataTables-table of (FILTER or BLAST search) results
     // received in AJAX request to Flask endpoint
-    // Pagination handled by client
+    // Pagination handled by client, or by server (one page per request)
+    // if serverSide is true
+    serverSide = serverSide === true;
     $.fn.dataTable.ext.errMode = 'none';
     var dTbl = $('.table')
         // Handle errors, including serverside BLAST errors causing response
@@ -414,16 +417,27 @@ function makeResultTbl(url, columns) {
                     $("#show_occurrences").prop("disabled",true);
                     dTbl.buttons().disable();
                 }
-                if (json.data.length > 999) {
+                if (json.estimated) {
+                    $('#dtbl_err_container').removeClass('hiddenElem');
+                    $('#dtbl_err_container').html('Please note that numbers of hits are estimates. '
+                      + 'Refine your search to get exact numbers.');
+                }
+                if (json.truncated || json.data.length > 999) {
                     $('#dtbl_err_container').removeClass('hiddenElem');
                     $('#dtbl_err_container').html('Please note that only the first 1000 hits are returned. '
                       + 'Refine your search to make sure results are not truncated.');
                 }
                 return json.data;
             } ,
-            // Include CSRF-token in POST
-            data: function () { return $("#sform").serialize(); }
+            // Include CSRF-token in POST, and (if server-side) paging,
+            // ordering and search parameters
+            data: function (d) {
+                var data = $("#sform").serialize();
+                return serverSide ? data + '&' + $.param(d) : data;
+            }
         },
+        serverSide: serverSide,
+        searchDelay: serverSide ? 400 : null, // Wait for user to stop typing
         pagingType: 'numbers',
         columns : columns,
         processing: true, // Show 'Loading' indicator
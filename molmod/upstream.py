@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+HTTP clients for upstream services (PostgREST and the BLAST workers), with
+per-process connection pools, so that connections are kept alive and reused
+between requests, instead of being opened for each call. All requests have
+connect and read timeouts, and idempotent requests (GET/HEAD, and POSTs to
+read-only functions if marked as such) are retried on connection errors,
+timeouts and gateway errors.
+"""
+
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Gateway errors that idempotent requests are retried on
+RETRY_STATUS = (502, 503, 504)
+
+
+class Upstream:
+    """
+    Client for service at 'base_url' (or any URL, if empty), keeping up to
+    'pool_size' connections per host alive. 'timeout' is a (connect, read)
+    tuple in seconds (read may be None, for no limit), and idempotent
+    requests are retried 'retries' times.
+    """
+
+    def __init__(self, base_url: str = '', pool_size: int = 10,
+                 timeout: tuple = (3, 60), retries: int = 2,
+                 backoff: float = 0.2):
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._local = threading.local()
+
+    @property
+    def session(self) -> requests.Session:
+        """
+        Returns the session of this process and thread. Sessions are not
+        shared between (forked uWSGI) processes, as they would then share
+        sockets, nor between threads, as sessions are not thread-safe.
+        """
+        session = getattr(self._local, 'session', None)
+        if session is None or self._local.pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size,
+                                  pool_maxsize=self.pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._local.session, self._local.pid = session, os.getpid()
+        return session
+
+    def url(self, path: str) -> str:
+        if path.startswith(('http://', 'https://')):
+            return path
+        return f'{self.base_url}/{path.lstrip("/")}'
+
+    def request(self, method: str, path: str, idempotent: bool = None,
+                **kwargs) -> requests.Response:
+        """
+        Sends request to 'path' (relative to base URL, or a full URL), and
+        returns response. Requests are retried if 'idempotent' (by default,
+        GET and HEAD requests are).
+        """
+        if idempotent is None:
+            idempotent = method.upper() in ('GET', 'HEAD')
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.retries if idempotent else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.request(method, self.url(path),
+                                                **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt == retries:
+                    raise
+                continue
+            if response.status_code not in RETRY_STATUS or attempt == retries:
+                return response
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Compares latency of exact-match lookups (as used by the BLAST page for
+searches with 100% identity and coverage) with running the same queries
+through a blast worker. Sample queries are (exact) sequences of ASVs in the
+BLAST database.
+
+Runs in the main container, which can reach both the API and the workers:
+
+    docker exec -i asv-main python3 - < scripts/blast_fastpath_benchmark.py
+"""
+
+import hashlib
+import logging
+import os
+import statistics
+import time
+import uuid
+
+import requests
+
+POSTGREST = os.getenv('POSTGREST_HOST', 'http://postgrest:3000')
+WORKER = 'http://blast-worker:5000/'
+BLAST_DB = os.getenv('BLAST_DB', '/blastdbs/asvdb')
+
+
+def sample_queries(n_seqs: int) -> list:
+    """
+    Returns FASTA records for n_seqs ASVs in the BLAST database.
+    """
+    response = requests.get(f'{POSTGREST}/app_asvs_for_blastdb',
+                            params={'select': 'asv_sequence',
+                                    'limit': n_seqs})
+    response.raise_for_status()
+    return [row['asv_sequence'] for row in response.json()]
+
+
+def fasta(seqs: list) -> str:
+    """
+    Returns FASTA text with random headers, so that the worker result cache
+    is not used.
+    """
+    return '\n'.join(f'>{uuid.uuid4().hex}\n{seq}' for seq in seqs)
+
+
+def exact_lookup(seqs: list):
+    ids = [f'ASV:{hashlib.md5(s.encode()).hexdigest()}' for s in seqs]
+    response = requests.post(f'{POSTGREST}/rpc/app_asvs_from_id',
+                             json={'ids': ids})
+    response.raise_for_status()
+
+
+def blast(seqs: list):
+    form = {'sequence': [fasta(seqs)], 'min_identity': ['100'],
+            'min_qry_cover': ['100'], 'db': BLAST_DB}
+    response = requests.post(WORKER, json=form)
+    response.raise_for_status()
+
+
+def benchmark(n_seqs: int, repeats: int):
+    """
+    Times exact lookups and BLAST searches, and logs the results.
+    """
+    seqs = sample_queries(n_seqs)
+    for name, func in [('exact lookup', exact_lookup), ('blastn', blast)]:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            func(seqs)
+            times.append(1000 * (time.perf_counter() - start))
+        logging.info("%-15s median %9.1f ms  (min %.1f, max %.1f)", name,
+                     statistics.median(times), min(times), max(times))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+
+    PARSER.add_argument('--seqs', type=int, default=10,
+                        help="Number of query sequences per search.")
+    PARSER.add_argument('--repeats', type=int, default=5,
+                        help="Number of times to run each alternative.")
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    benchmark(ARGS.seqs, ARGS.repeats)
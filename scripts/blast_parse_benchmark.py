@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Compares time and peak memory of parsing tabular BLAST output and encoding it
+as JSON, for the worker's current (rows parsed line by line, as read from
+blastn, chunked JSON) and previous (per-field parser of the whole output,
+single JSON document) implementations. Uses synthetic output with 10k, 100k
+and 1M rows (by default).
+
+Runs in a blast-worker container, where it uses the worker's own code, e.g.:
+
+    docker exec -i mol-mod_blast-worker_1 python3 - < \\
+        scripts/blast_parse_benchmark.py
+"""
+
+import hashlib
+import json
+import logging
+import random
+import time
+import tracemalloc
+
+from worker import FIELD_NAMES, json_chunks, parse_blast_row
+
+
+def synthetic_output(n_rows: int) -> bytes:
+    """
+    Returns n_rows of tabular BLAST output, with realistic field lengths.
+    """
+    rng = random.Random(n_rows)
+    taxonomy = 'Bacteria;Proteobacteria;Alphaproteobacteria;Rhodobacterales;' \
+               'Rhodobacteraceae;Planktomarina;;;'
+    rows = []
+    for i in range(n_rows):
+        asv_id = f'ASV:{hashlib.md5(str(i).encode()).hexdigest()}'
+        rows.append(f'query-{i // 500}\t{asv_id}-{taxonomy}\t'
+                    f'{rng.uniform(80, 100):.3f}\t{rng.randint(80, 100)}\t'
+                    f'{rng.uniform(0, 1) ** 20:.2e}\n')
+    return ''.join(rows).encode()
+
+
+def previous_parse(stdout: bytes) -> list:
+    """
+    Parser used by the worker before, kept here as baseline.
+    """
+    raw = stdout.decode()
+    results = []
+    for row in raw.split('\n'):
+        row = row.strip()
+        if not row:
+            continue
+        result = {}
+        for i, field in enumerate(row.split("\t")):
+            try:
+                value = float(field)
+            except ValueError:
+                value = field
+            result[FIELD_NAMES[i]] = value
+        results += [result]
+    return results
+
+
+def previous(stdout: bytes) -> int:
+    body = json.dumps({'data': previous_parse(stdout)}).encode()
+    return len(body)
+
+
+def current(stdout: bytes) -> int:
+    # Parse lines as the job queue reads them, and count bytes as they would
+    # be sent, without keeping the whole body
+    rows = [row for row in map(parse_blast_row, stdout.splitlines(True))
+            if row is not None]
+    return sum(len(chunk.encode()) for chunk in json_chunks(rows, False))
+
+
+def measure(func, stdout: bytes) -> tuple:
+    """
+    Returns run time (s) and peak memory (MB) of func(stdout).
+    """
+    start = time.perf_counter()
+    func(stdout)
+    seconds = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(stdout)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak / 1024 / 1024
+
+
+def benchmark(sizes: list):
+    """
+    Measures both implementations for each output size, and logs results.
+    """
+    logging.info("%9s %-10s %10s %12s", 'rows', 'parser', 'seconds',
+                 'peak MB')
+    for n_rows in sizes:
+        stdout = synthetic_output(n_rows)
+        for name, func in [('previous', previous), ('current', current)]:
+            seconds, peak = measure(func, stdout)
+            logging.info("%9d %-10s %10.2f %12.1f", n_rows, name, seconds,
+                         peak)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+
+    PARSER.add_argument('--sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000],
+                        help="Numbers of output rows.")
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    benchmark(ARGS.sizes)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Measures BLAST throughput (query sequences per second) for queries of
+different sizes, when split into different numbers of shards (concurrent
+blastn processes, sharing the worker's BLAST_THREADS). Query sequences are
+taken from the BLAST database itself.
+
+Runs in a blast-worker container, where it uses the worker's own code, e.g.:
+
+    docker exec -i mol-mod_blast-worker_1 python3 - < \\
+        scripts/blast_shard_benchmark.py --shards 1 2 4
+"""
+
+import logging
+import os
+import subprocess
+import time
+
+from jobs import DONE, JobQueue
+from worker import BLAST_THREADS, blast_command, resolve_db, split_query
+
+
+def sample_queries(db_path: str, n_seqs: int) -> list:
+    """
+    Returns FASTA records for (up to) the first n_seqs sequences in database.
+    """
+    cmd = ['blastdbcmd', '-db', db_path, '-entry', 'all', '-outfmt', '%s']
+    process = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    seqs = process.stdout.split()[:n_seqs]
+    return [f'>q{i}\n{seq}' for i, seq in enumerate(seqs)]
+
+
+def benchmark(db: str, sizes: list, shard_counts: list, repeats: int):
+    """
+    Runs queries of each size with each shard count, and logs throughput.
+    """
+    db_path = resolve_db(db)[0]
+    queries = sample_queries(db_path, max(sizes))
+    form = {'min_identity': '90', 'min_qry_cover': '90', 'db': db}
+    jobs = JobQueue(1, 1)
+
+    logging.info("%8s %8s %12s %12s", 'queries', 'shards', 'seconds',
+                 'queries/s')
+    for size in sizes:
+        query = '\n'.join(queries[:size])
+        for n_shards in shard_counts:
+            cmd = blast_command(form, max(1, BLAST_THREADS // n_shards),
+                                db_path)
+            shards = [(cmd, part.encode())
+                      for part in split_query(query, n_shards)]
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                job = jobs.submit(shards)
+                job.wait()
+                if job.state != DONE:
+                    logging.error(job.stderr.decode())
+                    return
+                times.append(time.perf_counter() - start)
+            best = min(times)
+            logging.info("%8d %8d %12.2f %12.1f", size, len(shards), best,
+                         size / best)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+
+    PARSER.add_argument('--db', default=os.getenv('BLAST_DB', 'asvdb'),
+                        help="Name of BLAST database (active version).")
+    PARSER.add_argument('--sizes', type=int, nargs='+',
+                        default=[1, 10, 100, 1000],
+                        help="Numbers of query sequences.")
+    PARSER.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4],
+                        help="Numbers of shards to split queries into.")
+    PARSER.add_argument('--repeats', type=int, default=3,
+                        help="Number of times to run each combination.")
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    benchmark(ARGS.db, ARGS.sizes, ARGS.shards, ARGS.repeats)
@@ -90,6 +90,10 @@ while true; do
 	# Perform deletion.
 	printf 'DELETING "%s"...\n' "$dataset"
 	dataset=${dataset//pid:/}
+	# Remove dataset from filter search data and About stats first,
+	# as the former uses dataset data
+	do_dbquery 'SELECT search_remove_dataset('"$dataset"')' >/dev/null
+	do_dbquery 'SELECT about_remove_dataset('"$dataset"')' >/dev/null
 	do_dbquery 'DELETE FROM dataset WHERE pid = '"$dataset"
 	do_dbquery 'DELETE FROM asv WHERE pid NOT IN (SELECT DISTINCT asv_pid FROM occurrence)'
 	echo 'Done.'
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""
+Benchmarks FILTER dropdown option requests (api.app_drop_options), comparing
+the previous function, which matched options with a case-insensitive regex
+in api.app_filter_mixs_tax and paged through them with OFFSET, with the
+current one, which searches options by prefix in api.app_filter_options and
+pages through them by value (keyset pagination, see db/db-api-schema.sql).
+
+Each request (e.g. opening a dropdown, typing, scrolling far down) is run with
+EXPLAIN (ANALYZE, BUFFERS) a number of times, and the median execution time
+and number of buffers used are logged. The previous function is only created
+temporarily (in a rolled back transaction), so the database is left
+unchanged. Use on a large database (e.g. a production restore) to get useful
+numbers.
+"""
+
+import json
+import logging
+import statistics
+import subprocess
+import sys
+
+# load database connection variables from the environment file
+ENV = {}
+for line in open('../.env'):
+    line = line.strip()
+    if not line or line[0] == '#':
+        continue
+    option, value = line.split('=', 1)
+    ENV[option.strip()] = value.strip().strip("'")
+
+# Function previously used for dropdown options (baseline)
+BASELINE = """
+CREATE FUNCTION pg_temp.app_drop_options_old(
+    field text,
+    noffset bigint,
+    nlimit integer,
+    term text DEFAULT '',
+    kingdom text[] DEFAULT '{}',
+    phylum text[] DEFAULT '{}',
+    classs text[] DEFAULT '{}',
+    oorder text[] DEFAULT '{}',
+    family text[] DEFAULT '{}',
+    genus text[] DEFAULT '{}',
+    species text[] DEFAULT '{}',
+    gene text[] DEFAULT '{}',
+    sub text[] DEFAULT '{}',
+    fw_prim text[] DEFAULT '{}',
+    rv_prim text[] DEFAULT '{}')
+RETURNS TABLE(data json)
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    RETURN QUERY EXECUTE format(
+        'WITH filtered AS (
+            SELECT DISTINCT %I AS id
+            FROM api.app_filter_mixs_tax
+            WHERE %I <> '''' AND %I IS NOT NULL
+            AND ($1 = ''{}'' OR kingdom = ANY($1))
+            AND ($2 = ''{}'' OR phylum = ANY($2))
+            AND ($3 = ''{}'' OR classs = ANY($3))
+            AND ($4 = ''{}'' OR oorder = ANY($4))
+            AND ($5 = ''{}'' OR family = ANY($5))
+            AND ($6 = ''{}'' OR genus = ANY($6))
+            AND ($7 = ''{}'' OR species = ANY($7))
+            AND %I ~* $8
+            AND ($9 = ''{}'' OR gene = ANY($9))
+            AND ($10 = ''{}'' OR sub = ANY($10))
+            AND ($11 = ''{}'' OR fw_prim = ANY($11))
+            AND ($12 = ''{}'' OR rv_prim = ANY($12))
+            ORDER BY %I
+            OFFSET $13
+            LIMIT $14 + 1)
+        SELECT json_build_object(
+            ''count'', (SELECT COUNT(*) FROM filtered),
+            ''results'', COALESCE(json_agg(json_build_object(''id'', f.id, ''text'', f.id)),''[]'')
+        ) FROM filtered f', field, field, field, field, field, field)
+    USING kingdom, phylum, classs, oorder, family, genus, species, '^'||term||'.*$',
+    gene, sub, fw_prim, rv_prim, noffset, nlimit;
+END;
+$$;
+"""
+
+# Options per page, as requested by filter_routes.py
+LIMIT = 25
+
+
+def run_on_db(queries: list) -> str:
+    """
+    Executes queries in a single (rolled back) transaction, using psql inside
+    the database container, and returns output (unaligned, without headers).
+    """
+    user = ENV.get('POSTGRES_USER', 'postgres')
+    database = ENV.get('POSTGRES_DB', 'asv')
+
+    cmd = ['docker', 'exec', 'asv-db', 'psql', '-U', user, database,
+           '-qAt', '-c', 'BEGIN;']
+    for query in queries:
+        cmd += ['-c', query]
+    cmd += ['-c', 'ROLLBACK;']
+
+    process = subprocess.run(cmd, capture_output=True, text=True)
+    if process.returncode != 0 or 'ERROR' in process.stderr:
+        logging.error('error: %s', process.stderr.strip())
+        sys.exit(1)
+    return process.stdout.strip()
+
+
+def quote(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def most_common(field: str, where: str = 'TRUE') -> str:
+    """
+    Returns most common value of field in FILTER view (rows matching where).
+    """
+    return run_on_db([f"SELECT {field} FROM api.app_filter_mixs_tax "
+                      f"WHERE {field} <> '' AND {where} "
+                      f"GROUP BY 1 ORDER BY count(*) DESC LIMIT 1;"])
+
+
+def call(function: str, field: str, offset: int, term: str = '',
+         selections: dict = None, after: str = None, limit: int = LIMIT,
+         columns: str = '*') -> str:
+    """
+    Returns SQL calling dropdown option function with (named) arguments.
+    """
+    args = [quote(field), str(offset), str(limit), quote(term)]
+    for name, values in (selections or {}).items():
+        array = '{' + ','.join('"{}"'.format(v.replace('"', '\\"'))
+                               for v in values) + '}'
+        args.append(f'{name} => {quote(array)}')
+    if after is not None:
+        args.append(f'after_value => {quote(after)}')
+    return f"SELECT {columns} FROM {function}({', '.join(args)})"
+
+
+def explain(query: str, repeats: int) -> tuple:
+    """
+    Returns median execution time (ms) and buffers (shared hit + read) of
+    query, as reported by EXPLAIN ANALYZE.
+    """
+    times, buffers = [], []
+    for _ in range(repeats):
+        plan = json.loads(run_on_db(
+            [BASELINE, f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query};"]
+        ))[0]
+        times.append(plan['Execution Time'])
+        buffers.append(plan['Plan']['Shared Hit Blocks']
+                       + plan['Plan']['Shared Read Blocks'])
+    return statistics.median(times), statistics.median(buffers)
+
+
+def benchmark(repeats: int = 5):
+    """
+    Times option requests with previous and current function, and logs the
+    results.
+    """
+    kingdom = most_common('kingdom')
+    phylum = most_common('phylum', f"kingdom = {quote(kingdom)}")
+    genus = most_common('genus')
+
+    # Requests as (name, field, page, term, selections)
+    requests = [
+        ('open genus', 'genus', 1, '', {}),
+        ('type genus prefix', 'genus', 1, genus[:3], {}),
+        ('scroll species to page 20', 'species', 20, '', {}),
+        ('open class in phylum', 'classs', 1, '', {'phylum': [phylum]}),
+        ('scroll genus in kingdom to page 10', 'genus', 10, '',
+         {'kingdom': [kingdom]}),
+    ]
+
+    logging.info("%-36s %-9s %12s %12s", 'request', 'function', 'median ms',
+                 'buffers')
+    for name, field, page, term, selections in requests:
+        offset = (page - 1) * LIMIT
+        # Page after the previous one, as requested when scrolling, starts
+        # after the last option of that page
+        after = None
+        if page > 1:
+            after = run_on_db([call(
+                'api.app_drop_options', field, offset - 1, term, selections,
+                limit=1, columns="data->'results'->0->>'id'") + ';']) or None
+        queries = {
+            'previous': call('pg_temp.app_drop_options_old', field, offset,
+                             term, selections),
+            'current': call('api.app_drop_options', field, 0 if after else
+                            offset, term, selections, after),
+        }
+        for function, query in queries.items():
+            ms, buffers = explain(query, repeats)
+            logging.info("%-36s %-9s %12.2f %12d", name, function, ms,
+                         buffers)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+
+    PARSER.add_argument('--repeats', type=int, default=5,
+                        help="Number of times to run each request.")
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    benchmark(ARGS.repeats)
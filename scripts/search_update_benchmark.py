@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Benchmarks updates of the FILTER search table (api.app_search_mixs_tax) when a
+single dataset is added to or removed from the Bioatlas. Compares the full
+rebuild that a materialized view required with per-dataset updates (see
+search_add_dataset / search_remove_dataset in db/db-api-schema.sql).
+
+All statements are executed in transactions that are rolled back, so the
+database is left unchanged. Use on a large database (e.g. a production
+restore, or with test datasets added by db_tester.py) to get useful numbers.
+"""
+
+import logging
+import re
+import statistics
+import subprocess
+import sys
+
+# load database connection variables from the environment file
+ENV = {}
+for line in open('../.env'):
+    line = line.strip()
+    if not line or line[0] == '#':
+        continue
+    option, value = line.split('=', 1)
+    ENV[option.strip()] = value.strip().strip("'")
+
+# Query previously used to (re)build the materialized view
+FULL_REFRESH = """
+CREATE TEMP TABLE old_search_mixs_tax AS
+SELECT DISTINCT asv.asv_id,
+    concat_ws('|'::text, concat_ws(''::text, asv.asv_id, '-', ta.kingdom), ta.phylum, ta.class, ta.oorder, ta.family, ta.genus, ta.specific_epithet, ta.infraspecific_epithet, ta.otu) AS asv_tax,
+    asv.asv_sequence,
+    mixs.target_gene AS gene,
+    mixs.target_subfragment AS sub,
+    (mixs.pcr_primer_name_forward)::text AS fw_name,
+    (mixs.pcr_primer_forward)::text AS fw_sequence,
+    (mixs.pcr_primer_name_reverse)::text AS rv_name,
+    (mixs.pcr_primer_reverse)::text AS rv_sequence,
+    (((mixs.pcr_primer_name_forward)::text || ': '::text) || (mixs.pcr_primer_forward)::text) AS fw_prim,
+    (((mixs.pcr_primer_name_reverse)::text || ': '::text) || (mixs.pcr_primer_reverse)::text) AS rv_prim,
+    ta.kingdom, ta.phylum, ta.class AS classs, ta.oorder, ta.family, ta.genus,
+    ta.specific_epithet AS species
+FROM mixs
+    JOIN occurrence oc ON oc.event_pid = mixs.pid
+    JOIN asv ON asv.pid = oc.asv_pid
+    JOIN taxon_annotation ta ON asv.pid = ta.asv_pid
+    JOIN sampling_event se ON oc.event_pid = se.pid
+    JOIN dataset ds ON se.dataset_pid = ds.pid
+WHERE ds.in_bioatlas
+    AND ta.status::text = 'valid'::text
+    AND ta.target_prediction = TRUE
+    AND ta.annotation_target = mixs.target_gene
+ORDER BY 1, 3, 4, 5, 10, 11;
+"""
+
+
+def time_on_db(queries: list) -> float:
+    """
+    Executes queries in a single (rolled back) transaction, using psql inside
+    the database container, and returns total execution time in ms, as
+    reported by psql.
+    """
+    user = ENV.get('POSTGRES_USER', 'postgres')
+    database = ENV.get('POSTGRES_DB', 'asv')
+
+    cmd = ['docker', 'exec', 'asv-db', 'psql', '-U', user, database,
+           '-c', '\\timing on', '-c', 'BEGIN;']
+    for query in queries:
+        cmd += ['-c', query]
+    cmd += ['-c', 'ROLLBACK;']
+
+    process = subprocess.run(cmd, capture_output=True, text=True)
+    if process.returncode != 0 or 'ERROR' in process.stderr:
+        logging.error('error: %s', process.stderr.strip())
+        sys.exit(1)
+
+    # One 'Time: ...' line per statement, incl. BEGIN and ROLLBACK
+    times = [float(t) for t in
+             re.findall(r'^Time: ([\d.]+) ms', process.stdout, re.M)]
+    return sum(times[1:-1])
+
+
+def benchmark(pid: int, repeats: int = 5):
+    """
+    Times the full and per-dataset update alternatives, and logs the results.
+    """
+    # Toggle the dataset's status in the same way as status_updater.py
+    in_bioatlas = f"SELECT in_bioatlas FROM dataset WHERE pid = {pid}"
+    alternatives = {
+        'full refresh (materialized view)': [
+            f"UPDATE dataset SET in_bioatlas = NOT in_bioatlas "
+            f"WHERE pid = {pid};",
+            FULL_REFRESH],
+        'full rebuild (search_rebuild)': [
+            f"UPDATE dataset SET in_bioatlas = NOT in_bioatlas "
+            f"WHERE pid = {pid};",
+            "SELECT search_rebuild();"],
+        'per dataset (add/remove)': [
+            f"UPDATE dataset SET in_bioatlas = NOT in_bioatlas "
+            f"WHERE pid = {pid};",
+            f"SELECT CASE WHEN ({in_bioatlas}) "
+            f"THEN search_add_dataset({pid}) "
+            f"ELSE search_remove_dataset({pid}) END;"],
+    }
+
+    for name, queries in alternatives.items():
+        times = [time_on_db(queries) for _ in range(repeats)]
+        logging.info("%-35s median %9.1f ms  (min %.1f, max %.1f)", name,
+                     statistics.median(times), min(times), max(times))
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+
+    PARSER.add_argument('pid', type=int,
+                        help="pid of dataset to toggle in_bioatlas for.")
+    PARSER.add_argument('--repeats', type=int, default=5,
+                        help="Number of times to run each alternative.")
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    benchmark(ARGS.pid, ARGS.repeats)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Compares latency of API calls made with a new connection per request (plain
+requests.get, as routes did before) and with the pooled, keep-alive client in
+upstream.py. By default, calls go to a local stand-in server (answering like
+PostgREST, with a small JSON body), started by the script itself, but any
+URL can be given, e.g. an API view.
+
+Runs in the main container, where it uses the app's own client, e.g.:
+
+    docker exec -i asv-main python3 - < scripts/upstream_benchmark.py
+    docker exec -i asv-main python3 - < scripts/upstream_benchmark.py \\
+        --url http://postgrest:3000/app_about_stats
+"""
+
+import json
+import logging
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from upstream import Upstream
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """
+    Answers all GET requests with a small JSON body, keeping connections
+    alive (HTTP/1.1), as PostgREST does.
+    """
+    protocol_version = 'HTTP/1.1'
+    # Send headers and body in one write, as otherwise delayed ACKs stall
+    # kept-alive connections
+    wbufsize = -1
+    body = json.dumps([{'asv_id': 'ASV:0', 'count': 1}]).encode()
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in() -> str:
+    """
+    Starts stand-in server on a free local port, and returns its URL.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_address[1]}/app_about_stats'
+
+
+def measure(get, url: str, n_calls: int) -> list:
+    """
+    Returns latencies (ms) of n_calls sequential calls to url.
+    """
+    times = []
+    for _ in range(n_calls):
+        start = time.perf_counter()
+        response = get(url)
+        response.raise_for_status()
+        response.content
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def benchmark(url: str, n_calls: int):
+    """
+    Measures both clients, and logs latency statistics.
+    """
+    client = Upstream()
+    logging.info('%s, %d calls per client', url, n_calls)
+    logging.info("%-10s %10s %10s %10s", 'client', 'mean ms', 'median ms',
+                 'p95 ms')
+    for name, get in [('new conn', requests.get), ('pooled', client.get)]:
+        # Warm up (e.g. DNS, and the pool)
+        measure(get, url, 5)
+        times = sorted(measure(get, url, n_calls))
+        logging.info("%-10s %10.2f %10.2f %10.2f", name,
+                     statistics.mean(times), statistics.median(times),
+                     times[int(0.95 * (len(times) - 1))])
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    PARSER = argparse.ArgumentParser(description=__doc__)
+
+    PARSER.add_argument('--url', help="URL to call (default: local stand-in "
+                                      "server).")
+    PARSER.add_argument('--calls', type=int, default=500,
+                        help="Number of calls per client.")
+
+    ARGS = PARSER.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    benchmark(ARGS.url or start_stand_in(), ARGS.calls)